@@ -0,0 +1,76 @@
+"""
+Measure peak memory while saving attachments, decoded whole and streamed.
+
+    python benchmarks/bench_attachment_memory.py --attachments 4 --attachment-mb 25
+
+Peaks are measured with tracemalloc after each message has been parsed, so they
+show only what saving the attachments adds on top of the parsed message.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+from bench_clean_pool import quiet  # noqa: E402
+from corpus import make_email  # noqa: E402
+from emails import get_attachments, parse_email  # noqa: E402
+
+
+def save_whole(msg, attachments_dir):
+    """
+    Save attachments the way get_attachments used to, decoding each one in full.
+    """
+    for part in msg.iter_parts():
+        if part.get_content_disposition() != "attachment":
+            continue
+        with open(os.path.join(attachments_dir, part.get_filename()), "wb") as f:
+            f.write(part.get_payload(decode=True))
+
+
+def save_streamed(msg, attachments_dir):
+    get_attachments(msg, attachments_dir, store="files")
+
+
+def measure(save, raw_email):
+    with tempfile.TemporaryDirectory() as attachments_dir:
+        msg = parse_email(raw_email)
+        tracemalloc.start()
+        start = time.perf_counter()
+        with quiet():
+            save(msg, attachments_dir)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--attachments", type=int, default=4)
+    parser.add_argument("--attachment-mb", type=int, default=25)
+    args = parser.parse_args()
+
+    raw_email = make_email(
+        0,
+        random.Random(0),
+        attachments=args.attachments,
+        attachment_size=args.attachment_mb * 1024 * 1024,
+    )
+    print(
+        f"1 message, {args.attachments} attachments of {args.attachment_mb} MB, "
+        f"{len(raw_email) / 1024 / 1024:.1f} MB raw"
+    )
+    print(f"{'decoding':>8}  {'peak MB':>8}  {'seconds':>8}")
+    for name, save in (("whole", save_whole), ("streamed", save_streamed)):
+        peak, elapsed = measure(save, raw_email)
+        print(f"{name:>8}  {peak / 1024 / 1024:>8.1f}  {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
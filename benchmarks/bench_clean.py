@@ -0,0 +1,154 @@
+"""
+Benchmark each step of cleaning an email, and cleaning as a whole, on synthetic corpora.
+
+    python benchmarks/bench_clean.py --profiles plain html_only nested mixed
+    python benchmarks/bench_clean.py --compare benchmarks/results/clean-20240101-100000.json
+
+Each corpus profile (see corpus.PROFILES) stresses one thing: long bodies,
+charsets, HTML, deep MIME nesting or attachments. Every step is timed over the
+whole corpus, taking the best of a few runs, then run once more under
+tracemalloc for its peak memory. Throughput in MB/sec is of raw email bytes.
+Results are saved as JSON, and can be compared with an earlier run.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+from bench_clean_pool import quiet  # noqa: E402
+from corpus import PROFILES, generate_profile  # noqa: E402
+from emails import (  # noqa: E402
+    build_email_content,
+    clean_email_with_metadata,
+    format_subject,
+    get_attachments,
+    get_body,
+    parse_email,
+)
+from results import load_results, print_comparison, save_results  # noqa: E402
+
+
+def steps(corpus, config):
+    """
+    Return the steps to time, each a function run once per message. All but
+    parse and clean work on messages parsed beforehand.
+    """
+    parsed = [parse_email(raw_email) for _, raw_email in corpus]
+    bodies = [get_body(msg) for msg in parsed]
+
+    def content(index):
+        msg = parsed[index]
+        return build_email_content(
+            "email.eml", "2024-01-01", msg["Subject"], msg["To"], msg["From"], [], bodies[index]
+        )
+
+    return {
+        "parse_email": lambda index: parse_email(corpus[index][1]),
+        "get_body": lambda index: get_body(parsed[index]),
+        "get_attachments": lambda index: get_attachments(
+            parsed[index], config.ATTACHMENTS_DIR, store="files"
+        ),
+        "format_subject": lambda index: format_subject(parsed[index]["Subject"]),
+        "build_email_content": content,
+        "clean_email": lambda index: clean_email_with_metadata(
+            corpus[index][1], config, corpus[index][0]
+        ),
+    }
+
+
+def time_step(step, count, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for index in range(count):
+            step(index)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(step, count):
+    """
+    Return the most memory a step held at once on any message, over what was already allocated.
+    """
+    tracemalloc.start()
+    for index in range(count):
+        step(index)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run_profile(profile, args):
+    corpus = generate_profile(profile, args.messages, max_bytes=args.max_mb * 1024 * 1024)
+    megabytes = sum(len(raw_email) for _, raw_email in corpus) / 1024 / 1024
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = SimpleNamespace(
+            CLEAN_EMAIL_DIR=os.path.join(temp_dir, "clean"),
+            ATTACHMENTS_DIR=os.path.join(temp_dir, "attachments"),
+        )
+        os.makedirs(config.CLEAN_EMAIL_DIR)
+        os.makedirs(config.ATTACHMENTS_DIR)
+        with quiet():
+            profile_steps = steps(corpus, config)
+        for name, step in profile_steps.items():
+            with quiet():
+                seconds = time_step(step, len(corpus), args.repeat)
+                peak = peak_memory(step, len(corpus))
+            rows.append(
+                {
+                    "profile": profile,
+                    "function": name,
+                    "messages": len(corpus),
+                    "megabytes": round(megabytes, 2),
+                    "seconds": round(seconds, 4),
+                    "msgs_per_sec": round(len(corpus) / seconds, 1),
+                    "mb_per_sec": round(megabytes / seconds, 2),
+                    "peak_kb": round(peak / 1024, 1),
+                }
+            )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--profiles", nargs="+", choices=PROFILES, default=list(PROFILES))
+    parser.add_argument("--messages", type=int, default=200)
+    # Keeps the attachment-heavy profiles from taking minutes
+    parser.add_argument("--max-mb", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="where to save the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    print(
+        f"{'profile':>16}  {'function':>19}  {'msgs':>5}  {'MB':>7}  "
+        f"{'msgs/sec':>9}  {'MB/sec':>8}  {'peak KB':>9}"
+    )
+    rows = []
+    for profile in args.profiles:
+        for row in run_profile(profile, args):
+            rows.append(row)
+            print(
+                f"{row['profile']:>16}  {row['function']:>19}  {row['messages']:>5}  "
+                f"{row['megabytes']:>7.1f}  {row['msgs_per_sec']:>9.1f}  "
+                f"{row['mb_per_sec']:>8.2f}  {row['peak_kb']:>9.1f}"
+            )
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    path = save_results("clean", params, rows, args.output)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        print_comparison(
+            rows, load_results(args.compare), ("profile", "function"), ("msgs_per_sec", "peak_kb")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark cleaning a synthetic corpus serially and with pools of worker processes.
+
+    python benchmarks/bench_clean_pool.py --messages 400 --processes 1 2 4
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+from corpus import generate_corpus  # noqa: E402
+from emails import clean_emails  # noqa: E402
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silence the per-message prints from clean_email, including those of worker processes.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def read_dir(path):
+    return {name: open(os.path.join(path, name), "rb").read() for name in os.listdir(path)}
+
+
+def run(corpus, processes):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = SimpleNamespace(
+            CLEAN_EMAIL_DIR=os.path.join(temp_dir, "clean"),
+            ATTACHMENTS_DIR=os.path.join(temp_dir, "attachments"),
+        )
+        os.makedirs(config.CLEAN_EMAIL_DIR)
+        os.makedirs(config.ATTACHMENTS_DIR)
+
+        start = time.perf_counter()
+        clean_emails(corpus, config, processes=processes)
+        elapsed = time.perf_counter() - start
+
+        return elapsed, read_dir(config.CLEAN_EMAIL_DIR), read_dir(config.ATTACHMENTS_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--attachments", type=int, default=2)
+    parser.add_argument("--attachment-kb", type=int, default=512)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    corpus = generate_corpus(
+        args.messages,
+        attachments=args.attachments,
+        attachment_size=args.attachment_kb * 1024,
+    )
+    megabytes = sum(len(raw) for _, raw in corpus) / 1024 / 1024
+    print(f"{args.messages} messages, {megabytes:.1f} MB, {os.cpu_count()} CPUs")
+    print(f"{'processes':>9}  {'seconds':>8}  {'msgs/sec':>9}  {'MB/sec':>7}  {'speed-up':>8}")
+
+    baseline = None
+    for processes in args.processes:
+        with quiet():
+            elapsed, clean_files, attachments = run(corpus, processes)
+
+        if baseline is None:
+            baseline = (elapsed, clean_files, attachments)
+        elif (clean_files, attachments) != baseline[1:]:
+            print(f"Output with {processes} processes differs from the first run!")
+
+        print(
+            f"{processes:>9}  {elapsed:>8.2f}  {args.messages / elapsed:>9.1f}  "
+            f"{megabytes / elapsed:>7.1f}  {baseline[0] / elapsed:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark fetch_emails end to end against the local Gmail stand-in.
+
+    python benchmarks/bench_fetch.py --messages 1000 --latency-ms 30 --workers 1 4 8
+    python benchmarks/bench_fetch.py --batch-size 50 --error-rate 0.02 --rate-limit 200
+
+Serves a generated mailbox over HTTP (see gmail_server.py) and fetches all of
+it into temporary directories, once per setting of --workers. Reports messages
+per second, the p50 and p99 time to download each message (a batched message
+counts its whole batch), the bytes written and how many calls the server
+throttled or failed. Results are saved as JSON, and can be compared with an earlier run.
+"""
+
+import argparse
+import copy
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+import emails  # noqa: E402
+import httplib2  # noqa: E402
+from bench_clean_pool import quiet  # noqa: E402
+from corpus import PROFILES  # noqa: E402
+from gmail_server import generate_mailbox, start_server  # noqa: E402
+from googleapiclient.discovery import build_from_document  # noqa: E402
+from results import load_results, print_comparison, save_results  # noqa: E402
+
+
+def local_builder(url):
+    """
+    Return a stand-in for emails.build_service that talks to the server at url.
+    """
+    document = copy.deepcopy(emails.load_discovery_document())
+    document["rootUrl"] = url
+    document["baseUrl"] = url
+    lock = threading.Lock()
+
+    def build_service(creds):
+        # Building changes the document it is given, so one thread builds at a time
+        with lock:
+            return build_from_document(document, http=httplib2.Http())
+
+    return build_service
+
+
+def timed(function, latencies, count):
+    """
+    Wrap a download function to record how long each message took.
+    """
+
+    def wrapper(service, message_ids, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(service, message_ids, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        latencies.extend([elapsed] * count(message_ids))
+        return result
+
+    return wrapper
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def run(url, args, workers):
+    latencies = []
+    saved = (
+        emails.get_credentials,
+        emails.build_service,
+        emails.get_message,
+        emails.get_messages_batch,
+    )
+    emails.get_credentials = lambda: object()
+    emails.build_service = local_builder(url)
+    emails.get_message = timed(emails.get_message, latencies, lambda message_id: 1)
+    emails.get_messages_batch = timed(emails.get_messages_batch, latencies, len)
+    # Each run needs services built for its own server
+    emails._services.update(creds=None, idle=[])
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = SimpleNamespace(
+                RAW_EMAIL_DIR=os.path.join(temp_dir, "raw"),
+                CLEAN_EMAIL_DIR=os.path.join(temp_dir, "clean"),
+                ATTACHMENTS_DIR=os.path.join(temp_dir, "attachments"),
+            )
+            for path in vars(config).values():
+                os.makedirs(path)
+            start = time.perf_counter()
+            with quiet():
+                result = emails.fetch_emails(
+                    "stu@bmail.com",
+                    config,
+                    batch_size=args.batch_size,
+                    workers=workers,
+                    raw_store=args.raw_store,
+                )
+            elapsed = time.perf_counter() - start
+            written = directory_size(temp_dir)
+    finally:
+        (
+            emails.get_credentials,
+            emails.build_service,
+            emails.get_message,
+            emails.get_messages_batch,
+        ) = saved
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "messages": result["total_messages"],
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(result["total_messages"] / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        "mb_written": round(written / 1024 / 1024, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--profile", choices=PROFILES, default="plain")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-size", type=int, default=0)
+    parser.add_argument("--raw-store", choices=("files", "packed"), default="files")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--rate-limit", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--output", help="where to save the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    print(
+        f"{'workers':>7}  {'msgs':>6}  {'seconds':>8}  {'msgs/sec':>9}  {'p50 ms':>8}  "
+        f"{'p99 ms':>8}  {'MB out':>7}  {'throttled':>9}  {'errors':>6}"
+    )
+    rows = []
+    for workers in args.workers:
+        mailbox = generate_mailbox(
+            args.profile,
+            args.messages,
+            page_size=args.page_size,
+            latency=args.latency_ms / 1000,
+            jitter=args.jitter_ms / 1000,
+            rate_limit=args.rate_limit,
+            error_rate=args.error_rate,
+        )
+        server, url = start_server(mailbox)
+        try:
+            row = run(url, args, workers)
+        finally:
+            server.shutdown()
+            server.server_close()
+        row.update(mailbox.counts)
+        rows.append(row)
+        print(
+            f"{row['workers']:>7}  {row['messages']:>6}  {row['seconds']:>8.2f}  "
+            f"{row['msgs_per_sec']:>9.1f}  {row['p50_ms']:>8.1f}  {row['p99_ms']:>8.1f}  "
+            f"{row['mb_written']:>7.1f}  {row['throttled']:>9}  {row['errors']:>6}"
+        )
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    path = save_results("fetch", params, rows, args.output)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        print_comparison(rows, load_results(args.compare), ("workers",), ("msgs_per_sec", "p99_ms"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Measure how long the app takes to start, and which imports the time goes to.
+
+    python benchmarks/bench_import.py --repeat 5 --top 10
+    python benchmarks/bench_import.py --compare benchmarks/results/import-20240101-100000.json
+
+Each target runs in a fresh interpreter with python -X importtime, taking the
+best of a few runs: importing the app, creating it with create_app, and building
+the Gmail service on the first fetch, which is when the client library and the
+Google auth libraries are imported. Wall time includes starting the interpreter.
+Results are saved as JSON, and can be compared with an earlier run.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from results import load_results, print_comparison, save_results
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app")
+
+TARGETS = {
+    "import": "import app",
+    "create_app": (
+        "import app; "
+        "app.create_app({{'SESSION_TYPE': 'redis', 'RAW_EMAIL_DIR': {root!r} + '/raw', "
+        "'CLEAN_EMAIL_DIR': {root!r} + '/clean', 'ATTACHMENTS_DIR': {root!r} + '/attachments'}})"
+    ),
+    "first_fetch": (
+        "import app, emails; "
+        "from google.auth.credentials import AnonymousCredentials; "
+        "emails.build_service(AnonymousCredentials())"
+    ),
+}
+
+# import time: self [us] | cumulative | imported package, indented two spaces per level
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def parse_importtime(stderr):
+    """
+    Return (module, depth, cumulative microseconds) for each import -X importtime reported.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports.append((match.group(4), len(match.group(3)) // 2, int(match.group(2))))
+    return imports
+
+
+def run_target(code):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=APP_DIR,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        sys.exit(f"{code} failed:\n{result.stderr[-2000:]}")
+    return seconds, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list per target")
+    parser.add_argument("--output", help="where to save the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        for target in args.targets:
+            code = TARGETS[target].format(root=root)
+            runs = [run_target(code) for _ in range(args.repeat)]
+            import_us, imports = min(
+                (sum(us for _, depth, us in imports if depth == 0), imports) for _, imports in runs
+            )
+            rows.append(
+                {
+                    "target": target,
+                    "wall_ms": round(min(run[0] for run in runs) * 1000, 1),
+                    "import_ms": round(import_us / 1000, 1),
+                    "modules": len(imports),
+                }
+            )
+            print(
+                f"\n{target}: {rows[-1]['import_ms']:.1f} ms importing {len(imports)} modules, "
+                f"{rows[-1]['wall_ms']:.1f} ms in all"
+            )
+            # The packages the code imports and what they import, by the time they took
+            slowest = sorted(
+                (entry for entry in imports if entry[1] <= 1), key=lambda entry: -entry[2]
+            )
+            for module, depth, us in slowest[: args.top]:
+                print(f"  {us / 1000:>8.1f} ms  {'  ' * depth}{module}")
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    path = save_results("import", params, rows, args.output)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        print_comparison(
+            rows, load_results(args.compare), ("target",), ("wall_ms", "import_ms", "modules")
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Compare the email package's parser with lazy parsing, alone and as part of cleaning.
+
+    python benchmarks/bench_parse.py --profiles large_attachment attachments nested
+    python benchmarks/bench_parse.py --compare benchmarks/results/parse-20240101-100000.json
+
+Each corpus is parsed, then cleaned, with both parsers (see emails.PARSER),
+taking the best CPU time of a few runs, then once more under tracemalloc for
+the peak memory. Cleaning with each parser must write the same files.
+Results are saved as JSON, and can be compared with an earlier run.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+import emails  # noqa: E402
+from bench_clean_pool import quiet  # noqa: E402
+from corpus import PROFILES, generate_profile  # noqa: E402
+from results import load_results, print_comparison, save_results  # noqa: E402
+
+PARSERS = ("full", "lazy")
+
+
+def cpu_time(step, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        for message_id, raw_email in corpus:
+            step(message_id, raw_email)
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def peak_memory(step, corpus):
+    """
+    Return the most memory the step held at once on any message.
+    """
+    tracemalloc.start()
+    for message_id, raw_email in corpus:
+        step(message_id, raw_email)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def written(config):
+    return {
+        name: open(os.path.join(directory, name), "rb").read()
+        for directory in (config.CLEAN_EMAIL_DIR, config.ATTACHMENTS_DIR)
+        for name in sorted(os.listdir(directory))
+    }
+
+
+def run_profile(profile, args):
+    corpus = generate_profile(profile, args.messages, max_bytes=args.max_mb * 1024 * 1024)
+    megabytes = sum(len(raw_email) for _, raw_email in corpus) / 1024 / 1024
+    rows = []
+    outputs = {}
+    for parser in PARSERS:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = SimpleNamespace(
+                CLEAN_EMAIL_DIR=os.path.join(temp_dir, "clean"),
+                ATTACHMENTS_DIR=os.path.join(temp_dir, "attachments"),
+            )
+            os.makedirs(config.CLEAN_EMAIL_DIR)
+            os.makedirs(config.ATTACHMENTS_DIR)
+            emails.PARSER = parser
+            steps = {
+                "parse": lambda message_id, raw_email: emails.parse_email(raw_email),
+                "clean": lambda message_id, raw_email: emails.clean_email_with_metadata(
+                    raw_email, config, message_id
+                ),
+            }
+            for name, step in steps.items():
+                with quiet():
+                    seconds = cpu_time(step, corpus, args.repeat)
+                    peak = peak_memory(step, corpus)
+                rows.append(
+                    {
+                        "profile": profile,
+                        "step": name,
+                        "parser": parser,
+                        "messages": len(corpus),
+                        "megabytes": round(megabytes, 2),
+                        "cpu_seconds": round(seconds, 4),
+                        "mb_per_sec": round(megabytes / seconds, 2),
+                        "peak_kb": round(peak / 1024, 1),
+                    }
+                )
+            outputs[parser] = written(config)
+
+    if outputs["lazy"] != outputs["full"]:
+        sys.exit(f"Cleaning {profile} with the lazy parser wrote different files.")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=PROFILES,
+        default=["plain", "nested", "attachments", "large_attachment", "mixed"],
+    )
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--max-mb", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="where to save the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    print(
+        f"{'profile':>16}  {'step':>5}  {'parser':>6}  {'msgs':>5}  {'MB':>7}  "
+        f"{'CPU s':>8}  {'MB/sec':>8}  {'peak KB':>10}"
+    )
+    rows = []
+    for profile in args.profiles:
+        profile_rows = run_profile(profile, args)
+        rows.extend(profile_rows)
+        for row in profile_rows:
+            print(
+                f"{row['profile']:>16}  {row['step']:>5}  {row['parser']:>6}  "
+                f"{row['messages']:>5}  {row['megabytes']:>7.1f}  {row['cpu_seconds']:>8.3f}  "
+                f"{row['mb_per_sec']:>8.1f}  {row['peak_kb']:>10.1f}"
+            )
+        for step in ("parse", "clean"):
+            full, lazy = (
+                next(row for row in profile_rows if row["step"] == step and row["parser"] == name)
+                for name in PARSERS
+            )
+            print(
+                f"{'':>16}  {step:>5}  lazy is {full['cpu_seconds'] / lazy['cpu_seconds']:.1f}x "
+                f"faster, peak {lazy['peak_kb'] / full['peak_kb']:.0%} of full"
+            )
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    path = save_results("parse", params, rows, args.output)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        print_comparison(
+            rows,
+            load_results(args.compare),
+            ("profile", "step", "parser"),
+            ("cpu_seconds", "peak_kb"),
+        )
+
+
+if __name__ == "__main__":
+    main()
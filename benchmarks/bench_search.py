@@ -0,0 +1,83 @@
+"""
+Benchmark indexing and searching the catalog's full-text index.
+
+    python benchmarks/bench_search.py --messages 1000000
+
+Fills a temporary catalog with synthetic messages, then times a few kinds of query.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+from catalog import Catalog  # noqa: E402
+from corpus import WORDS, make_text  # noqa: E402
+
+QUERIES = {
+    "rare word": "zanzibar",
+    "common word": "poem",
+    "two words": "barn teacher",
+    "prefix": "pump*",
+    "participant": "stu",
+}
+BATCH_SIZE = 1000
+
+
+def fill(catalog, count, rng):
+    for start in range(0, count, BATCH_SIZE):
+        records = []
+        for number in range(start, min(start + BATCH_SIZE, count)):
+            body = make_text(rng, 60)
+            # One message in ten thousand mentions somewhere rare
+            if number % 10000 == 0:
+                body += "Postcard from zanzibar.\n"
+            records.append(
+                {
+                    "message_id": f"{number:016x}",
+                    "correspondent": "stu@bmail.com",
+                    "date": f"20{10 + number % 15}-01-{number % 28 + 1:02d}",
+                    "sender": "Stu Bettler <stu@bmail.com>",
+                    "recipient": "Will Jakobson <will@jmail.com>",
+                    "subject": f"Re: {rng.choice(WORDS)} {rng.choice(WORDS)}",
+                    "attachments": [],
+                    "body": body,
+                }
+            )
+        catalog.add(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        catalog = Catalog(os.path.join(temp_dir, "catalog.sqlite3"))
+        start = time.perf_counter()
+        fill(catalog, args.messages, random.Random(0))
+        elapsed = time.perf_counter() - start
+        print(f"Indexed {args.messages} messages in {elapsed:.1f}s ({args.messages / elapsed:.0f}/sec)")
+
+        print(f"{'query':>12}  {'matches':>8}  {'p50 ms':>8}  {'max ms':>8}")
+        for name, query in QUERIES.items():
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = catalog.search(query)
+                times.append((time.perf_counter() - start) * 1000)
+            print(
+                f"{name:>12}  {result['total']:>8}  "
+                f"{statistics.median(times):>8.2f}  {max(times):>8.2f}"
+            )
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
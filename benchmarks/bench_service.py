@@ -0,0 +1,98 @@
+"""
+Benchmark the cost of setting up Gmail services for each fetch, cold and warm.
+
+    python benchmarks/bench_service.py --fetches 3 --messages 50 --workers 4
+
+Runs real fetches with fetch_emails, one after another, against the local Gmail
+stand-in (see gmail_server.py), each into fresh temporary directories.
+Cold drops the built services before every fetch, as fetch_emails used to build
+them all again each time. Warm fetches with the same credentials every time, so
+the second and later fetches can reuse the services the first one built.
+Reports how long each fetch took and how many services it built.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "app"))
+
+import emails  # noqa: E402
+from bench_clean_pool import quiet  # noqa: E402
+from bench_fetch import local_builder  # noqa: E402
+from gmail_server import generate_mailbox, start_server  # noqa: E402
+
+
+def fetch(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = SimpleNamespace(
+            RAW_EMAIL_DIR=os.path.join(temp_dir, "raw"),
+            CLEAN_EMAIL_DIR=os.path.join(temp_dir, "clean"),
+            ATTACHMENTS_DIR=os.path.join(temp_dir, "attachments"),
+        )
+        for path in vars(config).values():
+            os.makedirs(path)
+        start = time.perf_counter()
+        with quiet():
+            result = emails.fetch_emails("stu@bmail.com", config, workers=args.workers)
+        if "error" in result:
+            sys.exit(result["error"])
+        return time.perf_counter() - start
+
+
+def run(url, args, cold):
+    """
+    Return the seconds each fetch took and how many services it built.
+    """
+    build = local_builder(url)
+    builds = []
+
+    def build_service(creds):
+        builds.append(creds)
+        return build(creds)
+
+    creds = object()
+    saved = (emails.get_credentials, emails.build_service)
+    emails.get_credentials = lambda: creds
+    emails.build_service = build_service
+    emails._services.update(creds=None, idle=[])
+    rows = []
+    try:
+        for _ in range(args.fetches):
+            if cold:
+                emails._services.update(creds=None, idle=[])
+            built = len(builds)
+            seconds = fetch(args)
+            rows.append((seconds, len(builds) - built))
+    finally:
+        emails.get_credentials, emails.build_service = saved
+        emails._services.update(creds=None, idle=[])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--fetches", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    mailbox = generate_mailbox("plain", args.messages, latency=args.latency_ms / 1000)
+    server, url = start_server(mailbox)
+    try:
+        print(f"{args.fetches} fetches of {args.messages} messages, {args.workers} workers")
+        print(f"{'setup':>5}  {'fetch':>5}  {'ms':>8}  {'built':>5}")
+        for name, cold in (("cold", True), ("warm", False)):
+            for number, (seconds, built) in enumerate(run(url, args, cold), 1):
+                print(f"{name:>5}  {number:>5}  {seconds * 1000:>8.1f}  {built:>5}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
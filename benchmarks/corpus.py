@@ -0,0 +1,146 @@
+"""
+Deterministic generator of synthetic raw emails for the benchmarks.
+
+Messages can vary in body size, charset, HTML alternatives or HTML-only bodies,
+how deeply the body is nested in multipart containers, and their attachments.
+PROFILES names corpora that each stress one of these, plus a mix of them all.
+"""
+
+import html
+import random
+from email.message import EmailMessage
+
+WORDS = (
+    "draft revision poem teacher barn pumping station odds credulous rapt grade "
+    "advice plans later chuckle writing alone beautiful stunning new year"
+).split()
+# Words each charset can encode, so bodies aren't plain ASCII
+CHARSET_WORDS = {
+    "us-ascii": WORDS,
+    "utf-8": WORDS + "café naïve über страница 詩 改訂 смех".split(),
+    "iso-8859-1": WORDS + "café naïve über garçon señor façade".split(),
+    "koi8-r": WORDS + "страница черновик смех учитель".split(),
+    "shift_jis": WORDS + "詩 改訂 先生 納屋".split(),
+}
+CHARSETS = tuple(CHARSET_WORDS)
+
+
+def make_text(rng, words, vocabulary=WORDS):
+    lines = []
+    for start in range(0, words, 12):
+        lines.append(" ".join(rng.choice(vocabulary) for _ in range(min(12, words - start))))
+    return "\n".join(lines) + "\n"
+
+
+def make_html(text):
+    paragraphs = "".join(f"<p>{html.escape(line)}</p>\n" for line in text.splitlines())
+    return f"<html><body>\n{paragraphs}</body></html>\n"
+
+
+def make_email(
+    number,
+    rng,
+    body_words=200,
+    attachments=0,
+    attachment_size=0,
+    charset="utf-8",
+    html_body=False,
+    html_only=False,
+    depth=0,
+):
+    """
+    Build the raw bytes of one synthetic email.
+    html_body adds an HTML alternative to the text, and html_only sends only HTML.
+    depth wraps the body in that many more levels of multipart/mixed.
+    """
+    text = make_text(rng, body_words, CHARSET_WORDS[charset])
+    body = EmailMessage()
+    if html_only:
+        body.set_content(make_html(text), subtype="html", charset=charset)
+    else:
+        body.set_content(text, charset=charset)
+        if html_body:
+            body.add_alternative(make_html(text), subtype="html", charset=charset)
+    for _ in range(depth):
+        wrapper = EmailMessage()
+        wrapper.make_mixed()
+        wrapper.attach(body)
+        body = wrapper
+
+    msg = body
+    msg["Date"] = f"Mon, {number % 28 + 1:02d} Jan 2024 10:{number % 60:02d}:00 +0000"
+    msg["Subject"] = f"Re: {rng.choice(WORDS)} {rng.choice(WORDS)} {number}"
+    msg["To"] = "Will Jakobson <will@jmail.com>"
+    msg["From"] = "Stu Bettler <stu@bmail.com>"
+    for i in range(attachments):
+        msg.add_attachment(
+            rng.randbytes(attachment_size),
+            maintype="application",
+            subtype="pdf",
+            filename=f"attachment_{number}_{i}.pdf",
+        )
+    # Boundaries are random unless set, and the corpus has to be the same every time
+    for index, part in enumerate(msg.walk()):
+        if part.is_multipart():
+            part.set_boundary(f"==gfetch-{number}-{index}==")
+    return bytes(msg)
+
+
+def generate_corpus(count, seed=0, **options):
+    """
+    Return a list of (message_id, raw email) pairs; the same arguments always give the same corpus.
+    """
+    rng = random.Random(seed)
+    return [(f"{number:016x}", make_email(number, rng, **options)) for number in range(count)]
+
+
+def mixed_options(number, rng):
+    """
+    Draw the options of one message of a mixed mailbox: mostly short text, some
+    long, HTML, deeply nested or foreign messages, and a few big attachments.
+    """
+    attachments = rng.choice([0, 0, 0, 0, 1, 1, 2, 5])
+    return {
+        "body_words": rng.choice([20, 100, 200, 200, 1000, 5000]),
+        "charset": rng.choice(CHARSETS),
+        "html_body": rng.random() < 0.5,
+        "html_only": rng.random() < 0.15,
+        "depth": rng.choice([0, 0, 0, 1, 2, 4]),
+        "attachments": attachments,
+        "attachment_size": rng.choice([1024, 64 * 1024, 64 * 1024, 1024 * 1024]),
+    }
+
+
+# Options for each message of a profile, given its number and the generator's random source
+PROFILES = {
+    "plain": lambda number, rng: {},
+    "long": lambda number, rng: {"body_words": 20000},
+    "charsets": lambda number, rng: {"charset": CHARSETS[number % len(CHARSETS)]},
+    "html": lambda number, rng: {"html_body": True},
+    "html_only": lambda number, rng: {"html_only": True},
+    "nested": lambda number, rng: {"html_body": True, "depth": 8},
+    "attachments": lambda number, rng: {"attachments": 4, "attachment_size": 64 * 1024},
+    "large_attachment": lambda number, rng: {
+        "attachments": 1,
+        "attachment_size": 8 * 1024 * 1024,
+    },
+    "mixed": mixed_options,
+}
+
+
+def generate_profile(profile, count, seed=0, max_bytes=None):
+    """
+    Return a corpus of one of the PROFILES, as (message_id, raw email) pairs.
+    If max_bytes is given, the corpus stops growing once it is that big.
+    """
+    rng = random.Random(seed)
+    options = PROFILES[profile]
+    corpus = []
+    size = 0
+    for number in range(count):
+        raw_email = make_email(number, rng, **options(number, rng))
+        corpus.append((f"{number:016x}", raw_email))
+        size += len(raw_email)
+        if max_bytes and size >= max_bytes:
+            break
+    return corpus
@@ -0,0 +1,167 @@
+"""
+A local HTTP stand-in for the Gmail API, serving a generated mailbox.
+
+    python benchmarks/gmail_server.py --messages 1000 --latency-ms 30 --error-rate 0.01
+
+It answers messages.list (with paging), messages.get (raw), batch requests,
+history.list and getProfile, using the FakeMailbox the tests use, over real HTTP.
+Latency, throttling and errors can be injected, per API call, so calls inside a
+batch are slowed, throttled and failed one by one like Gmail's.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tests"))
+
+from corpus import PROFILES, generate_profile  # noqa: E402
+from fake_gmail import FakeMailbox  # noqa: E402
+
+
+class ServedMailbox(FakeMailbox):
+    """
+    A FakeMailbox that slows down, throttles and fails calls on request.
+    latency (plus up to jitter more) is spent on each call, rate_limit caps calls
+    per second (0 for no cap) and error_rate is the share of calls that fail.
+    """
+
+    def __init__(
+        self,
+        messages,
+        page_size=100,
+        latency=0.0,
+        jitter=0.0,
+        rate_limit=0,
+        error_rate=0.0,
+        seed=0,
+    ):
+        super().__init__(messages, page_size)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_calls = 0
+        self.counts = {"calls": 0, "throttled": 0, "errors": 0}
+
+    def handle(self, method, uri, body=None, headers=None):
+        if uri.startswith("/batch"):
+            # Each call inside the batch comes back through handle
+            return super().handle(method, uri, body, headers)
+
+        with self.lock:
+            self.counts["calls"] += 1
+            delay = self.latency + self.rng.random() * self.jitter
+            failed = self.rng.random() < self.error_rate
+            throttled = self.over_rate_limit()
+            if throttled:
+                self.counts["throttled"] += 1
+            elif failed:
+                self.counts["errors"] += 1
+        time.sleep(delay)
+
+        if throttled:
+            status, response_headers, content = self.error(
+                429, "Rate Limit Exceeded", reason="rateLimitExceeded"
+            )
+            response_headers["retry-after"] = "1"
+            return status, response_headers, content
+        if failed:
+            return self.error(503, "Backend Error", reason="backendError")
+        return super().handle(method, uri, body, headers)
+
+    def over_rate_limit(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            self.window_start = now
+            self.window_calls = 0
+        self.window_calls += 1
+        return self.window_calls > self.rate_limit
+
+
+class GmailHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, as the Google client expects
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which Nagle's algorithm would hold up
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.answer("GET")
+
+    def do_POST(self):
+        self.answer("POST")
+
+    def answer(self, method):
+        length = int(self.headers.get("content-length", 0))
+        body = self.rfile.read(length).decode() if length else None
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        status, response_headers, content = self.server.mailbox.handle(
+            method, self.path, body, headers
+        )
+        self.send_response(status)
+        for key, value in response_headers.items():
+            self.send_header(key, value)
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(mailbox, host="127.0.0.1", port=0):
+    """
+    Serve a mailbox from a background thread. Return the server and its URL.
+    """
+    server = ThreadingHTTPServer((host, port), GmailHandler)
+    server.daemon_threads = True
+    server.mailbox = mailbox
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+
+def generate_mailbox(profile, messages, **options):
+    return ServedMailbox(generate_profile(profile, messages), **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--profile", choices=PROFILES, default="plain")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-limit", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--port", type=int, default=8025)
+    args = parser.parse_args()
+
+    mailbox = generate_mailbox(
+        args.profile,
+        args.messages,
+        page_size=args.page_size,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+    )
+    server, url = start_server(mailbox, port=args.port)
+    print(f"Serving {args.messages} {args.profile} messages at {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Saving benchmark results as JSON and comparing them with an earlier run.
+
+Each file records the benchmark, its parameters, the machine and commit it ran
+on, and a list of result rows, so runs can be compared to spot regressions.
+"""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+def save_results(benchmark, params, rows, path=None):
+    """
+    Write a run's results to path, by default benchmarks/results/<benchmark>-<time>.json.
+    Return the path.
+    """
+    created = datetime.datetime.now(datetime.timezone.utc)
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{benchmark}-{created:%Y%m%d-%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "created": created.isoformat(timespec="seconds"),
+                "environment": environment(),
+                "params": params,
+                "results": rows,
+            },
+            f,
+            indent=2,
+        )
+    return path
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def print_comparison(rows, baseline, keys, metrics):
+    """
+    Print how each metric of each row changed since a baseline run, matching rows
+    by their keys. Ratios above 1 mean the metric went up.
+    """
+    earlier = {tuple(row[key] for key in keys): row for row in baseline["results"]}
+    print(f"\nCompared with {baseline['created']} ({baseline['environment']['commit']}):")
+    for row in rows:
+        match = earlier.get(tuple(row[key] for key in keys))
+        if not match:
+            continue
+        changes = "  ".join(
+            f"{metric} {row[metric] / match[metric]:.2f}x"
+            for metric in metrics
+            if match.get(metric)
+        )
+        print(f"  {' / '.join(str(row[key]) for key in keys)}: {changes}")
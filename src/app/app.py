@@ -18,28 +18,67 @@
 
 import os
 
+from auth import share_credentials
+from catalog import get_catalog
 from dotenv import load_dotenv
-from emails import fetch_emails
-from flask import Flask, flash, redirect, render_template, request, url_for
+from emails import CLEAN_SETTINGS, FETCH_SETTINGS, parse_addresses
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask_session import Session
-
-load_dotenv()
-
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY")
+from jobs import (
+    cancel_job,
+    enqueue_delete,
+    enqueue_fetch,
+    get_job,
+    start_workers,
+    stream_job_events,
+)
+from metrics import CONTENT_TYPE, render_metrics
+from profiling import profile_path, summary_path
+
+# The app's pages, registered on each app create_app makes
+routes = Blueprint("gfetch", __name__)
+# Settings the jobs are given along with the directories, read from GFETCH_<name>
+JOB_SETTINGS = (*FETCH_SETTINGS, *CLEAN_SETTINGS, "DELETE_BATCH_SIZE", "PROFILES_DIR")
+# Those of them that are numbers
+INT_SETTINGS = (
+    "BATCH_SIZE",
+    "WORKERS",
+    "CLEANERS",
+    "WRITERS",
+    "CLEAN_PROCESSES",
+    "QUEUE_SIZE",
+    "RETRIES",
+    "DELETE_BATCH_SIZE",
+)
 
 
 class DirConfig:
     """
-    Store dir configuration in a class to allow easy access by emails.py
+    The directories emails are saved to, passed to emails.py and the jobs,
+    with the fetch, delete and profiling settings they are run with.
+    Settings that are None keep the defaults in emails.py, deletion.py and profiling.py.
     """
 
-    RAW_EMAIL_DIR = os.getenv("RAW_EMAIL_DIR")
-    CLEAN_EMAIL_DIR = os.getenv("CLEAN_EMAIL_DIR")
-    ATTACHMENTS_DIR = os.getenv("ATTACHMENTS_DIR")
-
-
-app.dir_config = DirConfig()
+    def __init__(self, raw_email_dir, clean_email_dir, attachments_dir, **settings):
+        self.RAW_EMAIL_DIR = raw_email_dir
+        self.CLEAN_EMAIL_DIR = clean_email_dir
+        self.ATTACHMENTS_DIR = attachments_dir
+        for name in JOB_SETTINGS:
+            setattr(self, name, settings.get(name))
 
 
 def create_dirs(config):
@@ -51,83 +90,229 @@ def create_dirs(config):
         os.makedirs(config.ATTACHMENTS_DIR)
 
 
-# Redis configuration
-app.config["SESSION_TYPE"] = os.getenv("SESSION_TYPE")
-app.config["SESSION_PERMANENT"] = os.getenv("SESSION_PERMANENT")
-# app.config["SESSION_USE_SIGNER"] = os.getenv("SESSION_USE_SIGNER")
-app.config["SESSION_KEY_PREFIX"] = os.getenv("SESSION_KEY_PREFIX")
-app.config["SESSION_REDIS"] = os.getenv("SESSION_REDIS")
-
-# Start redis
-Session(app)
+def load_config():
+    """
+    Read the app's settings from the environment, after loading any .env file into it.
+    """
+    load_dotenv()
+    return {
+        "SECRET_KEY": os.getenv("SECRET_KEY"),
+        "RAW_EMAIL_DIR": os.getenv("RAW_EMAIL_DIR"),
+        "CLEAN_EMAIL_DIR": os.getenv("CLEAN_EMAIL_DIR"),
+        "ATTACHMENTS_DIR": os.getenv("ATTACHMENTS_DIR"),
+        # Redis configuration
+        "SESSION_TYPE": os.getenv("SESSION_TYPE"),
+        "SESSION_PERMANENT": os.getenv("SESSION_PERMANENT"),
+        # "SESSION_USE_SIGNER": os.getenv("SESSION_USE_SIGNER"),
+        "SESSION_KEY_PREFIX": os.getenv("SESSION_KEY_PREFIX"),
+        "SESSION_REDIS": os.getenv("SESSION_REDIS"),
+        # Worker threads started in this process; set to 0 when running jobs.py separately
+        "JOB_WORKERS": int(os.getenv("GFETCH_JOB_WORKERS", 1)),
+        # Port a worker started with python src/app/jobs.py serves its metrics on; 0 for none
+        "METRICS_PORT": int(os.getenv("GFETCH_METRICS_PORT") or 0),
+        # Let several app or worker processes share one OAuth token instead of each refreshing it
+        "SHARE_CREDENTIALS": os.getenv("GFETCH_SHARE_CREDENTIALS") == "True",
+        # Read here rather than when the modules using them are imported, so a
+        # .env file is loaded first; unset or empty settings are None
+        **{name: getenv_setting(name) for name in JOB_SETTINGS},
+    }
+
+
+def getenv_setting(name):
+    value = os.getenv(f"GFETCH_{name}") or None
+    if value is not None and name in INT_SETTINGS:
+        return int(value)
+    return value
+
+
+def create_app(config=None):
+    """
+    Create the app, configured from the environment, with any settings in the
+    config dict taking precedence, and make the directories emails are saved to.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping({**load_config(), **(config or {})})
+    app.dir_config = DirConfig(
+        app.config["RAW_EMAIL_DIR"],
+        app.config["CLEAN_EMAIL_DIR"],
+        app.config["ATTACHMENTS_DIR"],
+        **{name: app.config.get(name) for name in JOB_SETTINGS},
+    )
 
+    # Start redis
+    Session(app)
 
-create_dirs(app.dir_config)
+    # Background fetch jobs are queued in the same redis instance as the sessions
+    app.redis = app.session_interface.client
+    if app.config["SHARE_CREDENTIALS"]:
+        share_credentials(app.redis)
 
+    create_dirs(app.dir_config)
+    app.register_blueprint(routes)
+    return app
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    if request.method == "POST":
-        email_address = request.form["email_address"]
 
-        result = fetch_emails(email_address, app.dir_config)
+def __getattr__(name):
+    """
+    Create the app the flask command, python src/app/jobs.py and the tests use
+    the first time it is asked for, so importing this module doesn't.
+    """
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-        if "error" in result:
-            flash(result["error"])
-            return redirect(url_for("index"))
 
-        flash(f"Saved and cleaned {result['total_messages']} messages.")
-        flash(f"Saved {result['total_attachments']} attachments.")
+@routes.route("/", methods=["GET", "POST"])
+def index():
+    if request.method == "POST":
+        email_addresses = parse_addresses(request.form["email_address"])
+        # A file of addresses, one per line or separated by commas, adds to those typed in
+        addresses_file = request.files.get("addresses_file")
+        if addresses_file:
+            email_addresses = list(
+                dict.fromkeys(
+                    email_addresses
+                    + parse_addresses(addresses_file.read().decode("utf-8", "replace"))
+                )
+            )
+        if not email_addresses:
+            flash("Enter an email address or choose a file of them.")
+            return redirect(url_for(".index"))
+        incremental = "incremental" in request.form
+        resume = "resume" in request.form
+        # Asked for with a profile form field or an X-Gfetch-Profile: 1 header
+        profile = "profile" in request.form or request.headers.get("X-Gfetch-Profile") == "1"
+
+        job_id = enqueue_fetch(
+            current_app.redis, email_addresses, incremental=incremental, resume=resume, profile=profile
+        )
+        start_workers(current_app.redis, current_app.dir_config, current_app.config["JOB_WORKERS"])
+
+        if request.accept_mimetypes.best_match(["text/html", "application/json"]) == (
+            "application/json"
+        ):
+            return jsonify({"job_id": job_id}), 202
+
+        flash(f"Started fetching emails for {', '.join(email_addresses)}.")
+        return redirect(url_for(".index", job=job_id))
+
+    return render_template("index.html", job_id=request.args.get("job"))
+
+
+@routes.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(current_app.redis, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@routes.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    if get_job(current_app.redis, job_id) is None:
+        abort(404)
+    return Response(
+        stream_with_context(stream_job_events(current_app.redis, job_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@routes.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel(job_id):
+    if not cancel_job(current_app.redis, job_id):
+        abort(404)
+    return jsonify(get_job(current_app.redis, job_id))
+
+
+@routes.route("/jobs/<job_id>/profile")
+def job_profile(job_id):
+    """
+    Download the profile of a job run with profiling, in pstats format, or
+    with ?format=text, a summary of the functions that took longest.
+    """
+    job = get_job(current_app.redis, job_id)
+    if job is None or not job["profile"]:
+        abort(404)
+    path = os.path.abspath(profile_path(current_app.dir_config, job_id))
+    text = request.args.get("format") == "text"
+    if text:
+        path = summary_path(path)
+    # A job still running, or run while another was being profiled, has none
+    if not os.path.exists(path):
+        abort(404)
+    if text:
+        return send_file(path, mimetype="text/plain")
+    return send_file(path, as_attachment=True, download_name=f"{job_id}.prof")
+
+
+@routes.route("/metrics")
+def metrics():
+    """
+    Show how long each step of fetching has taken, for Prometheus to scrape.
+    """
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
 
-        return redirect(url_for("index"))
 
-    return render_template("index.html")
+@routes.route("/messages")
+def messages():
+    """
+    Browse saved messages a page at a time, from the catalog rather than the filesystem.
+    """
+    try:
+        return jsonify(
+            get_catalog(current_app.dir_config).browse(
+                page=request.args.get("page", 1, type=int),
+                per_page=request.args.get("per_page", 50, type=int),
+                sort=request.args.get("sort", "date"),
+                order=request.args.get("order", "desc"),
+                correspondent=request.args.get("correspondent"),
+                date_from=request.args.get("from"),
+                date_to=request.args.get("to"),
+            )
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@routes.route("/search")
+def search():
+    """
+    Search saved messages' subjects, participants and bodies, best matches first.
+    """
+    return jsonify(
+        get_catalog(current_app.dir_config).search(
+            request.args.get("q", ""),
+            page=request.args.get("page", 1, type=int),
+            per_page=request.args.get("per_page", 20, type=int),
+        )
+    )
 
 
-@app.route("/delete/", methods=["POST"])
+@routes.route("/delete/", methods=["POST"])
 def delete_files():
-    attachments_dir = app.dir_config.ATTACHMENTS_DIR
-    clean_dir = app.dir_config.CLEAN_EMAIL_DIR
-    raw_dir = app.dir_config.RAW_EMAIL_DIR
-
-    attachments = os.listdir(attachments_dir)
-    clean_emails = [email for email in os.listdir(clean_dir) if email.endswith(".txt")]
-    raw_emails = [email for email in os.listdir(raw_dir) if email.endswith(".eml")]
-    deleted_emails = 0
-    deleted_attachments = 0
-
-    if not attachments:
-        flash("No attachments found.")
-    else:
-        for attachment in attachments:
-            attachment_path = os.path.join(attachments_dir, attachment)
-            os.remove(attachment_path)
-            deleted_attachments += 1
-
-    if not clean_emails:
-        flash("No cleaned emails found.")
-    else:
-        for email in clean_emails:
-            clean_path = os.path.join(clean_dir, email)
-            os.remove(clean_path)
-            deleted_emails += 1
-
-    if not raw_emails:
-        flash("No raw emails found.")
+    """
+    Start a background job deleting every downloaded file, or, given a
+    correspondent, a date range or message ids, just those messages.
+    """
+    correspondent = request.form.get("correspondent") or None
+    date_from = request.form.get("from") or None
+    date_to = request.form.get("to") or None
+    message_ids = request.form.get("message_ids", "").replace(",", " ").split() or None
+    job_id = enqueue_delete(current_app.redis, correspondent, date_from, date_to, message_ids)
+    start_workers(current_app.redis, current_app.dir_config, current_app.config["JOB_WORKERS"])
+    if request.accept_mimetypes.best_match(["text/html", "application/json"]) == (
+        "application/json"
+    ):
+        return jsonify({"job_id": job_id}), 202
+    if correspondent or date_from or date_to or message_ids:
+        flash("Started deleting the selected messages.")
     else:
-        for email in raw_emails:
-            raw_path = os.path.join(raw_dir, email)
-            os.remove(raw_path)
-
-    if deleted_emails and deleted_attachments:
-        flash(f"Deleted {deleted_emails} emails and {deleted_attachments} attachments.")
-    elif deleted_emails:
-        flash(f"Deleted {deleted_emails} emails.")
-    elif deleted_attachments:
-        flash(f"Deleted {deleted_attachments} attachments.")
-
-    return redirect(url_for("index"))
+        flash("Started deleting every saved file.")
+    return redirect(url_for(".index", job=job_id))
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    create_app().run(debug=True, port=5000)
@@ -1,39 +1,173 @@
+import json
 import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+# The Google auth libraries are imported where credentials are first loaded,
+# since they take longer to import than the rest of the app
 
 SCOPES = os.getenv("SCOPES")
 CREDS = os.getenv("CREDS")
 TOKEN = os.getenv("TOKEN")
 
+# Refresh a token this long before it expires, so no request goes out with a stale one
+REFRESH_MARGIN = timedelta(minutes=5)
+SHARED_TOKEN_KEY = "gfetch:token"
+SHARED_LOCK_KEY = "gfetch:token:lock"
+SHARED_LOCK_TIMEOUT = 60
+
+_cached_creds = None
+_shared_redis = None
+_lock = threading.Lock()
+
+
+def share_credentials(redis):
+    """
+    Share credentials with other processes, such as other gunicorn workers, through redis.
+    """
+    global _shared_redis
+    _shared_redis = redis
+
+
+def clear_cached_credentials():
+    """
+    Forget the credentials held in memory, so the next call loads them again.
+    """
+    global _cached_creds
+    _cached_creds = None
+
 
 def get_credentials():
-    creds = None
-    if os.path.exists(TOKEN):
+    """
+    Return valid credentials, from memory if possible.
+    Only one thread, and with shared credentials only one process, refreshes them at a time.
+    """
+    global _cached_creds
+    creds = _cached_creds
+    if is_fresh(creds):
+        return creds
+
+    with _lock:
+        # Another thread may have refreshed them while this one waited
+        if is_fresh(_cached_creds):
+            return _cached_creds
+
+        if _shared_redis is None:
+            creds = load_credentials()
+        else:
+            creds = load_shared_credentials()
+
+        _cached_creds = creds if is_fresh(creds) else None
+        return creds
+
+
+def is_fresh(creds):
+    """
+    Check that credentials are valid and won't expire within REFRESH_MARGIN.
+    """
+    if not creds or not creds.valid:
+        return False
+    if not creds.expiry:
+        return True
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - REFRESH_MARGIN > now
+
+
+def load_shared_credentials():
+    """
+    Take credentials from redis, or load or refresh them while holding a redis lock.
+    """
+    creds = read_shared_credentials()
+    if is_fresh(creds):
+        return creds
+
+    with shared_lock():
+        # Another process may have refreshed them while this one waited
+        creds = read_shared_credentials()
+        if is_fresh(creds):
+            return creds
+
+        creds = load_credentials(creds)
+        if creds and creds.valid:
+            _shared_redis.set(SHARED_TOKEN_KEY, creds.to_json())
+        return creds
+
+
+@contextmanager
+def shared_lock():
+    """
+    Hold a redis lock across processes. It expires on its own if its holder dies.
+    """
+    owner = uuid.uuid4().hex
+    while not _shared_redis.set(SHARED_LOCK_KEY, owner, nx=True, ex=SHARED_LOCK_TIMEOUT):
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        if _shared_redis.get(SHARED_LOCK_KEY) == owner.encode():
+            _shared_redis.delete(SHARED_LOCK_KEY)
+
+
+def read_shared_credentials():
+    from google.oauth2.credentials import Credentials
+
+    token_json = _shared_redis.get(SHARED_TOKEN_KEY)
+    if not token_json:
+        return None
+    try:
+        return Credentials.from_authorized_user_info(json.loads(token_json), SCOPES)
+    except Exception as e:
+        print(f"Error loading shared credentials: {e}")
+        return None
+
+
+def load_credentials(creds=None):
+    """
+    Load credentials from the token file, refreshing them or running the OAuth flow as needed.
+    """
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    if not creds and os.path.exists(TOKEN):
         try:
             creds = Credentials.from_authorized_user_file(TOKEN, SCOPES)
         except Exception as e:
             print(f"Error loading credentials: {e}")
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    if not is_fresh(creds):
+        if creds and creds.refresh_token:
             try:
                 creds.refresh(Request())
+                save_token(creds)
             except Exception as e:
                 print(f"Error refreshing credentials: {e}")
                 if os.path.exists(TOKEN):
                     os.remove(TOKEN)
                 creds = None
+        elif creds and not creds.valid:
+            creds = None
 
         if not creds:
             try:
                 flow = InstalledAppFlow.from_client_secrets_file(CREDS, SCOPES)
                 creds = flow.run_local_server(port=0)
-                with open(TOKEN, "w") as token:
-                    token.write(creds.to_json())
+                save_token(creds)
             except Exception as e:
                 print(f"Error during OAuth flow: {e}")
 
     return creds
+
+
+def save_token(creds):
+    """
+    Write the token file atomically, so a crash or another reader never sees half of it.
+    """
+    temp_token = f"{TOKEN}.tmp"
+    with open(temp_token, "w") as token:
+        token.write(creds.to_json())
+    os.replace(temp_token, TOKEN)
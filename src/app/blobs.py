@@ -0,0 +1,168 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+A content-addressed attachment store.
+
+Each distinct attachment is kept once, as blobs/<2 hex>/<2 hex>/<sha256>, and each
+message gets a map from its attachments' filenames to their blobs in messages/<id>.json.
+Links under <message id>/<filename> can give the blobs their original names.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+BLOBS_DIR = "blobs"
+MAPS_DIR = "messages"
+# Hash payloads in pieces of this many bytes
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(attachments_dir, digest):
+    """
+    Return the path of a blob, sharded two levels deep so no directory gets too big.
+    """
+    return os.path.join(attachments_dir, BLOBS_DIR, digest[:2], digest[2:4], digest)
+
+
+def hash_chunks(chunks):
+    sha256 = hashlib.sha256()
+    for chunk in chunks:
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]
+
+
+def store_blob(attachments_dir, data):
+    """
+    Store an attachment unless an identical one is already stored.
+    Return its SHA-256 digest and whether it was new.
+    data is either bytes or a function returning an iterable of pieces of the
+    attachment, which is called once to hash them and once more to write them.
+    """
+    read_chunks = data if callable(data) else lambda: iter_chunks(data)
+    # The hash is taken before anything is written, so a duplicate costs no writes
+    digest = hash_chunks(read_chunks())
+    path = blob_path(attachments_dir, digest)
+    if os.path.exists(path):
+        return digest, False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Another thread or process may be storing the same blob, so each writes its own temp file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        for chunk in read_chunks():
+            f.write(chunk)
+    os.replace(temp_path, path)
+    return digest, True
+
+
+def map_path(attachments_dir, message_id):
+    return os.path.join(attachments_dir, MAPS_DIR, f"{message_id}.json")
+
+
+def save_message_blobs(attachments_dir, message_id, blobs):
+    """
+    Atomically write a message's list of (filename, digest) pairs.
+    """
+    path = map_path(attachments_dir, message_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            [{"filename": filename, "sha256": digest} for filename, digest in blobs], f
+        )
+    os.replace(temp_path, path)
+
+
+def load_message_blobs(attachments_dir, message_id):
+    """
+    Return a message's list of (filename, digest) pairs, or an empty list.
+    """
+    try:
+        with open(map_path(attachments_dir, message_id), encoding="utf-8") as f:
+            return [(blob["filename"], blob["sha256"]) for blob in json.load(f)]
+    except FileNotFoundError:
+        return []
+
+
+def link_message_blobs(attachments_dir, message_id, blobs, mode):
+    """
+    Give a message's blobs their original filenames in <attachments_dir>/<message_id>/.
+    Return the paths of the links.
+    """
+    if mode == "none" or not blobs:
+        return []
+
+    link_dir = os.path.join(attachments_dir, message_id)
+    os.makedirs(link_dir, exist_ok=True)
+    links = []
+    used = set()
+    for filename, digest in blobs:
+        name = unique_name(safe_filename(filename), used)
+        link = os.path.join(link_dir, name)
+        target = blob_path(attachments_dir, digest)
+        if os.path.lexists(link):
+            os.remove(link)
+        try:
+            if mode == "hardlink":
+                os.link(target, link)
+            else:
+                os.symlink(os.path.relpath(target, link_dir), link)
+        except OSError as e:
+            # Hardlinks fail across filesystems; the blob itself is still stored
+            print(f"Error linking attachment {filename}: {e}")
+            continue
+        links.append(link)
+    return links
+
+
+def safe_filename(filename):
+    """
+    Keep an attachment's filename from reaching outside its directory.
+    """
+    name = os.path.basename(filename.replace("\\", "/")).strip()
+    return name if name not in ("", ".", "..") else "attachment"
+
+
+def unique_name(name, used):
+    """
+    Number repeated filenames within a message: name.pdf, name (2).pdf, ...
+    """
+    stem, ext = os.path.splitext(name)
+    candidate = name
+    number = 1
+    while candidate in used:
+        number += 1
+        candidate = f"{stem} ({number}){ext}"
+    used.add(candidate)
+    return candidate
+
+
+def count_blobs(attachments_dir):
+    count = 0
+    for _, _, files in os.walk(os.path.join(attachments_dir, BLOBS_DIR)):
+        count += sum(1 for name in files if not name.endswith(".tmp"))
+    return count
+
@@ -0,0 +1,546 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import threading
+from itertools import batched
+
+from blobs import MAPS_DIR, load_message_blobs
+
+CATALOG_FILENAME = "gfetch.sqlite3"
+# Columns the catalog can be sorted by, mapped to their SQL
+SORTS = {
+    "date": "date",
+    "subject": "subject COLLATE NOCASE",
+    "from": "sender COLLATE NOCASE",
+    "to": "recipient COLLATE NOCASE",
+    "size": "size",
+}
+MAX_PER_PAGE = 200
+# Message ids bound to one statement, well under SQLite's limit on variables
+MAX_VARIABLES = 500
+# Search ranking weights for subject, participants and body
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+# Words of body text around each match in a search snippet
+SNIPPET_WORDS = 16
+# Ranking scores every match, so a search matching more messages than this
+# ranks only the most recently indexed ones
+MAX_RANKED = 2000
+# Each message's correspondents, as a JSON list
+CORRESPONDENTS = (
+    "(SELECT json_group_array(correspondent) FROM correspondents "
+    "WHERE correspondents.message_id = messages.message_id) AS correspondents"
+)
+COLUMNS = (
+    "message_id",
+    "thread_id",
+    "correspondent",
+    "date",
+    "sender",
+    "recipient",
+    "subject",
+    "size",
+    "attachments",
+    "raw_file",
+    "clean_file",
+)
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+class Catalog:
+    """
+    An SQLite index of saved messages, so they can be counted and browsed
+    without listing the directories they are saved in.
+    """
+
+    def __init__(self, path, attachments_dir=None):
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id TEXT PRIMARY KEY, thread_id TEXT, correspondent TEXT, "
+            "date TEXT, sender TEXT, recipient TEXT, subject TEXT, size INTEGER, "
+            "attachments TEXT, raw_file TEXT, clean_file TEXT)"
+        )
+        for column in ("correspondent, date", "date", "thread_id"):
+            name = column.replace(", ", "_")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS messages_{name} ON messages ({column})")
+        self.create_correspondents()
+        self.create_blobs(attachments_dir)
+        self.create_search()
+        self.lock = threading.Lock()
+
+    def create_correspondents(self):
+        """
+        Create the table of every correspondent each message is attributed to.
+        The correspondent column of messages keeps the first of them.
+        """
+        if self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'correspondents'"
+        ).fetchone():
+            return
+        self.db.execute(
+            "CREATE TABLE correspondents (correspondent TEXT, message_id TEXT, "
+            "PRIMARY KEY (correspondent, message_id)) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX correspondents_message_id ON correspondents (message_id)"
+        )
+        # Catalogs from before messages could have several correspondents
+        self.db.execute(
+            "INSERT INTO correspondents SELECT correspondent, message_id FROM messages "
+            "WHERE correspondent IS NOT NULL"
+        )
+
+    def create_blobs(self, attachments_dir):
+        """
+        Create the table of the blobs each message uses, so a blob's last user
+        can be found without reading every message's blob map.
+        """
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'blobs'").fetchone():
+            return
+        self.db.execute(
+            "CREATE TABLE blobs (digest TEXT, message_id TEXT, "
+            "PRIMARY KEY (digest, message_id)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX blobs_message_id ON blobs (message_id)")
+        # Blobs stored before the catalog kept track of them are only in the maps
+        maps_dir = os.path.join(attachments_dir, MAPS_DIR) if attachments_dir else None
+        if not maps_dir or not os.path.isdir(maps_dir):
+            return
+        with os.scandir(maps_dir) as entries:
+            message_ids = [
+                entry.name.removesuffix(".json")
+                for entry in entries
+                if entry.name.endswith(".json")
+            ]
+        self.db.executemany(
+            "INSERT OR IGNORE INTO blobs VALUES (?, ?)",
+            [
+                (digest, message_id)
+                for message_id in message_ids
+                for _, digest in load_message_blobs(attachments_dir, message_id)
+            ],
+        )
+
+    def create_search(self):
+        """
+        Create the full-text index, an FTS5 table whose rows are tied to
+        messages by the stable rowids in search_ids.
+        """
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS search_ids ("
+            "rowid INTEGER PRIMARY KEY, message_id TEXT UNIQUE)"
+        )
+        if self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search'"
+        ).fetchone():
+            return
+        self.db.execute(
+            "CREATE VIRTUAL TABLE search USING fts5("
+            "subject, participants, body, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        # Set once, so every query can order by the built-in rank column
+        weights = ", ".join(str(weight) for weight in SEARCH_WEIGHTS)
+        self.db.execute(
+            "INSERT INTO search (search, rank) VALUES ('rank', ?)", (f"bm25({weights})",)
+        )
+
+    def add(self, records):
+        """
+        Add or update messages, all in one transaction.
+        Fields missing from a record keep the value already in the catalog, and
+        its correspondents are added to those the message already has.
+        Records with a body are also (re)indexed for search, and records with a
+        list of blob digests replace the blobs the message uses.
+        """
+        updates = ", ".join(
+            f"{column} = COALESCE(excluded.{column}, {column})" for column in COLUMNS[1:]
+        )
+        rows = [
+            tuple(
+                json.dumps(record["attachments"])
+                if column == "attachments"
+                else record.get(column)
+                for column in COLUMNS
+            )
+            for record in records
+        ]
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                f"INSERT INTO messages ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))}) "
+                f"ON CONFLICT (message_id) DO UPDATE SET {updates}",
+                rows,
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO correspondents VALUES (?, ?)",
+                [
+                    (correspondent, record["message_id"])
+                    for record in records
+                    for correspondent in record.get("correspondents")
+                    or filter(None, [record.get("correspondent")])
+                ],
+            )
+            with_blobs = [record for record in records if record.get("blobs") is not None]
+            self.db.executemany(
+                "DELETE FROM blobs WHERE message_id = ?",
+                [(record["message_id"],) for record in with_blobs],
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO blobs VALUES (?, ?)",
+                [
+                    (digest, record["message_id"])
+                    for record in with_blobs
+                    for digest in record["blobs"]
+                ],
+            )
+            searchable = [record for record in records if record.get("body") is not None]
+            if searchable:
+                self.index_bodies(searchable)
+
+    def index_bodies(self, records):
+        ids = [(record["message_id"],) for record in records]
+        self.db.executemany("INSERT OR IGNORE INTO search_ids (message_id) VALUES (?)", ids)
+        rowids = dict(
+            self.db.execute(
+                "SELECT message_id, rowid FROM search_ids WHERE message_id IN "
+                f"({', '.join('?' * len(ids))})",
+                [message_id for message_id, in ids],
+            ).fetchall()
+        )
+        self.db.executemany(
+            "DELETE FROM search WHERE rowid = ?",
+            [(rowids[message_id],) for message_id, in ids],
+        )
+        # Participants are taken from the catalog, which may know more than the record
+        self.db.executemany(
+            "INSERT INTO search (rowid, subject, participants, body) "
+            "SELECT ?, subject, "
+            "coalesce((SELECT group_concat(correspondent, ' ') FROM correspondents "
+            "WHERE correspondents.message_id = messages.message_id), '') || ' ' || "
+            "coalesce(sender, '') || ' ' || "
+            "coalesce(recipient, ''), ? FROM messages WHERE message_id = ?",
+            [
+                (rowids[record["message_id"]], record["body"], record["message_id"])
+                for record in records
+            ],
+        )
+
+    def search(self, query, page=1, per_page=20):
+        """
+        Return one page of the messages matching a search, best matches first,
+        each with a snippet of its body around the matches.
+        The total counts every match, but only the MAX_RANKED most recently
+        indexed ones are ranked and paged through; ranked says how many that is.
+        """
+        match = match_expression(query)
+        page = max(int(page), 1)
+        per_page = min(max(int(per_page), 1), MAX_PER_PAGE)
+        if not match:
+            return {
+                "messages": [],
+                "page": page,
+                "per_page": per_page,
+                "total": 0,
+                "ranked": 0,
+                "pages": 0,
+            }
+
+        with self.lock:
+            total = self.db.execute(
+                "SELECT COUNT(*) FROM search WHERE search MATCH ?", (match,)
+            ).fetchone()[0]
+            # Walking matches by rowid is cheap, and FTS5 can skip rowids below a bound
+            lowest = self.db.execute(
+                "SELECT rowid FROM search WHERE search MATCH ? "
+                "ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                (match, MAX_RANKED - 1),
+            ).fetchone()
+            rows = self.db.execute(
+                f"SELECT messages.*, {CORRESPONDENTS}, "
+                "snippet(search, 2, '[', ']', '...', ?) AS snippet "
+                "FROM search "
+                "JOIN search_ids ON search_ids.rowid = search.rowid "
+                "JOIN messages ON messages.message_id = search_ids.message_id "
+                "WHERE search MATCH ? AND search.rowid >= ? "
+                "ORDER BY rank LIMIT ? OFFSET ?",
+                (
+                    SNIPPET_WORDS,
+                    match,
+                    lowest[0] if lowest else 0,
+                    per_page,
+                    (page - 1) * per_page,
+                ),
+            ).fetchall()
+
+        return {
+            "messages": [message_from_row(row) for row in rows],
+            "page": page,
+            "per_page": per_page,
+            "total": total,
+            "ranked": min(total, MAX_RANKED),
+            "pages": (min(total, MAX_RANKED) + per_page - 1) // per_page,
+        }
+
+    def browse(
+        self,
+        page=1,
+        per_page=50,
+        sort="date",
+        order="desc",
+        correspondent=None,
+        date_from=None,
+        date_to=None,
+    ):
+        """
+        Return one page of messages, sorted and filtered, with the total count.
+        Dates are YYYY-MM-DD strings and both ends of the range are included.
+        """
+        if sort not in SORTS:
+            raise ValueError(f"Can't sort by {sort}.")
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Unknown order {order}.")
+        page = max(int(page), 1)
+        per_page = min(max(int(per_page), 1), MAX_PER_PAGE)
+
+        conditions = []
+        params = []
+        if correspondent:
+            conditions.append(
+                "message_id IN (SELECT message_id FROM correspondents WHERE correspondent = ?)"
+            )
+            params.append(correspondent.lower())
+        if date_from:
+            conditions.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("date <= ?")
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            total = self.db.execute(
+                f"SELECT COUNT(*) FROM messages {where}", params
+            ).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT *, {CORRESPONDENTS} FROM messages {where} "
+                f"ORDER BY {SORTS[sort]} {order}, message_id {order} LIMIT ? OFFSET ?",
+                (*params, per_page, (page - 1) * per_page),
+            ).fetchall()
+
+        return {
+            "messages": [message_from_row(row) for row in rows],
+            "page": page,
+            "per_page": per_page,
+            "total": total,
+            "pages": (total + per_page - 1) // per_page,
+        }
+
+    def find(self, correspondent=None, date_from=None, date_to=None, message_ids=None):
+        """
+        Return the messages matching all of the given filters, with where their
+        files are, e.g. to delete them. Message ids not in the catalog are left out.
+        """
+        conditions = []
+        params = []
+        if correspondent:
+            conditions.append(
+                "message_id IN (SELECT message_id FROM correspondents WHERE correspondent = ?)"
+            )
+            params.append(correspondent.lower())
+        if date_from:
+            conditions.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("date <= ?")
+            params.append(date_to)
+        where = " AND ".join(conditions) or "1"
+        query = (
+            "SELECT message_id, correspondent, raw_file, clean_file, attachments, "
+            f"{CORRESPONDENTS} FROM messages WHERE {where}"
+        )
+
+        with self.lock:
+            if message_ids is None:
+                rows = self.db.execute(query, params).fetchall()
+            else:
+                rows = []
+                for batch in batched(list(message_ids), MAX_VARIABLES):
+                    rows += self.db.execute(
+                        f"{query} AND message_id IN ({', '.join('?' * len(batch))})",
+                        (*params, *batch),
+                    ).fetchall()
+        return [
+            {
+                **dict(row),
+                "attachments": json.loads(row["attachments"] or "[]"),
+                "correspondents": json.loads(row["correspondents"]),
+            }
+            for row in rows
+        ]
+
+    def delete(self, message_ids):
+        """
+        Remove messages from the catalog, the search index and the blobs they use,
+        all in one transaction.
+        """
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for batch in batched(list(message_ids), MAX_VARIABLES):
+                marks = ", ".join("?" * len(batch))
+                self.db.execute(
+                    "DELETE FROM search WHERE rowid IN "
+                    f"(SELECT rowid FROM search_ids WHERE message_id IN ({marks}))",
+                    batch,
+                )
+                self.db.execute(f"DELETE FROM search_ids WHERE message_id IN ({marks})", batch)
+                self.db.execute(
+                    f"DELETE FROM correspondents WHERE message_id IN ({marks})", batch
+                )
+                self.db.execute(f"DELETE FROM blobs WHERE message_id IN ({marks})", batch)
+                self.db.execute(f"DELETE FROM messages WHERE message_id IN ({marks})", batch)
+
+    def detach(self, message_ids, correspondent):
+        """
+        Stop attributing messages to a correspondent, without removing them.
+        """
+        correspondent = correspondent.lower()
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            for batch in batched(list(message_ids), MAX_VARIABLES):
+                marks = ", ".join("?" * len(batch))
+                self.db.execute(
+                    f"DELETE FROM correspondents WHERE correspondent = ? AND message_id IN ({marks})",
+                    (correspondent, *batch),
+                )
+                self.db.execute(
+                    "UPDATE messages SET correspondent = (SELECT MIN(correspondent) "
+                    "FROM correspondents WHERE correspondents.message_id = messages.message_id) "
+                    f"WHERE correspondent = ? AND message_id IN ({marks})",
+                    (correspondent, *batch),
+                )
+
+    def attachment_names(self):
+        """
+        Return the filenames of every catalogued message's attachments.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT DISTINCT value FROM messages, json_each(messages.attachments)"
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def unused_blobs(self, digests):
+        """
+        Return the given blob digests that no catalogued message uses.
+        """
+        digests = set(digests)
+        with self.lock:
+            for batch in batched(list(digests), MAX_VARIABLES):
+                rows = self.db.execute(
+                    "SELECT DISTINCT digest FROM blobs WHERE digest IN "
+                    f"({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                digests.difference_update(row[0] for row in rows)
+        return digests
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def message_from_row(row):
+    message = dict(row)
+    message["attachments"] = json.loads(message["attachments"] or "[]")
+    message["correspondents"] = json.loads(message["correspondents"])
+    message["from"] = message.pop("sender")
+    message["to"] = message.pop("recipient")
+    return message
+
+
+def match_expression(query):
+    """
+    Turn what a user typed into an FTS5 query that matches all of its words.
+    Each word is quoted, so punctuation can't be read as query syntax;
+    a trailing * still searches for words starting with what precedes it.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def catalog_path(config):
+    return os.path.join(config.RAW_EMAIL_DIR, CATALOG_FILENAME)
+
+
+def get_catalog(config):
+    """
+    Return the catalog kept in the raw email dir, opening it the first time.
+    """
+    path = os.path.abspath(catalog_path(config))
+    with _catalogs_lock:
+        # Reopen a catalog whose file was removed behind its back
+        if path not in _catalogs or not os.path.exists(path):
+            _catalogs[path] = Catalog(path, getattr(config, "ATTACHMENTS_DIR", None))
+        return _catalogs[path]
+
+
+def remove_catalog(config):
+    """
+    Close and delete the catalog, if there is one.
+    """
+    path = os.path.abspath(catalog_path(config))
+    with _catalogs_lock:
+        catalog = _catalogs.pop(path, None)
+    if catalog:
+        catalog.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def catalog_record(metadata, **fields):
+    """
+    Turn the metadata from clean_email_with_metadata into a catalog record.
+    """
+    return {
+        "message_id": metadata["message_id"],
+        "date": None if metadata["date"] == "Unknown" else metadata["date"],
+        "sender": metadata["from"],
+        "recipient": metadata["to"],
+        "subject": metadata["subject"],
+        "attachments": metadata["attachments"],
+        "clean_file": str(metadata["clean_file"]),
+        "body": metadata.get("body"),
+        "blobs": metadata.get("blobs"),
+        **fields,
+    }
@@ -0,0 +1,126 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Checkpoints of a running fetch, so one that dies can carry on where it stopped.
+
+A checkpoint records the searches, the page token of the first listed page with
+messages not yet saved, and the messages already saved from that page on.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+
+
+def checkpoint_path(raw_dir, email_addresses):
+    """
+    Return the path of the checkpoint of a fetch of these correspondents, named after
+    the correspondent, or after a hash of them all when there are several.
+    """
+    if len(email_addresses) == 1:
+        name = email_addresses[0]
+    else:
+        name = hashlib.sha256(",".join(sorted(email_addresses)).encode()).hexdigest()[:16]
+    return os.path.join(raw_dir, f"{name}{CHECKPOINT_SUFFIX}")
+
+
+def load_checkpoint(raw_dir, email_addresses):
+    """
+    Return the checkpoint of an unfinished fetch of these correspondents, or None.
+    """
+    try:
+        with open(checkpoint_path(raw_dir, email_addresses), encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Error loading checkpoint: {e}")
+        return None
+
+    checkpoint["completed_ids"] = set(checkpoint["completed_ids"])
+    return checkpoint
+
+
+def remove_checkpoint(raw_dir, email_addresses):
+    try:
+        os.remove(checkpoint_path(raw_dir, email_addresses))
+    except FileNotFoundError:
+        pass
+
+
+class CheckpointTracker:
+    """
+    Follows which listed pages have all their messages saved, to know where a
+    fetch could resume. Pages are listed ahead of saving, and saved out of order
+    by several threads, so every page from the first unfinished one is kept.
+    """
+
+    def __init__(self, raw_dir, email_addresses, queries, history_id):
+        self.path = checkpoint_path(raw_dir, email_addresses)
+        self.queries = queries
+        self.history_id = history_id
+        # Listed pages as [query index, page token, ids to save, ids saved]
+        self.pages = deque()
+        self.page_of = {}
+        self.lock = threading.Lock()
+
+    def listed(self, query_index, page_token, message_ids):
+        with self.lock:
+            page = [query_index, page_token, set(message_ids), set()]
+            self.pages.append(page)
+            for message_id in message_ids:
+                self.page_of[message_id] = page
+
+    def saved(self, message_id):
+        with self.lock:
+            page = self.page_of.pop(message_id, None)
+            if page:
+                page[2].discard(message_id)
+                page[3].add(message_id)
+
+    def save(self):
+        """
+        Atomically write the checkpoint. Call it only once the saved messages are
+        in the manifests, since resuming relies on them to skip those messages.
+        """
+        with self.lock:
+            # Finished pages are dropped, except the last, which resuming lists again
+            while len(self.pages) > 1 and not self.pages[0][2]:
+                self.pages.popleft()
+            if not self.pages:
+                return
+            query_index, page_token = self.pages[0][:2]
+            completed_ids = set().union(*(page[3] for page in self.pages))
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "queries": [query for query, _ in self.queries],
+                    "query_index": query_index,
+                    "page_token": page_token,
+                    "completed_ids": sorted(completed_ids),
+                    "history_id": self.history_id,
+                },
+                f,
+            )
+        os.replace(temp_path, self.path)
@@ -0,0 +1,314 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Deleting some of the saved messages: those with one correspondent, in a date
+range, or with given ids. The messages and their files are looked up in the
+catalog and the manifests, so the directories they live in are never listed
+except to find the odd file the catalog doesn't know about.
+Deleting everything does list them, and removes whatever it finds.
+"""
+
+import os
+import shutil
+from itertools import batched
+
+from blobs import (
+    BLOBS_DIR,
+    MAPS_DIR,
+    blob_path,
+    count_blobs,
+    load_message_blobs,
+    map_path,
+)
+from catalog import get_catalog, remove_catalog
+from checkpoints import CHECKPOINT_SUFFIX
+from emails import (
+    MANIFEST_SUFFIX,
+    ignore_progress,
+    load_manifest,
+    manifest_path,
+    raw_email_filename,
+    save_manifest,
+)
+from rawstore import get_packed_store, has_packed_store, remove_packed_store
+
+# Messages deleted between progress reports and catalog transactions, unless
+# the config sets DELETE_BATCH_SIZE
+DELETE_BATCH_SIZE = 500
+
+
+def delete_messages(
+    config,
+    correspondent=None,
+    date_from=None,
+    date_to=None,
+    message_ids=None,
+    batch_size=None,
+    progress=None,
+):
+    """
+    Delete the saved messages matching all of the given filters: their raw and
+    cleaned emails, their attachments, and their entries in the catalog and manifests.
+    Dates are YYYY-MM-DD strings and both ends of the range are included.
+    A correspondent's messages that are also attributed to other correspondents
+    are kept for them, and only stop being attributed to this one.
+    If progress is given, it is called as progress("selected", messages=n) once the
+    messages are found and progress("deleted", messages=n) after each batch.
+    Return how many messages and attachments were deleted.
+    """
+    if not (correspondent or date_from or date_to or message_ids):
+        raise ValueError("Give a correspondent, a date range or message ids to delete.")
+
+    progress = progress or ignore_progress
+    batch_size = batch_size or delete_batch_size(config)
+    catalog = get_catalog(config)
+    messages = {
+        message["message_id"]: message
+        for message in catalog.find(correspondent, date_from, date_to, message_ids)
+    }
+    manifests = load_manifests(config.RAW_EMAIL_DIR)
+    # Messages saved before there was a catalog are only known to the manifests
+    if correspondent and not (date_from or date_to):
+        wanted = manifests.get(correspondent.lower(), new_manifest())["message_ids"]
+        if message_ids is not None:
+            wanted = wanted & set(message_ids)
+        for message_id in wanted - messages.keys():
+            messages[message_id] = {"message_id": message_id, "attachments": []}
+    elif message_ids is not None and not (date_from or date_to):
+        for message_id in set(message_ids) - messages.keys():
+            if any(message_id in manifest["message_ids"] for manifest in manifests.values()):
+                messages[message_id] = {"message_id": message_id, "attachments": []}
+
+    if correspondent:
+        correspondent = correspondent.lower()
+        shared_ids = [
+            message_id
+            for message_id, message in messages.items()
+            if set(message.get("correspondents", [])) - {correspondent}
+        ]
+        catalog.detach(shared_ids, correspondent)
+        if correspondent in manifests:
+            update_manifests(
+                config.RAW_EMAIL_DIR, {correspondent: manifests[correspondent]}, shared_ids
+            )
+        for message_id in shared_ids:
+            del messages[message_id]
+
+    progress("selected", messages=len(messages))
+    find_clean_files(config.CLEAN_EMAIL_DIR, messages)
+    attachment_names = set()
+    digests = set()
+    for batch in batched(messages.values(), batch_size):
+        delete_raw_emails(config.RAW_EMAIL_DIR, batch)
+        for message in batch:
+            remove_file(message.get("clean_file"))
+            attachment_names.update(message["attachments"])
+            digests.update(delete_message_blobs(config.ATTACHMENTS_DIR, message["message_id"]))
+        catalog.delete([message["message_id"] for message in batch])
+        progress("deleted", messages=len(batch))
+
+    deleted_attachments = delete_unused_attachments(
+        config.ATTACHMENTS_DIR, attachment_names, catalog.attachment_names()
+    )
+    deleted_attachments += delete_unused_blobs(config.ATTACHMENTS_DIR, digests, catalog)
+    update_manifests(config.RAW_EMAIL_DIR, manifests, messages.keys())
+    return {"deleted_messages": len(messages), "deleted_attachments": deleted_attachments}
+
+
+def delete_everything(config, batch_size=None, progress=None):
+    """
+    Delete every saved file: the raw and cleaned emails, the attachments, the
+    catalog, and the manifests and checkpoints.
+    If progress is given, it is called as progress("selected", messages=n) once the
+    raw emails are found and progress("deleted", messages=n) as they are deleted.
+    Return how many messages and attachments were deleted.
+    """
+    progress = progress or ignore_progress
+    batch_size = batch_size or delete_batch_size(config)
+    attachments_dir = config.ATTACHMENTS_DIR
+    clean_dir = config.CLEAN_EMAIL_DIR
+    raw_dir = config.RAW_EMAIL_DIR
+
+    with os.scandir(raw_dir) as entries:
+        raw_files = [entry.path for entry in entries if entry.name.endswith(".eml")]
+    packed = len(get_packed_store(raw_dir)) if has_packed_store(raw_dir) else 0
+    progress("selected", messages=len(raw_files) + packed)
+    for batch in batched(raw_files, batch_size):
+        for path in batch:
+            remove_file(path)
+        progress("deleted", messages=len(batch))
+    if packed:
+        remove_packed_store(raw_dir)
+        progress("deleted", messages=packed)
+    elif not raw_files:
+        print("No raw emails found.")
+
+    deleted_clean = 0
+    with os.scandir(clean_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".txt"):
+                os.remove(entry.path)
+                deleted_clean += 1
+    if not deleted_clean:
+        print("No cleaned emails found.")
+
+    deleted_attachments = 0
+    found_attachments = False
+    with os.scandir(attachments_dir) as entries:
+        for entry in entries:
+            found_attachments = True
+            if entry.is_dir(follow_symlinks=False):
+                # Directories of the blob store; its links and maps aren't attachments of their own
+                if entry.name == BLOBS_DIR:
+                    deleted_attachments += count_blobs(attachments_dir)
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+                deleted_attachments += 1
+    if not found_attachments:
+        print("No attachments found.")
+
+    remove_catalog(config)
+    # Without their raw emails, the manifests and checkpoints would make fetches skip messages
+    with os.scandir(raw_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith((MANIFEST_SUFFIX, CHECKPOINT_SUFFIX)):
+                os.remove(entry.path)
+
+    return {
+        "deleted_messages": max(len(raw_files) + packed, deleted_clean),
+        "deleted_attachments": deleted_attachments,
+    }
+
+
+def delete_batch_size(config):
+    return getattr(config, "DELETE_BATCH_SIZE", None) or DELETE_BATCH_SIZE
+
+
+def load_manifests(raw_dir):
+    """
+    Load every correspondent's manifest, keyed by correspondent.
+    """
+    manifests = {}
+    with os.scandir(raw_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(MANIFEST_SUFFIX):
+                email_address = entry.name[: -len(MANIFEST_SUFFIX)]
+                manifests[email_address] = load_manifest(raw_dir, email_address)
+    return manifests
+
+
+def new_manifest():
+    return {"message_ids": set(), "history_id": None}
+
+
+def update_manifests(raw_dir, manifests, message_ids):
+    """
+    Take deleted messages out of the manifests, so fetching again saves them again.
+    Their history id is cleared as well: history only reports messages added
+    since, so the next incremental fetch compares message ids instead and finds them.
+    A manifest left with no messages is removed, as when everything is deleted.
+    """
+    for email_address, manifest in manifests.items():
+        saved_ids = manifest["message_ids"]
+        if saved_ids.isdisjoint(message_ids):
+            continue
+        saved_ids.difference_update(message_ids)
+        if saved_ids:
+            save_manifest(raw_dir, email_address, saved_ids, None)
+        else:
+            remove_file(manifest_path(raw_dir, email_address))
+
+
+def find_clean_files(clean_dir, messages):
+    """
+    Fill in the cleaned emails the catalog doesn't know about, in one pass over clean_dir.
+    """
+    missing = {
+        message_id
+        for message_id, message in messages.items()
+        if not message.get("clean_file")
+    }
+    if not missing:
+        return
+    with os.scandir(clean_dir) as entries:
+        for entry in entries:
+            # Cleaned emails are named <date>__<subject>__<message id>.txt
+            message_id = entry.name.removesuffix(".txt").rpartition("__")[2]
+            if message_id in missing:
+                messages[message_id]["clean_file"] = entry.path
+
+
+def delete_raw_emails(raw_dir, messages):
+    packed_ids = []
+    for message in messages:
+        if not remove_file(os.path.join(raw_dir, raw_email_filename(message["message_id"]))):
+            packed_ids.append(message["message_id"])
+    if packed_ids and has_packed_store(raw_dir):
+        get_packed_store(raw_dir).delete(packed_ids)
+
+
+def delete_message_blobs(attachments_dir, message_id):
+    """
+    Remove a message's blob map and links, and return the digests it used.
+    """
+    blobs = load_message_blobs(attachments_dir, message_id)
+    if not blobs:
+        return set()
+    remove_file(map_path(attachments_dir, message_id))
+    shutil.rmtree(os.path.join(attachments_dir, message_id), ignore_errors=True)
+    return {digest for _, digest in blobs}
+
+
+def delete_unused_attachments(attachments_dir, names, names_in_use):
+    """
+    Remove attachments saved as plain files, unless a message that is kept has
+    one with the same name, since they share the attachments dir.
+    """
+    deleted = 0
+    for name in names - names_in_use:
+        if name not in (BLOBS_DIR, MAPS_DIR) and remove_file(
+            os.path.join(attachments_dir, name)
+        ):
+            deleted += 1
+    return deleted
+
+
+def delete_unused_blobs(attachments_dir, digests, catalog):
+    """
+    Remove the blobs no message left in the catalog uses.
+    """
+    if not digests:
+        return 0
+    return sum(
+        remove_file(blob_path(attachments_dir, digest))
+        for digest in catalog.unused_blobs(digests)
+    )
+
+
+def remove_file(path):
+    """
+    Remove a file if there is one. Return whether there was.
+    """
+    if not path:
+        return False
+    try:
+        os.remove(path)
+    except (FileNotFoundError, IsADirectoryError):
+        return False
+    return True
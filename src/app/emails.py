@@ -16,101 +16,937 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import base64
+import binascii
+import contextlib
 import email
+import functools
+import json
+import multiprocessing
 import os
+import quopri
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from email import policy
-from email.parser import BytesParser
+from email.parser import Parser
+from types import SimpleNamespace
 
 from auth import get_credentials
-from googleapiclient.discovery import build
+from blobs import blob_path, link_message_blobs, save_message_blobs, store_blob
+from catalog import catalog_record, get_catalog
+from checkpoints import CheckpointTracker, load_checkpoint, remove_checkpoint
+from lazyparse import parse_lazily
+from metrics import API_ERRORS, API_THROTTLED, STAGE_BYTES, STAGE_SECONDS
+from pipeline import Pipeline, Stage
+from rawstore import get_packed_store, has_packed_store
+from throttling import AdaptiveLimiter, error_status, execute, is_throttled
 
-import ipdb
+# Gmail caps a batch request at 100 calls; 0 disables batching
+MAX_BATCH_SIZE = 100
+# The defaults of the fetch settings, which create_app reads from GFETCH_* variables
+BATCH_SIZE = 0
+WORKERS = 1
+CLEANERS = 1
+WRITERS = 1
+CLEAN_PROCESSES = 0
+# Items each pipeline queue holds before the stage feeding it has to wait; 0 means twice its workers
+QUEUE_SIZE = 0
+# Times a throttled or failed Gmail request is retried before the fetch gives up
+RETRIES = 6
+# "files" saves attachments under their own names; "blobs" keeps each distinct one once, by hash
+ATTACHMENT_STORE = "files"
+# With the blob store, "hardlink" or "symlink" also shows attachments under their own names
+ATTACHMENT_LINKS = "none"
+# "files" saves each raw email as an eml file; "packed" appends them, compressed, to segment files
+RAW_STORE = "files"
+# "lazy" finds a message's parts without the email package reading every line,
+# leaving unusual messages to it; "full" always has the email package parse them
+PARSER = "lazy"
+# Settings a config can give fetch_emails, named as its arguments in upper case
+FETCH_SETTINGS = (
+    "BATCH_SIZE",
+    "WORKERS",
+    "CLEANERS",
+    "WRITERS",
+    "CLEAN_PROCESSES",
+    "QUEUE_SIZE",
+    "RETRIES",
+    "RAW_STORE",
+)
+# Settings a config can give the cleaning of each message
+CLEAN_SETTINGS = ("ATTACHMENT_STORE", "ATTACHMENT_LINKS", "PARSER")
+# Characters of encoded attachment text decoded at a time
+DECODE_CHUNK_SIZE = 1024 * 1024
+NOT_BASE64 = re.compile(r"[^A-Za-z0-9+/=]")
+# What well-formed base64 text may hold before its padding, and the padding
+BASE64_LINES = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/\r\n"
+BASE64_PADDING = re.compile(r"(?:=[\r\n]*){1,2}")
+# Saved messages between manifest updates during a fetch
+MANIFEST_INTERVAL = 100
+# Saved messages added to the catalog and its search index in one transaction
+CATALOG_BATCH_SIZE = 100
+MANIFEST_SUFFIX = ".manifest.json"
+# Gmail doesn't document how long a search can be, but rejects very long ones
+MAX_QUERY_LENGTH = 1500
+# Headers whose addresses a message is attributed to correspondents by
+ADDRESS_HEADERS = ("From", "To", "Cc", "Bcc")
+# Gmail's discovery document, kept with the app so building a service never goes online
+DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(__file__), "discovery", "gmail.v1.json")
 
+# Gmail services built for the current credentials and not in use, kept across fetches
+_services = {"creds": None, "idle": []}
+_services_lock = threading.Lock()
+# build_from_document fills in the shared discovery document as it goes
+_build_lock = threading.Lock()
 
-def fetch_emails(email_address, config):
+
+def fetch_emails(
+    email_address,
+    config,
+    batch_size=BATCH_SIZE,
+    workers=WORKERS,
+    incremental=False,
+    cleaners=CLEANERS,
+    writers=WRITERS,
+    clean_processes=CLEAN_PROCESSES,
+    queue_size=QUEUE_SIZE,
+    retries=RETRIES,
+    raw_store=RAW_STORE,
+    resume=False,
+    progress=None,
+):
     """
-    Fetch all emails from a given email address.
+    Fetch all emails from a given email address, or from several at once.
+    email_address can be a list of addresses, or a string of them separated by
+    commas or whitespace. The correspondents are combined into as few Gmail
+    searches as will fit, each message is downloaded once however many of them
+    it matches, and it is attributed to each of them in the catalog and manifests.
+    Messages go through a pipeline of stages joined by bounded queues: listing,
+    downloading (workers threads), parsing and cleaning (cleaners threads) and
+    writing raw files (writers threads).
+    If batch_size is set, messages are downloaded in batched requests.
+    If clean_processes is more than 1, the cleaning is done by a pool of worker processes.
+    If incremental is set, only messages missing from the manifest are downloaded.
+    A checkpoint of how far the fetch has got is saved along with the manifests.
+    If resume is set and an earlier fetch of the same correspondents didn't finish,
+    listing carries on from its checkpoint, skipping the messages it saved.
+    Saved messages are added to the catalog and its search index in batches.
+    raw_store picks how raw emails are saved: "files" or "packed".
+    Gmail requests are retried up to retries times, and fewer are sent at once while
+    Gmail is throttling them.
+    If progress is given, it is called as progress(event, **data) for each page
+    listed, each message fetched and cleaned, and with the stage stats every second;
+    it may raise to stop the fetch.
     """
-    raw_dir = config.RAW_EMAIL_DIR
+    progress = progress or ignore_progress
     creds = get_credentials()
 
     if not creds:
         return {"error": "Failed to obtain credentials."}
 
     try:
-        service = build("gmail", "v1", credentials=creds)
+        # Used for listing for the whole fetch, while the download workers check out their own
+        service = checkout_service(creds)
     except Exception as e:
         print(f"Error building Gmail service: {e}")
         return {"error": f"Error building Gmail service: {e}"}
 
-    query = f"to:{email_address} OR from:{email_address}"
-    next_page_token = None
-    total_messages = 0
-    total_attachments = 0
+    try:
+        email_addresses = (
+            parse_addresses(email_address)
+            if isinstance(email_address, str)
+            else [address.lower() for address in email_address]
+        )
+        if not email_addresses:
+            return {"error": "No email address given."}
+        queries = build_queries(email_addresses, MAX_QUERY_LENGTH)
+        raw_dir = config.RAW_EMAIL_DIR
+        manifests = {address: load_manifest(raw_dir, address) for address in email_addresses}
+        # Messages saved for any of the correspondents are already on disk
+        saved_ids = set().union(*(manifest["message_ids"] for manifest in manifests.values()))
+        history_ids = [manifest["history_id"] for manifest in manifests.values()]
+        # Shared by every thread, since they all draw on the same Gmail quota
+        limiter = AdaptiveLimiter(workers + 1)
+        request_options = {"limiter": limiter, "retries": retries}
+        # Taken before listing, so anything that arrives during the fetch shows up next time
+        history_id = execute(service.users().getProfile(userId="me"), **request_options)[
+            "historyId"
+        ]
+        checkpoint = load_checkpoint(raw_dir, email_addresses) if resume else None
+        if checkpoint and checkpoint["queries"] != [query for query, _ in queries]:
+            print("The checkpoint is for different searches, starting over.")
+            checkpoint = None
+        if checkpoint:
+            # Anything that arrived since the interrupted fetch started shows up next time
+            history_id = checkpoint["history_id"]
+        tracker = CheckpointTracker(raw_dir, email_addresses, queries, history_id)
+        # Filled in by the listing with the thread of each message
+        thread_ids = {}
+        # Filled in by the listing with the correspondents whose search found each message
+        query_addresses = {}
+        list_options = {**request_options, "thread_ids": thread_ids}
+
+        def list_all(start_query=0, page_token=None, **options):
+            listed_ids = set()
+            for query_index in range(start_query, len(queries)):
+                query, addresses = queries[query_index]
+                page_tokens = []
+                for message_ids in list_messages(
+                    service,
+                    query,
+                    page_token=page_token,
+                    page_tokens=page_tokens,
+                    **options,
+                    **list_options,
+                ):
+                    # Messages matching several searches are only downloaded once
+                    message_ids = [
+                        message_id for message_id in message_ids if message_id not in listed_ids
+                    ]
+                    listed_ids.update(message_ids)
+                    for message_id in message_ids:
+                        query_addresses[message_id] = addresses
+                    tracker.listed(query_index, page_tokens[-1], message_ids)
+                    yield message_ids
+                page_token = None
+
+        def list_added(message_ids):
+            # Only the correspondents' messages, found by their headers, without listing
+            # searches. Each worker asks about a batch of them at a time, with its own service
+            size = min(batch_size or MAX_BATCH_SIZE, MAX_BATCH_SIZE)
+            chunks = [
+                message_ids[start : start + size] for start in range(0, len(message_ids), size)
+            ]
+
+            def check(chunk):
+                with pooled_service(creds) as worker_service:
+                    return get_correspondent_messages(
+                        worker_service, chunk, email_addresses, size, **list_options
+                    )
+
+            executor = ThreadPoolExecutor(workers)
+            try:
+                for added_addresses in executor.map(check, chunks):
+                    query_addresses.update(added_addresses)
+                    added_ids = list(added_addresses)
+                    # Resuming lists everything again, leaving out the messages saved
+                    tracker.listed(0, None, added_ids)
+                    yield added_ids
+            finally:
+                executor.shutdown(cancel_futures=True)
+
+        if checkpoint:
+            print("Resuming from the checkpoint of an unfinished fetch.")
+            pages = list_all(
+                checkpoint["query_index"],
+                checkpoint["page_token"],
+                known_ids=saved_ids | checkpoint["completed_ids"],
+            )
+        elif not incremental:
+            pages = list_all()
+        elif all(history_ids):
+            # History since the oldest fetch covers every correspondent
+            start_history_id = min(history_ids, key=int)
+            added_ids = get_added_message_ids(service, start_history_id, **request_options)
+            if added_ids is None:
+                print("History is no longer available, comparing message ids instead.")
+                pages = list_all(known_ids=saved_ids)
+            else:
+                pages = list_added(list(added_ids - saved_ids))
+        else:
+            pages = list_all(known_ids=saved_ids)
+
+        chunk_size = batch_size or 1
+        clean_pool = new_clean_pool(clean_processes) if clean_processes > 1 else None
+        clean_dirs = get_clean_dirs(config)
+        catalog = get_catalog(config)
+        catalog_records = []
+        totals = {"messages": 0, "attachments": 0}
+        totals_lock = threading.Lock()
+
+        def list_chunks():
+            for message_ids in pages:
+                progress("page", messages=len(message_ids))
+                for start in range(0, len(message_ids), chunk_size):
+                    yield message_ids[start : start + chunk_size]
+
+        def download(message_ids):
+            # Each worker has a service to itself while it downloads
+            with pooled_service(creds) as worker_service:
+                if batch_size:
+                    raw_messages = get_messages_batch(
+                        worker_service, message_ids, batch_size, **request_options
+                    )
+                else:
+                    raw_messages = [
+                        get_message(worker_service, message_ids[0], **request_options)
+                    ]
+            for message_id, msg_str in zip(message_ids, raw_messages):
+                progress("fetched", message_id=message_id, size=len(msg_str))
+                yield message_id, msg_str
+
+        def clean(item):
+            message_id, msg_str = item
+            # Steps run in worker processes aren't recorded here, but the whole is
+            with STAGE_SECONDS.time("clean"):
+                if clean_pool:
+                    metadata = clean_pool.submit(
+                        clean_email_task, msg_str, clean_dirs, message_id
+                    ).result()
+                else:
+                    metadata = clean_email_with_metadata(msg_str, config, message_id)
+            progress("cleaned", message_id=message_id, attachments=len(metadata["attachments"]))
+            yield message_id, msg_str, metadata
+
+        def write(item):
+            message_id, msg_str, metadata = item
+            raw_file = write_raw_email(message_id, msg_str, config, raw_store)
+            # Gmail may match a correspondent by an alias that isn't in the headers
+            correspondents = [
+                address for address in email_addresses if address in metadata["addresses"]
+            ] or query_addresses.get(message_id, email_addresses)
+            record = catalog_record(
+                metadata,
+                thread_id=thread_ids.get(message_id),
+                correspondent=correspondents[0],
+                correspondents=correspondents,
+                size=len(msg_str),
+                raw_file=raw_file,
+            )
+            # A message only goes in the manifests once its raw file is written
+            with totals_lock:
+                for address in correspondents:
+                    manifests[address]["message_ids"].add(message_id)
+                tracker.saved(message_id)
+                catalog_records.append(record)
+                totals["messages"] += 1
+                totals["attachments"] += len(metadata["attachments"])
+                if len(catalog_records) >= CATALOG_BATCH_SIZE:
+                    add_to_catalog()
+                if totals["messages"] % MANIFEST_INTERVAL == 0:
+                    save_manifests()
+                    tracker.save()
+            return ()
+
+        def add_to_catalog():
+            if catalog_records:
+                with STAGE_SECONDS.time("catalog"):
+                    catalog.add(catalog_records)
+            catalog_records.clear()
+
+        def save_manifests(history_id=None):
+            for address, manifest in manifests.items():
+                save_manifest(
+                    raw_dir,
+                    address,
+                    manifest["message_ids"],
+                    history_id or manifest["history_id"],
+                )
+
+        fetch_pipeline = Pipeline(
+            "list",
+            list_chunks(),
+            [
+                Stage("download", download, workers, queue_size, ordered=True),
+                Stage("clean", clean, max(cleaners, clean_processes), queue_size, ordered=True),
+                Stage("write", write, writers, queue_size),
+            ],
+        )
+
+        try:
+            fetch_pipeline.run(on_stats=lambda stats: progress("stages", stages=stats))
+        except BaseException:
+            # Keep track of the messages saved before the fetch stopped
+            add_to_catalog()
+            save_manifests()
+            tracker.save()
+            raise
+        finally:
+            if clean_pool:
+                clean_pool.shutdown(cancel_futures=True)
+
+        total_messages = totals["messages"]
+        total_attachments = totals["attachments"]
+
+        if not total_messages:
+            print("No messages remain.")
+
+        add_to_catalog()
+        save_manifests(history_id)
+        remove_checkpoint(raw_dir, email_addresses)
+
+        print("\nDone.")
+        for name, stats in fetch_pipeline.stats().items():
+            print(
+                f"{name}: {stats['processed']} items, {stats['per_sec']}/sec, "
+                f"{stats['utilization']:.0%} busy"
+            )
+        limiter_stats = limiter.stats()
+        if limiter_stats["retries"]:
+            print(
+                f"Retried {limiter_stats['retries']} requests, {limiter_stats['throttles']} "
+                f"throttled; ended at {limiter_stats['limit']} requests at a time."
+            )
+        print(f"Retrieved {total_messages} messages and {total_attachments} attachments.")
+        return {"total_messages": total_messages, "total_attachments": total_attachments}
+    finally:
+        return_service(creds, service)
+
+
+def checkout_service(creds):
+    """
+    Take a Gmail service for the credentials that no other thread is using,
+    building one only if every service built for them is in use.
+    httplib2 is not thread-safe, so a service is used by one thread at a time.
+    Services are kept across fetches, and dropped when the credentials change.
+    """
+    with _services_lock:
+        if _services["creds"] is not creds:
+            _services["creds"] = creds
+            _services["idle"] = []
+        if _services["idle"]:
+            return _services["idle"].pop()
+    return build_service(creds)
+
+
+def return_service(creds, service):
+    """
+    Give back a service from checkout_service, for the next fetch or worker to use.
+    """
+    with _services_lock:
+        if _services["creds"] is creds:
+            _services["idle"].append(service)
+
+
+@contextlib.contextmanager
+def pooled_service(creds):
+    service = checkout_service(creds)
+    try:
+        yield service
+    finally:
+        return_service(creds, service)
+
+
+def build_service(creds):
+    """
+    Build a Gmail service from the bundled discovery document. The client
+    library is imported here, on the first fetch, rather than with the app.
+    """
+    from googleapiclient.discovery import build_from_document
+
+    with _build_lock:
+        return build_from_document(load_discovery_document(), credentials=creds)
+
+
+@functools.cache
+def load_discovery_document():
+    with open(DISCOVERY_DOCUMENT) as f:
+        return json.load(f)
+
+
+def ignore_progress(event, **data):
+    """
+    Default progress hook for fetch_emails, which does nothing.
+    """
+
+
+def parse_addresses(text):
+    """
+    Split a list of email addresses separated by commas, semicolons or whitespace,
+    as typed in the form or read from a file, dropping repeats.
+    """
+    addresses = re.split(r"[\s,;]+", text.lower())
+    return list(dict.fromkeys(address for address in addresses if address))
+
+
+def build_queries(email_addresses, max_length=MAX_QUERY_LENGTH):
+    """
+    OR together searches for as many correspondents as fit in each Gmail query.
+    Return a list of (query, addresses) pairs.
+    """
+    queries = []
+    terms = []
+    addresses = []
+    for address in email_addresses:
+        term = f"to:{address} OR from:{address}"
+        if terms and len(" OR ".join([*terms, term])) > max_length:
+            queries.append((" OR ".join(terms), addresses))
+            terms = []
+            addresses = []
+        terms.append(term)
+        addresses.append(address)
+    if terms:
+        queries.append((" OR ".join(terms), addresses))
+    return queries
+
+
+def list_messages(
+    service,
+    query,
+    known_ids=frozenset(),
+    limiter=None,
+    retries=RETRIES,
+    thread_ids=None,
+    page_token=None,
+    page_tokens=None,
+):
+    """
+    Yield pages of ids of messages matching the query, leaving out known_ids.
+    If thread_ids is given, each listed message's thread id is stored in it.
+    Listing starts from page_token, if given. If page_tokens is given, the token
+    each page was listed with is appended to it before the page is yielded.
+    """
+    next_page_token = page_token
 
     while True:
         if next_page_token:
-            results = (
+            request = (
                 service.users()
                 .messages()
                 .list(userId="me", q=query, pageToken=next_page_token)
-                .execute()
             )
         else:
-            results = service.users().messages().list(userId="me", q=query).execute()
+            request = service.users().messages().list(userId="me", q=query)
+        with STAGE_SECONDS.time("list"):
+            results = execute(request, limiter, retries)
+        if page_tokens is not None:
+            page_tokens.append(next_page_token)
+        if thread_ids is not None:
+            for message in results.get("messages", []):
+                thread_ids[message["id"]] = message.get("threadId")
 
-        messages = results.get("messages", [])
-        next_page_token = results.get("nextPageToken", None)
+        message_ids = [
+            message["id"]
+            for message in results.get("messages", [])
+            if message["id"] not in known_ids
+        ]
+        yield message_ids
 
-        if not messages:
-            print("No messages remain.")
+        next_page_token = results.get("nextPageToken", None)
+        if not next_page_token:
             break
-        else:
-            for message in messages:
-                message_id = message["id"] 
-                msg = (
-                    service.users()
-                    .messages()
-                    .get(userId="me", id=message["id"], format="raw")
-                    .execute()
+
+
+def get_added_message_ids(service, start_history_id, limiter=None, retries=RETRIES):
+    """
+    Return the set of ids of messages added since start_history_id.
+    Return None if Gmail no longer has history that far back.
+    """
+    from googleapiclient.errors import HttpError
+
+    added_ids = set()
+    next_page_token = None
+
+    while True:
+        try:
+            request = (
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes="messageAdded",
+                    pageToken=next_page_token,
                 )
-                msg_str = base64.urlsafe_b64decode(msg["raw"].encode("ASCII"))
-                raw_email_path = os.path.join(raw_dir, f'email_{message["id"]}.eml')
-                print(f'\nRetrieving message {raw_email_path.split('/')[-1]}.')
-                with open(raw_email_path, "wb") as f:
-                    f.write(msg_str)
-                attachments = clean_email(raw_email_path, config, message_id)
-                if attachments:
-                    total_attachments += attachments
+            )
+            with STAGE_SECONDS.time("history"):
+                results = execute(request, limiter, retries)
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
 
-            total_messages += len(messages)
+        for record in results.get("history", []):
+            for added in record.get("messagesAdded", []):
+                added_ids.add(added["message"]["id"])
 
+        next_page_token = results.get("nextPageToken", None)
         if not next_page_token:
-            break
+            return added_ids
+
+
+def get_correspondent_messages(
+    service,
+    message_ids,
+    email_addresses,
+    batch_size=MAX_BATCH_SIZE,
+    limiter=None,
+    retries=RETRIES,
+    thread_ids=None,
+):
+    """
+    Pick out the messages sent to or from any of email_addresses, by asking Gmail
+    for each message's address headers in batched requests of batch_size messages
+    (0 for as many as a batch holds). Return a dict of each such message id to
+    its correspondents, in the order of message_ids.
+    Messages in spam or trash, or deleted since, are left out, as a search leaves them out.
+    Any message that fails inside a batch for another reason is asked for on its own.
+    If thread_ids is given, each message's thread id is stored in it.
+    """
+    from googleapiclient.errors import HttpError
+
+    limiter = limiter or AdaptiveLimiter(1)
+    batch_size = min(batch_size or MAX_BATCH_SIZE, MAX_BATCH_SIZE)
+    correspondents = {}
+    failed_ids = []
+
+    def metadata_request(message_id):
+        return (
+            service.users()
+            .messages()
+            .get(
+                userId="me",
+                id=message_id,
+                format="metadata",
+                metadataHeaders=list(ADDRESS_HEADERS),
+            )
+        )
+
+    def store_metadata(request_id, response, exception):
+        if isinstance(exception, HttpError) and exception.resp.status == 404:
+            return
+        if exception is not None:
+            print(f"Batch request for message {request_id} failed: {exception}")
+            failed_ids.append(request_id)
+            API_ERRORS.inc(1, error_status(exception))
+            if is_throttled(exception):
+                API_THROTTLED.inc()
+                limiter.record(throttled=True)
+            return
+        if {"SPAM", "TRASH"} & set(response.get("labelIds", [])):
+            return
+        values = [
+            header["value"]
+            for header in response.get("payload", {}).get("headers", [])
+            if header["name"].title() in ADDRESS_HEADERS
+        ]
+        addresses = header_addresses(values)
+        matched = [address for address in email_addresses if address in addresses]
+        if matched:
+            correspondents[request_id] = matched
+            if thread_ids is not None:
+                thread_ids[request_id] = response.get("threadId")
+
+    for start in range(0, len(message_ids), batch_size):
+        batch = service.new_batch_http_request(callback=store_metadata)
+        for message_id in message_ids[start : start + batch_size]:
+            batch.add(metadata_request(message_id), request_id=message_id)
+        with STAGE_SECONDS.time("metadata"):
+            execute(batch, limiter, retries)
+
+    for message_id in failed_ids:
+        try:
+            with STAGE_SECONDS.time("metadata"):
+                response = execute(metadata_request(message_id), limiter, retries)
+        except HttpError as e:
+            if e.resp.status == 404:
+                continue
+            raise
+        store_metadata(message_id, response, None)
+
+    return {
+        message_id: correspondents[message_id]
+        for message_id in message_ids
+        if message_id in correspondents
+    }
+
+
+def manifest_path(raw_dir, email_address):
+    """
+    Return the path of the manifest of messages saved for a correspondent.
+    """
+    return os.path.join(raw_dir, f"{email_address.lower()}{MANIFEST_SUFFIX}")
 
-    print("\nDone.")
-    print(f"Retrieved {total_messages} messages and {total_attachments} attachments.")
-    return {"total_messages": total_messages, "total_attachments": total_attachments}
+
+def load_manifest(raw_dir, email_address):
+    """
+    Load the ids of messages already saved for a correspondent and the last history id.
+    """
+    try:
+        with open(manifest_path(raw_dir, email_address), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {"message_ids": set(), "history_id": None}
+    except (OSError, ValueError) as e:
+        print(f"Error loading manifest: {e}")
+        return {"message_ids": set(), "history_id": None}
+
+    return {
+        "message_ids": set(manifest.get("message_ids", [])),
+        "history_id": manifest.get("history_id"),
+    }
+
+
+def save_manifest(raw_dir, email_address, message_ids, history_id):
+    """
+    Atomically write the manifest of messages saved for a correspondent.
+    """
+    path = manifest_path(raw_dir, email_address)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"history_id": history_id, "message_ids": sorted(message_ids)}, f)
+    os.replace(temp_path, path)
+
+
+def get_message(service, message_id, limiter=None, retries=RETRIES):
+    """
+    Download a single message and return its raw bytes.
+    """
+    request = service.users().messages().get(userId="me", id=message_id, format="raw")
+    with STAGE_SECONDS.time("get"):
+        msg = execute(request, limiter, retries)
+    return decode_raw(msg["raw"])
 
 
-def clean_email(email_file, config, message_id):
+def get_messages_batch(
+    service, message_ids, batch_size=MAX_BATCH_SIZE, limiter=None, retries=RETRIES
+):
     """
-    Take an eml file, clean and save it as a txt file, and save any attachments.
+    Download messages in batched requests and return their raw bytes in order.
+    Any message that fails inside a batch is retried on its own.
     """
-    print(f"Cleaning email {email_file.split('/')[-1]}.")
+    limiter = limiter or AdaptiveLimiter(1)
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    raw_messages = {}
+    failed_ids = []
+
+    def store_message(request_id, response, exception):
+        if exception is not None:
+            print(f"Batch request for message {request_id} failed: {exception}")
+            failed_ids.append(request_id)
+            API_ERRORS.inc(1, error_status(exception))
+            if is_throttled(exception):
+                API_THROTTLED.inc()
+                limiter.record(throttled=True)
+        else:
+            # Decoded once the batch is in, so the batch's time is all downloading
+            raw_messages[request_id] = response["raw"]
+
+    for start in range(0, len(message_ids), batch_size):
+        batch = service.new_batch_http_request(callback=store_message)
+        for message_id in message_ids[start : start + batch_size]:
+            batch.add(
+                service.users().messages().get(userId="me", id=message_id, format="raw"),
+                request_id=message_id,
+            )
+        with STAGE_SECONDS.time("batch"):
+            execute(batch, limiter, retries)
+
+    for message_id, raw in raw_messages.items():
+        raw_messages[message_id] = decode_raw(raw)
+    for message_id in failed_ids:
+        raw_messages[message_id] = get_message(service, message_id, limiter, retries)
+
+    return [raw_messages[message_id] for message_id in message_ids]
+
+
+def decode_raw(raw):
+    """
+    Decode a message as the Gmail API sends it, in URL-safe base64, to its raw bytes.
+    """
+    with STAGE_SECONDS.time("decode"):
+        msg_bytes = base64.urlsafe_b64decode(raw.encode("ASCII"))
+    STAGE_BYTES.inc(len(msg_bytes), "decode")
+    return msg_bytes
+
+
+def write_raw_email(message_id, msg_str, config, store=None):
+    """
+    Write a raw message to disk, as an eml file or into the packed store, and
+    return the path of the file holding it.
+    """
+    STAGE_BYTES.inc(len(msg_str), "write_raw")
+    with STAGE_SECONDS.time("write_raw"):
+        if (store or RAW_STORE) == "packed":
+            raw_email_path = get_packed_store(config.RAW_EMAIL_DIR).put(message_id, msg_str)
+        else:
+            raw_email_path = os.path.join(config.RAW_EMAIL_DIR, raw_email_filename(message_id))
+            with open(raw_email_path, "wb") as f:
+                f.write(msg_str)
+    print(f"\nRetrieving message {message_id} into {os.path.basename(raw_email_path)}.")
+    return raw_email_path
+
+
+def read_raw_email(message_id, config):
+    """
+    Return a saved raw message from either storage backend, or None.
+    """
+    raw_email_path = os.path.join(config.RAW_EMAIL_DIR, raw_email_filename(message_id))
+    if os.path.exists(raw_email_path):
+        with open(raw_email_path, "rb") as f:
+            return f.read()
+    if not has_packed_store(config.RAW_EMAIL_DIR):
+        return None
+    return get_packed_store(config.RAW_EMAIL_DIR).get(message_id)
+
+
+def iter_raw_emails(config):
+    """
+    Yield (message_id, raw email) for every saved message, loose files first.
+    """
+    raw_dir = config.RAW_EMAIL_DIR
+    loose_ids = set()
+    with os.scandir(raw_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith("email_") and entry.name.endswith(".eml"):
+                message_id = entry.name[len("email_") : -len(".eml")]
+                loose_ids.add(message_id)
+                with open(entry.path, "rb") as f:
+                    yield message_id, f.read()
+
+    if not has_packed_store(raw_dir):
+        return
+    store = get_packed_store(raw_dir)
+    for message_id in store.message_ids():
+        if message_id not in loose_ids:
+            yield message_id, store.get(message_id)
+
+
+def reclean_emails(config, processes=CLEAN_PROCESSES):
+    """
+    Clean every saved raw email again, e.g. after the cleaning code changes.
+    Return the number of messages cleaned.
+    """
+    metadata = clean_emails(iter_raw_emails(config), config, processes=processes)
+    get_catalog(config).add([catalog_record(item) for item in metadata])
+    return len(metadata)
+
+
+def raw_email_filename(message_id):
+    return f"email_{message_id}.eml"
+
+
+def parse_email(raw_email, parser=None):
+    """
+    Parse a raw email held in memory, as bytes or a memoryview, without copying it to bytes.
+    Line breaks are translated to \n, as when clean_email reads an eml file, so
+    Gmail's CRLF messages are cleaned the same from memory as from a path.
+    """
+    # This is what BytesParser.parsebytes does, but str() also accepts a memoryview
+    text = str(raw_email, "ASCII", "surrogateescape")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return parse_text(text, parser)
+
+
+def parse_text(text, parser=None):
+    """
+    Parse an email decoded as the email package decodes it, lazily unless parser is "full".
+    """
+    if (parser or PARSER) == "lazy":
+        msg = parse_lazily(text)
+        if msg is not None:
+            return msg
+    return Parser(policy=policy.default).parsestr(text)
+
+
+def clean_emails(raw_emails, config, processes=CLEAN_PROCESSES):
+    """
+    Clean many emails, given as (message_id, raw email) pairs, and return their metadata in order.
+    If processes is more than 1, the emails are cleaned by a pool of worker processes.
+    """
+    if processes <= 1:
+        return [
+            clean_email_with_metadata(raw_email, config, message_id)
+            for message_id, raw_email in raw_emails
+        ]
+
+    raw_emails = list(raw_emails)
+    if not raw_emails:
+        return []
+
+    message_ids, raw_emails = zip(*raw_emails)
+    clean_dirs = [get_clean_dirs(config)] * len(message_ids)
+    with new_clean_pool(processes) as pool:
+        # Chunks keep the per-task pickling overhead down for small emails
+        return list(
+            pool.map(clean_email_task, raw_emails, clean_dirs, message_ids, chunksize=8)
+        )
+
+
+def new_clean_pool(processes):
+    """
+    Start a pool of processes for cleaning emails.
+    """
+    # Forking a process that is running threads can deadlock, so workers start fresh
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+def get_clean_dirs(config):
+    """
+    Pick out the directories clean_email writes to, and the settings it cleans
+    with, so they can be sent to worker processes.
+    """
+    return {
+        "CLEAN_EMAIL_DIR": config.CLEAN_EMAIL_DIR,
+        "ATTACHMENTS_DIR": config.ATTACHMENTS_DIR,
+        **{name: getattr(config, name, None) for name in CLEAN_SETTINGS},
+    }
+
+
+def fetch_options(config):
+    """
+    Return the fetch_emails arguments the config sets, e.g. from GFETCH_* variables.
+    Settings the config leaves out or sets to None keep their defaults.
+    """
+    return {
+        name.lower(): getattr(config, name)
+        for name in FETCH_SETTINGS
+        if getattr(config, name, None) is not None
+    }
+
+
+def clean_email_task(raw_email, clean_dirs, message_id):
+    """
+    Clean an email in a worker process and return its metadata.
+    """
+    return clean_email_with_metadata(raw_email, SimpleNamespace(**clean_dirs), message_id)
+
+
+def clean_email(raw_email, config, message_id):
+    """
+    Take a raw email, clean and save it as a txt file, and save any attachments.
+    The raw email can be the path of an eml file, or its contents as bytes or a memoryview.
+    """
+    attachments = clean_email_with_metadata(raw_email, config, message_id)["attachments"]
+
+    if attachments:
+        return len(attachments)
+
+
+def clean_email_with_metadata(raw_email, config, message_id):
+    """
+    Clean an email like clean_email, and return a dict describing the message and its files.
+    """
+    parser = getattr(config, "PARSER", None)
+    with STAGE_SECONDS.time("parse"):
+        if isinstance(raw_email, (bytes, bytearray, memoryview)):
+            raw_file = raw_email_filename(message_id)
+            msg = parse_email(raw_email, parser)
+        else:
+            raw_file = os.path.basename(raw_email)
+            # Read as BytesParser.parse reads a file, translating line breaks to \n
+            with open(raw_email, encoding="ASCII", errors="surrogateescape") as f:
+                msg = parse_text(f.read(), parser)
+
+    print(f"Cleaning email {raw_file}.")
     clean_dir = config.CLEAN_EMAIL_DIR
     attachments_dir = config.ATTACHMENTS_DIR
 
-    with open(email_file, "rb") as f:
-        msg = BytesParser(policy=policy.default).parse(f)
-
-    raw_file = email_file.split("/")[-1]
     date = set_date(msg["Date"])
     subject = msg["Subject"]
     formatted_subject = format_subject(msg["Subject"])
     to = msg["To"]
     from_ = msg["From"]
-    attachments = get_attachments(msg, attachments_dir)
+    addresses = get_addresses(msg)
+    store = getattr(config, "ATTACHMENT_STORE", None) or ATTACHMENT_STORE
+    links = getattr(config, "ATTACHMENT_LINKS", None)
+    # Which blobs the message uses is only known with the blob store
+    digests = [] if store == "blobs" else None
+    with STAGE_SECONDS.time("get_attachments"):
+        attachments = get_attachments(
+            msg, attachments_dir, message_id, store=store, links=links, digests=digests
+        )
     # body = clean_body(get_body(msg))
     body = get_body(msg)
 
@@ -119,11 +955,40 @@ def clean_email(email_file, config, message_id):
     )
 
     email_filename = os.path.join(clean_dir, f"{date}__{formatted_subject}__{message_id}.txt")
-    with open(email_filename, "w", encoding="utf-8") as f:
-        f.write(email_content)
+    with STAGE_SECONDS.time("write_clean"):
+        with open(email_filename, "w", encoding="utf-8") as f:
+            f.write(email_content)
+            STAGE_BYTES.inc(f.tell(), "write_clean")
 
-    if attachments:
-        return len(attachments)
+    # Headers are converted to plain strings so the metadata can be pickled and stored
+    return {
+        "message_id": message_id,
+        "raw_file": raw_file,
+        "clean_file": email_filename,
+        "date": date,
+        "subject": None if subject is None else str(subject),
+        "to": None if to is None else str(to),
+        "from": None if from_ is None else str(from_),
+        "attachments": attachments,
+        "blobs": digests,
+        "body": body,
+        "addresses": addresses,
+    }
+
+
+def get_addresses(msg):
+    """
+    Return the lowercased addresses a message was sent from and to.
+    """
+    values = [str(value) for header in ADDRESS_HEADERS for value in msg.get_all(header, [])]
+    return sorted(header_addresses(values))
+
+
+def header_addresses(values):
+    """
+    Return the set of lowercased addresses in address header values.
+    """
+    return {address.lower() for _, address in email.utils.getaddresses(values) if address}
 
 
 def set_date(date_str):
@@ -176,11 +1041,16 @@ def format_subject(subject_str):
     return "".join(subj_list)
 
 
-def get_attachments(msg, attachments_dir):
+def get_attachments(msg, attachments_dir, message_id=None, store=None, links=None, digests=None):
     """
     Download any attachments to the email and return a list of them.
+    With the blob store, identical attachments are only written once, and the
+    message's filenames are mapped to their blobs. If digests is a list, the
+    digests of the message's blobs are added to it.
     """
+    store = store or ATTACHMENT_STORE
     attachments = []
+    blobs = []
 
     if not msg.is_multipart():
         return attachments
@@ -191,13 +1061,107 @@ def get_attachments(msg, attachments_dir):
         filename = part.get_filename()
         print(f"Found attachment: {filename}")
         attachments.append(filename)
+        if store == "blobs" and message_id:
+            digest, new = store_blob(attachments_dir, lambda part=part: iter_payload(part))
+            if new:
+                size = os.path.getsize(blob_path(attachments_dir, digest))
+                STAGE_BYTES.inc(size, "get_attachments")
+            blobs.append((filename, digest))
+            continue
         filepath = os.path.join(attachments_dir, filename)
         with open(filepath, "wb") as attachment_file:
-            attachment_file.write(part.get_payload(decode=True))
+            for chunk in iter_payload(part):
+                attachment_file.write(chunk)
+            STAGE_BYTES.inc(attachment_file.tell(), "get_attachments")
+
+    if blobs:
+        save_message_blobs(attachments_dir, message_id, blobs)
+        if digests is not None:
+            digests.extend(dict.fromkeys(digest for _, digest in blobs))
+        link_message_blobs(attachments_dir, message_id, blobs, links or ATTACHMENT_LINKS)
 
     return attachments
 
 
+def iter_payload(part, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Yield the decoded payload of a part piece by piece, as get_payload(decode=True)
+    would return it, so a large attachment is never held decoded in memory at once.
+    """
+    # get_payload() encodes the whole text once just to look for surrogates, so
+    # read the payload directly; iter_quoted_printable handles surrogates itself
+    payload = part._payload
+    encoding = str(part.get("content-transfer-encoding", "")).lower()
+    if part.is_multipart() or not isinstance(payload, str):
+        yield part.get_payload(decode=True) or b""
+    elif encoding == "base64" and is_well_formed_base64(payload, chunk_size):
+        yield from iter_base64(payload, chunk_size)
+    elif encoding == "quoted-printable":
+        yield from iter_quoted_printable(payload, chunk_size)
+    else:
+        # Including broken base64, which the email package decodes as a whole
+        yield part.get_payload(decode=True) or b""
+
+
+def is_well_formed_base64(text, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Check whether iter_base64 decodes text as the email package would: only
+    line breaks besides base64 characters, no padding but at the end, and a
+    length that padding can complete. The email package decodes anything else
+    with fallbacks that only work on the whole text.
+    """
+    if not text.isascii():
+        return False
+    end = text.find("=")
+    if end == -1:
+        end = len(text)
+    elif not BASE64_PADDING.fullmatch(text, end):
+        return False
+    # Checked a piece at a time, so the text is never copied whole
+    for start in range(0, end, chunk_size):
+        piece = text[start : min(start + chunk_size, end)].encode("ascii")
+        if piece.translate(None, BASE64_LINES):
+            return False
+    length = len(text) - text.count("\n") - text.count("\r")
+    if end < len(text):
+        return length % 4 == 0
+    return length % 4 != 1
+
+
+def iter_base64(text, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Decode well-formed base64 text, as is_well_formed_base64 checks for, in
+    pieces, each a whole number of 4-character groups.
+    """
+    leftover = ""
+    for start in range(0, len(text), chunk_size):
+        piece = leftover + NOT_BASE64.sub("", text[start : start + chunk_size])
+        usable = len(piece) - len(piece) % 4
+        if usable:
+            yield binascii.a2b_base64(piece[:usable])
+        leftover = piece[usable:]
+    if leftover:
+        # Like the email package, make up for missing padding at the end
+        yield binascii.a2b_base64(leftover + "=" * (-len(leftover) % 4))
+
+
+def iter_quoted_printable(text, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Decode quoted-printable text in pieces that end at line breaks.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + chunk_size)
+        end = len(text) if end == -1 else end + 1
+        piece = text[start:end]
+        try:
+            yield quopri.decodestring(piece.encode("ascii", "surrogateescape"))
+        except UnicodeError:
+            # As the email package does for non-ASCII text
+            yield quopri.decodestring(piece.encode("raw-unicode-escape"))
+        start = end
+
+
 def get_body(msg):
     """
     Get and return the message body as a string.
@@ -216,6 +1180,9 @@ def get_body(msg):
             plain_text = part.get_payload(decode=True).decode(charset, errors="replace")
             break  
 
+    # HTML-only messages with attachments have no text/plain part at all
+    if plain_text is None:
+        return "This email has no text in the body."
     return plain_text.split("\nOn ")[0] or "This email has no text in the body."
 
 # def clean_body(body):
@@ -239,4 +1206,16 @@ def build_email_content(raw_file, date, subject, to, from_, attachments, body):
             email_content += f"- {attachment}\n"
 
     email_content += f"\n{body}"
-    return email_content    
\ No newline at end of file
+    return email_content    
+
+
+if __name__ == "__main__":
+    # Clean every saved raw email again: python src/app/emails.py reclean
+    import sys
+
+    from app import create_app
+
+    if sys.argv[1:] != ["reclean"]:
+        sys.exit("usage: python src/app/emails.py reclean")
+    app = create_app()
+    print(f"Recleaned {reclean_emails(app.dir_config)} emails")
@@ -0,0 +1,407 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import threading
+import time
+import uuid
+
+from deletion import delete_everything, delete_messages
+from emails import fetch_emails, fetch_options
+from metrics import JOBS_FINISHED, JOBS_IN_FLIGHT, serve_metrics
+from profiling import profile_path, profiled
+
+QUEUE_KEY = "gfetch:jobs:queue"
+JOB_KEY_PREFIX = "gfetch:job:"
+# Finished jobs are kept around for a week so their status can still be read
+JOB_TTL = 7 * 24 * 60 * 60
+COUNTERS = (
+    "pages_listed",
+    "messages_listed",
+    "messages_fetched",
+    "messages_cleaned",
+    "attachments_saved",
+)
+DELETE_COUNTERS = ("messages_selected", "messages_deleted")
+FINISHED = ("done", "failed", "cancelled")
+# How often a running job checks whether anyone is streaming its events
+LISTENER_CHECK_INTERVAL = 1.0
+# Events sent for every message, which only update the counters kept in memory;
+# the others, such as fetch_emails' once a second "stages", also save them to redis
+PER_MESSAGE_EVENTS = ("fetched", "cleaned")
+
+_workers = []
+_workers_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a running fetch to stop it once its job has been cancelled.
+    """
+
+
+class JobProgress:
+    """
+    Progress hook for fetch_emails and delete_messages that keeps a job's counters
+    in redis and publishes events for anyone streaming them.
+    The counters are kept in memory and saved, and the job checked for being
+    cancelled, on every event but the per-message ones, so a message costs no
+    trip to redis unless someone is streaming the job's events.
+    The rate and time left are worked out from the done and total counters.
+    """
+
+    def __init__(
+        self,
+        redis,
+        job_id,
+        counters=COUNTERS,
+        done="messages_cleaned",
+        total="messages_listed",
+    ):
+        self.redis = redis
+        self.key = job_key(job_id)
+        self.channel = events_channel(job_id)
+        self.counts = dict.fromkeys(counters, 0)
+        self.done = done
+        self.total = total
+        self.started = time.monotonic()
+        self.listening = False
+        self.listeners_checked = 0.0
+        # fetch_emails calls the hook from its worker threads
+        self.lock = threading.Lock()
+
+    def __call__(self, event, **data):
+        with self.lock:
+            increments = {}
+            if event == "page":
+                increments = {"pages_listed": 1, "messages_listed": data["messages"]}
+            elif event == "fetched":
+                increments = {"messages_fetched": 1}
+            elif event == "cleaned":
+                increments = {"messages_cleaned": 1}
+                if data["attachments"]:
+                    increments["attachments_saved"] = data["attachments"]
+            elif event == "selected":
+                increments = {"messages_selected": data["messages"]}
+            elif event == "deleted":
+                increments = {"messages_deleted": data["messages"]}
+            for counter, amount in increments.items():
+                self.counts[counter] += amount
+
+            if self.is_listened_to():
+                self.redis.publish(self.channel, json.dumps(self.event(event, **data)))
+            if event in PER_MESSAGE_EVENTS:
+                return
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hget(self.key, "cancel_requested")
+            pipe.hset(self.key, mapping=self.counts)
+            if event == "stages":
+                pipe.hset(self.key, "stages", json.dumps(data["stages"]))
+            cancel_requested = pipe.execute()[0]
+
+        if cancel_requested == b"1":
+            raise JobCancelled()
+
+    def is_listened_to(self):
+        """
+        Check for subscribers at most once per interval, so events cost nothing
+        when no one is streaming them.
+        """
+        now = time.monotonic()
+        if now - self.listeners_checked >= LISTENER_CHECK_INTERVAL:
+            self.listeners_checked = now
+            self.listening = self.redis.pubsub_numsub(self.channel)[0][1] > 0
+        return self.listening
+
+    def event(self, event, **data):
+        """
+        Build an event with the current counters, throughput and estimated time left.
+        """
+        elapsed = time.monotonic() - self.started
+        done = self.counts[self.done]
+        rate = done / elapsed if elapsed else 0.0
+        remaining = self.counts[self.total] - done
+        return {
+            "event": event,
+            **data,
+            **self.counts,
+            "rate": round(rate, 2),
+            # Only covers messages listed so far, since listing runs alongside fetching
+            "eta": round(remaining / rate, 1) if rate else None,
+        }
+
+    def finish(self, status):
+        """
+        Save the final counters, and tell anyone streaming the job that it has finished.
+        """
+        self.redis.hset(self.key, mapping=self.counts)
+        self.redis.publish(
+            self.channel, json.dumps({**self.event("finished"), "status": status})
+        )
+
+
+def job_key(job_id):
+    return f"{JOB_KEY_PREFIX}{job_id}"
+
+
+def events_channel(job_id):
+    return f"{job_key(job_id)}:events"
+
+
+def enqueue_fetch(redis, email_address, incremental=False, resume=False, profile=False):
+    """
+    Queue a fetch of all emails from a given email address, or a list of them,
+    and return its job id. If profile is set, the fetch is run under a profiler.
+    """
+    if not isinstance(email_address, str):
+        email_address = ", ".join(email_address)
+    job_id = uuid.uuid4().hex
+    redis.hset(
+        job_key(job_id),
+        mapping={
+            "status": "queued",
+            "kind": "fetch",
+            "email_address": email_address,
+            "incremental": int(incremental),
+            "resume": int(resume),
+            "profile": int(profile),
+            "created": time.time(),
+            "errors": "[]",
+            **{counter: 0 for counter in COUNTERS},
+        },
+    )
+    redis.lpush(QUEUE_KEY, job_id)
+    return job_id
+
+
+def enqueue_delete(
+    redis, correspondent=None, date_from=None, date_to=None, message_ids=None
+):
+    """
+    Queue a deletion of the saved messages matching all of the given filters
+    and return its job id. With no filters, every saved file is deleted.
+    """
+    job_id = uuid.uuid4().hex
+    redis.hset(
+        job_key(job_id),
+        mapping={
+            "status": "queued",
+            "kind": "delete",
+            "scope": json.dumps(
+                {
+                    "correspondent": correspondent,
+                    "date_from": date_from,
+                    "date_to": date_to,
+                    "message_ids": message_ids,
+                }
+            ),
+            "created": time.time(),
+            "errors": "[]",
+            **{counter: 0 for counter in DELETE_COUNTERS},
+        },
+    )
+    redis.lpush(QUEUE_KEY, job_id)
+    return job_id
+
+
+def get_job(redis, job_id):
+    """
+    Return the status and progress of a job, or None if there is no such job.
+    """
+    fields = redis.hgetall(job_key(job_id))
+    if not fields:
+        return None
+
+    job = {key.decode(): value.decode() for key, value in fields.items()}
+    for counter in (
+        *COUNTERS,
+        *DELETE_COUNTERS,
+        "total_messages",
+        "total_attachments",
+        "deleted_messages",
+        "deleted_attachments",
+    ):
+        if counter in job:
+            job[counter] = int(job[counter])
+    job["id"] = job_id
+    # Jobs queued before deletions were added are all fetches
+    job["kind"] = job.get("kind", "fetch")
+    if job["kind"] == "fetch":
+        job["incremental"] = job["incremental"] == "1"
+        job["resume"] = job.get("resume") == "1"
+    else:
+        job["scope"] = json.loads(job["scope"])
+    job["profile"] = job.get("profile") == "1"
+    job["cancel_requested"] = job.get("cancel_requested") == "1"
+    job["errors"] = json.loads(job["errors"])
+    job["stages"] = json.loads(job.get("stages", "{}"))
+    return job
+
+
+def cancel_job(redis, job_id):
+    """
+    Ask a job to stop. Return False if there is no such job.
+    """
+    key = job_key(job_id)
+    if not redis.exists(key):
+        return False
+
+    redis.hset(key, "cancel_requested", 1)
+    # A job still in the queue is skipped by the worker when it comes up
+    if redis.hget(key, "status") == b"queued":
+        redis.hset(key, "status", "cancelled")
+        redis.publish(
+            events_channel(job_id),
+            json.dumps({"event": "finished", "status": "cancelled"}),
+        )
+    return True
+
+
+def run_job(redis, job_id, config):
+    """
+    Run a queued fetch or delete job, recording its progress and result in redis.
+    """
+    key = job_key(job_id)
+    job = get_job(redis, job_id)
+    if not job or job["status"] != "queued":
+        return
+
+    redis.hset(key, mapping={"status": "running", "started": time.time()})
+    if job["kind"] == "delete":
+        progress = JobProgress(
+            redis, job_id, DELETE_COUNTERS, done="messages_deleted", total="messages_selected"
+        )
+    else:
+        progress = JobProgress(redis, job_id)
+
+    profiler = (
+        profiled(profile_path(config, job_id)) if job["profile"] else contextlib.nullcontext()
+    )
+    JOBS_IN_FLIGHT.inc(1, job["kind"])
+    try:
+        with profiler:
+            if job["kind"] == "delete" and any(job["scope"].values()):
+                result = delete_messages(config, **job["scope"], progress=progress)
+            elif job["kind"] == "delete":
+                result = delete_everything(config, progress=progress)
+            else:
+                result = fetch_emails(
+                    job["email_address"],
+                    config,
+                    incremental=job["incremental"],
+                    resume=job["resume"],
+                    progress=progress,
+                    **fetch_options(config),
+                )
+    except JobCancelled:
+        print(f"Job {job_id} cancelled.")
+        status = {"status": "cancelled"}
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        status = {"status": "failed", "errors": json.dumps([str(e)])}
+    else:
+        if "error" in result:
+            status = {"status": "failed", "errors": json.dumps([result["error"]])}
+        else:
+            status = {"status": "done", **result}
+    finally:
+        JOBS_IN_FLIGHT.dec(1, job["kind"])
+    JOBS_FINISHED.inc(1, job["kind"], status["status"])
+
+    redis.hset(key, mapping={**status, "finished": time.time()})
+    redis.expire(key, JOB_TTL)
+    progress.finish(status["status"])
+
+
+def stream_job_events(redis, job_id, keepalive=15):
+    """
+    Yield a job's progress as server-sent events until it finishes.
+    """
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the job, so no event falls in between
+    pubsub.subscribe(events_channel(job_id))
+    try:
+        job = get_job(redis, job_id)
+        yield f"event: status\ndata: {json.dumps(job)}\n\n"
+        if not job or job["status"] in FINISHED:
+            return
+
+        last_sent = time.monotonic()
+        while True:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None:
+                # A comment line keeps proxies from closing an idle stream
+                if time.monotonic() - last_sent >= keepalive:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+                continue
+            last_sent = time.monotonic()
+            data = message["data"].decode()
+            yield f"data: {data}\n\n"
+            if json.loads(data)["event"] == "finished":
+                return
+    finally:
+        pubsub.close()
+
+
+def run_next_job(redis, config, timeout=1):
+    """
+    Wait up to timeout seconds for a queued job and run it. Return its id, if any.
+    """
+    item = redis.brpop(QUEUE_KEY, timeout=timeout)
+    if not item:
+        return None
+
+    job_id = item[1].decode()
+    run_job(redis, job_id, config)
+    return job_id
+
+
+def run_worker(redis, config):
+    """
+    Run queued jobs forever.
+    """
+    while True:
+        try:
+            run_next_job(redis, config, timeout=5)
+        except Exception as e:
+            print(f"Error running job: {e}")
+            time.sleep(1)
+
+
+def start_workers(redis, config, count):
+    """
+    Start count worker threads in this process, unless they are already running.
+    """
+    with _workers_lock:
+        while len(_workers) < count:
+            worker = threading.Thread(
+                target=run_worker, args=(redis, config), daemon=True
+            )
+            worker.start()
+            _workers.append(worker)
+
+
+if __name__ == "__main__":
+    # Run a dedicated worker process: python src/app/jobs.py
+    from app import create_app
+
+    app = create_app()
+    if app.config["METRICS_PORT"]:
+        serve_metrics(app.config["METRICS_PORT"])
+    run_worker(app.redis, app.dir_config)
@@ -0,0 +1,140 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Parsing an email's MIME structure without reading it line by line.
+
+The email package's parser feeds every line of a message, attachments and all,
+through Python code, testing each against the boundaries of every multipart it
+is in. Here the boundaries are found with str.find, only header blocks go
+through the email package, and each part's payload is the undecoded slice of
+text between its headers and the next boundary. The tree of EmailMessage objects
+is the same as the email package's, with what cleaning uses of it: headers,
+structure and payloads, though not preambles, epilogues or defects. Payloads are
+only decoded when asked for, as before.
+
+Anything the email package would handle as a special or broken case, such as
+message/* parts, digests, missing boundaries or bare carriage returns, is left
+to it: parse_lazily returns None.
+"""
+
+import re
+from email import policy
+from email.parser import Parser
+
+# A blank line, which ends a header block
+HEADER_END = re.compile(r"^\r?\n", re.MULTILINE)
+
+
+class NotSimple(Exception):
+    """
+    Raised inside parse_lazily when a message needs the email package's parser.
+    """
+
+
+def parse_lazily(text):
+    """
+    Parse an email, decoded from ASCII with surrogateescape as the email package
+    does, into the same EmailMessage tree as Parser(policy=policy.default) would,
+    or return None if it is unusual enough to be left to that parser.
+    """
+    # The email package also ends lines at a lone \r, which str.find can't follow
+    if text.count("\r") != text.count("\r\n"):
+        return None
+    try:
+        return parse_part(text, 0, len(text), top=True)
+    except NotSimple:
+        return None
+
+
+def parse_part(text, start, end, top=False):
+    """
+    Parse the part of text from start to end, a message if top is set.
+    """
+    blank_line = HEADER_END.search(text, start, end)
+    if blank_line is None:
+        raise NotSimple("no blank line after the headers")
+    body_start = blank_line.end()
+    part = Parser(policy=policy.default).parsestr(text[start:body_start], headersonly=True)
+    # Anything but header lines before the blank line leaves defects or a payload
+    if part.defects or part.get_payload():
+        raise NotSimple("malformed headers")
+
+    maintype = part.get_content_maintype()
+    if maintype == "message":
+        raise NotSimple("message/* part")
+    if maintype != "multipart":
+        body = text[body_start:end]
+        # The line break before a boundary belongs to the boundary
+        if not top and body.endswith("\n"):
+            body = body[:-2] if body.endswith("\r\n") else body[:-1]
+        part.set_payload(body)
+        return part
+
+    # Parts of a digest default to message/rfc822
+    if part.get_content_subtype() == "digest":
+        raise NotSimple("digest")
+    boundary = part.get_boundary()
+    if boundary is None:
+        raise NotSimple("multipart without a boundary")
+    part.set_payload(
+        [
+            parse_part(text, part_start, part_end)
+            for part_start, part_end in part_spans(text, body_start, end, boundary)
+        ]
+    )
+    return part
+
+
+def part_spans(text, start, end, boundary):
+    """
+    Return where each part of a multipart body starts and ends, from the line
+    after one boundary line to the start of the next.
+    """
+    delimiter = f"--{boundary}"
+    # As the email package matches a boundary line, with any whitespace after it
+    boundary_line = re.compile(re.escape(delimiter) + r"(--)?[ \t]*\r?(?:\n|\Z)")
+    spans = []
+    part_start = None
+    for line_start in delimiter_lines(text, start, end, delimiter):
+        match = boundary_line.match(text, line_start, end)
+        if match is None:
+            continue
+        if part_start is not None:
+            # The email package skips repeated boundary lines
+            if line_start == part_start:
+                raise NotSimple("repeated boundary")
+            spans.append((part_start, line_start))
+        if match.group(1):
+            if not spans:
+                raise NotSimple("multipart without parts")
+            return spans
+        part_start = match.end()
+    raise NotSimple("no closing boundary")
+
+
+def delimiter_lines(text, start, end, delimiter):
+    """
+    Yield the start of every line from start to end beginning with the delimiter.
+    """
+    if text.startswith(delimiter, start, end):
+        yield start
+    delimiter = f"\n{delimiter}"
+    index = text.find(delimiter, start, end)
+    while index != -1:
+        yield index + 1
+        index = text.find(delimiter, index + 1, end)
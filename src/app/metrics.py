@@ -0,0 +1,209 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Counters and histograms of how long each step of a fetch takes, kept in memory
+and shown in Prometheus' text format.
+
+Recording a value takes a lock and a few additions, so metrics are always on.
+Each process keeps its own: cleaning in worker processes is only timed as a
+whole, and a separate job worker serves its metrics on GFETCH_METRICS_PORT.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds, from a parsed header to a slow batch
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+
+
+class Metric:
+    """
+    A named metric with a value for each combination of its labels' values.
+    Label values are given positionally, in the order of labelnames.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def label_text(self, labels, extra=()):
+        pairs = [*zip(self.labelnames, labels), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(str(value))}"' for name, value in pairs) + "}"
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield from self.samples(labels, value)
+
+    def samples(self, labels, value):
+        yield f"{self.name}{self.label_text(labels)} {format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values by bucket, with their sum.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # A count for each bucket, one for larger values, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], value[:-1]):
+            cumulative += count
+            le = bound if bound == "+Inf" else format_value(bound)
+            yield f"{self.name}_bucket{self.label_text(labels, [('le', le)])} {cumulative}"
+        yield f"{self.name}_sum{self.label_text(labels)} {format_value(value[-1])}"
+        yield f"{self.name}_count{self.label_text(labels)} {cumulative}"
+
+
+class Timer:
+    """
+    Context manager observing how long its block took.
+    """
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_metrics():
+    """
+    Return every metric in Prometheus' text exposition format.
+    """
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+def reset_metrics():
+    for metric in _metrics:
+        with metric.lock:
+            metric.values.clear()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("content-type", CONTENT_TYPE)
+        self.send_header("content-length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    """
+    Serve the metrics of this process from a background thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+STAGE_SECONDS = Histogram(
+    "gfetch_stage_seconds",
+    "Time spent in each step of fetching and cleaning messages.",
+    ("stage",),
+)
+STAGE_BYTES = Counter(
+    "gfetch_stage_bytes_total",
+    "Bytes produced by each step of fetching and cleaning messages.",
+    ("stage",),
+)
+API_ERRORS = Counter(
+    "gfetch_api_errors_total",
+    "Gmail API requests that failed, by HTTP status or exception.",
+    ("status",),
+)
+API_RETRIES = Counter("gfetch_api_retries_total", "Gmail API requests retried.")
+API_THROTTLED = Counter(
+    "gfetch_api_throttled_total", "Gmail API requests Gmail turned away for going over quota."
+)
+JOBS_IN_FLIGHT = Gauge("gfetch_jobs_in_flight", "Jobs running in this process.", ("kind",))
+JOBS_FINISHED = Counter(
+    "gfetch_jobs_finished_total", "Jobs finished in this process, by outcome.", ("kind", "status")
+)
@@ -0,0 +1,189 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import time
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+class Stage:
+    """
+    One step of a pipeline: a function run by worker threads that read from a bounded queue.
+    The function takes one item and returns an iterable of items for the next stage.
+    If ordered is set, a stage with several workers passes its results on in input order.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=None, ordered=False):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue(maxsize=queue_size or 2 * self.workers)
+        self.ordered = ordered
+        self.processed = 0
+        self.busy = 0.0
+        self.running = self.workers
+        self.lock = threading.Lock()
+        self.take_lock = threading.Lock()
+        # For ordered stages: results waiting for an earlier item, keyed by input number
+        self.pending = {}
+        self.next_in = 0
+        self.next_out = 0
+        # Stops an ordered stage from running too far ahead of a slow item
+        self.window = threading.BoundedSemaphore(self.queue.maxsize + self.workers)
+
+    def stats(self, elapsed):
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "processed": self.processed,
+            "per_sec": round(self.processed / elapsed, 2) if elapsed else 0.0,
+            # Share of the workers' time spent working rather than waiting
+            "utilization": round(self.busy / (elapsed * self.workers), 3) if elapsed else 0.0,
+        }
+
+
+class Pipeline:
+    """
+    Run a source iterable through a series of stages connected by bounded queues.
+    A full queue blocks the stage feeding it, so memory use stays bounded.
+    """
+
+    def __init__(self, name, source, stages):
+        self.source = Stage(name, None)
+        self.source_iterable = source
+        self.stages = stages
+        self.error = None
+        self.stopped = threading.Event()
+        self.started = None
+
+    def run(self, on_stats=None, stats_interval=1.0):
+        """
+        Run the pipeline to the end, calling on_stats(stats) every stats_interval seconds.
+        Re-raise the first exception raised by any stage.
+        """
+        self.started = time.monotonic()
+        threads = [threading.Thread(target=self.feed, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            threads += [
+                threading.Thread(target=self.work, args=(stage, following), daemon=True)
+                for _ in range(stage.workers)
+            ]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(stats_interval)
+                if on_stats and thread.is_alive():
+                    self.report(on_stats)
+        if on_stats:
+            self.report(on_stats)
+
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """
+        Return the queue depth, throughput and utilization of each stage.
+        """
+        elapsed = time.monotonic() - self.started
+        return {
+            stage.name: stage.stats(elapsed) for stage in (self.source, *self.stages)
+        }
+
+    def report(self, on_stats):
+        try:
+            on_stats(self.stats())
+        except Exception as e:
+            self.stop(e)
+
+    def stop(self, error):
+        with self.source.lock:
+            if self.error is None:
+                self.error = error
+        self.stopped.set()
+
+    def feed(self):
+        first = self.stages[0]
+        items = iter(self.source_iterable)
+        try:
+            while not self.stopped.is_set():
+                start = time.monotonic()
+                item = next(items, DONE)
+                self.source.busy += time.monotonic() - start
+                if item is DONE:
+                    break
+                self.source.processed += 1
+                first.queue.put(item)
+        except Exception as e:
+            self.stop(e)
+        first.queue.put(DONE)
+
+    def work(self, stage, following):
+        while True:
+            if stage.ordered:
+                stage.window.acquire()
+            with stage.take_lock:
+                # Taking the number and the item together keeps them in step
+                item = stage.queue.get()
+                number = stage.next_in
+                stage.next_in += 1
+
+            if item is DONE:
+                if stage.ordered:
+                    stage.window.release()
+                # Let the other workers see it too; the last one out tells the next stage
+                stage.queue.put(DONE)
+                with stage.lock:
+                    stage.running -= 1
+                    last = stage.running == 0
+                if last and following:
+                    following.queue.put(DONE)
+                return
+
+            results = []
+            if not self.stopped.is_set():
+                start = time.monotonic()
+                try:
+                    results = list(stage.func(item))
+                except Exception as e:
+                    self.stop(e)
+                    results = []
+                with stage.lock:
+                    stage.processed += 1
+                    stage.busy += time.monotonic() - start
+
+            if stage.ordered:
+                self.release_in_order(stage, following, number, results)
+            elif following:
+                for result in results:
+                    following.queue.put(result)
+
+    def release_in_order(self, stage, following, number, results):
+        with stage.lock:
+            stage.pending[number] = results
+            while stage.next_out in stage.pending:
+                for result in stage.pending.pop(stage.next_out):
+                    if following:
+                        following.queue.put(result)
+                stage.next_out += 1
+                stage.window.release()
@@ -0,0 +1,88 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Profiling a job on request, to find out why one correspondent's fetch is slow.
+
+Since Python 3.12, cProfile sees every thread of the process, so a profile of
+a fetch includes its download, clean and write threads, but also anything else
+the process did meanwhile. Only one profiler can run at a time, so a job asking
+for a profile while another is being profiled runs without one.
+"""
+
+import contextlib
+import cProfile
+import os
+import pstats
+import threading
+
+# Functions listed in a profile's text summary
+SUMMARY_LINES = 50
+
+_profiler_lock = threading.Lock()
+
+
+def profiles_dir(config):
+    """
+    Return where profiles are saved: the config's PROFILES_DIR, or by default a
+    profiles directory in the raw email directory.
+    """
+    return getattr(config, "PROFILES_DIR", None) or os.path.join(config.RAW_EMAIL_DIR, "profiles")
+
+
+def profile_path(config, name):
+    """
+    Return the path of a saved profile, in pstats format. Its text summary is
+    saved alongside, with a .txt suffix.
+    """
+    return os.path.join(profiles_dir(config), f"{name}.prof")
+
+
+def summary_path(path):
+    return f"{os.path.splitext(path)[0]}.txt"
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """
+    Profile the block with cProfile and save the profile to path, along with a
+    summary of the functions taking the longest, counting what they call.
+    Yield whether the block is being profiled.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        print("Another job is being profiled, so this one won't be.")
+        yield False
+        return
+
+    try:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield True
+        finally:
+            profile.disable()
+            save_profile(profile, path)
+    finally:
+        _profiler_lock.release()
+
+
+def save_profile(profile, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profile.dump_stats(path)
+    with open(summary_path(path), "w", encoding="utf-8") as f:
+        pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(SUMMARY_LINES)
+    print(f"Saved profile to {path}.")
@@ -0,0 +1,219 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sqlite3
+import threading
+import zlib
+
+PACKS_DIR = "packs"
+INDEX_FILENAME = "index.sqlite3"
+# A new segment is started once the current one reaches this size
+SEGMENT_SIZE = 256 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class PackedRawStore:
+    """
+    Raw emails packed into append-only segment files, each message compressed on its own.
+    An SQLite index maps every message id to its segment, offset and length, so one
+    message can be read without touching the others.
+    """
+
+    def __init__(self, raw_dir):
+        self.dir = os.path.join(raw_dir, PACKS_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        # Transactions are managed here, and SQLite's own locking keeps processes
+        # sharing the store from appending to a segment at the same time
+        self.db = sqlite3.connect(
+            os.path.join(self.dir, INDEX_FILENAME),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id TEXT PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_segment ON messages (segment)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS state (segment INTEGER)")
+        self.lock = threading.Lock()
+
+    def segment_path(self, segment):
+        return os.path.join(self.dir, f"segment_{segment:06d}.pack")
+
+    def put(self, message_id, raw_email):
+        """
+        Append a compressed message to the current segment and index it, and
+        return the segment's path. A message id already stored keeps its copy, as a
+        Gmail message never changes, and nothing is appended for it.
+        """
+        data = zlib.compress(raw_email, COMPRESSION_LEVEL)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT segment FROM messages WHERE message_id = ?", (message_id,)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute("COMMIT")
+                    return self.segment_path(row[0])
+                segment = self.current_segment()
+                with open(self.segment_path(segment), "ab") as f:
+                    offset = f.tell()
+                    f.write(data)
+                # Bytes left behind by a crash before this point are never indexed
+                self.db.execute(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?)",
+                    (message_id, segment, offset, len(data)),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return self.segment_path(segment)
+
+    def current_segment(self):
+        row = self.db.execute("SELECT segment FROM state").fetchone()
+        if row is None:
+            segment = 1
+            self.db.execute("INSERT INTO state VALUES (?)", (segment,))
+        else:
+            segment = row[0]
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_SIZE:
+            segment += 1
+            self.db.execute("UPDATE state SET segment = ?", (segment,))
+        return segment
+
+    def get(self, message_id):
+        """
+        Return a message's raw bytes, or None if it isn't stored.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT segment, offset, length FROM messages WHERE message_id = ?",
+                (message_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def __contains__(self, message_id):
+        with self.lock:
+            return (
+                self.db.execute(
+                    "SELECT 1 FROM messages WHERE message_id = ?", (message_id,)
+                ).fetchone()
+                is not None
+            )
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def message_ids(self):
+        """
+        Return the stored message ids, in the order they are laid out on disk.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT message_id FROM messages ORDER BY segment, offset"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, message_ids):
+        """
+        Remove messages from the index, and any segment left holding none of them.
+        Return how many were removed.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                segments = set()
+                deleted = 0
+                for message_id in message_ids:
+                    row = self.db.execute(
+                        "DELETE FROM messages WHERE message_id = ? RETURNING segment",
+                        (message_id,),
+                    ).fetchone()
+                    if row:
+                        segments.add(row[0])
+                        deleted += 1
+                current = self.db.execute("SELECT segment FROM state").fetchone()
+                empty = [
+                    segment
+                    for segment in segments
+                    if (current is None or segment != current[0])
+                    and not self.db.execute(
+                        "SELECT 1 FROM messages WHERE segment = ? LIMIT 1", (segment,)
+                    ).fetchone()
+                ]
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+        for segment in empty:
+            os.remove(self.segment_path(segment))
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def has_packed_store(raw_dir):
+    return os.path.isdir(os.path.join(raw_dir, PACKS_DIR))
+
+
+def get_packed_store(raw_dir):
+    """
+    Return the packed store for a raw dir, opening it the first time.
+    """
+    key = os.path.abspath(raw_dir)
+    with _stores_lock:
+        # Reopen a store whose files were removed behind its back
+        if key not in _stores or not has_packed_store(raw_dir):
+            _stores[key] = PackedRawStore(raw_dir)
+        return _stores[key]
+
+
+def remove_packed_store(raw_dir):
+    """
+    Close and delete a raw dir's packed store. Return how many messages it held.
+    """
+    key = os.path.abspath(raw_dir)
+    with _stores_lock:
+        store = _stores.pop(key, None)
+    if not has_packed_store(raw_dir):
+        return 0
+
+    store = store or PackedRawStore(raw_dir)
+    count = len(store)
+    store.close()
+    shutil.rmtree(os.path.join(raw_dir, PACKS_DIR))
+    return count
@@ -0,0 +1,211 @@
+# gfetch -- save gmail emails locally
+# Copyright (C) 2024 Jeff Jacobson <jeffjacobsonhimself@gmail.com>
+#
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# googleapiclient is imported where its errors are caught, so the app starts without it
+from metrics import API_ERRORS, API_RETRIES, API_THROTTLED
+
+RETRIES = 6
+# Backoff doubles from BACKOFF_BASE seconds with each retry, up to BACKOFF_CAP
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 64.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Gmail answers some quota errors with 403 rather than 429
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# Throttling of requests in flight together counts as one signal to slow down
+DECREASE_INTERVAL = 1.0
+
+
+class AdaptiveLimiter:
+    """
+    Limit the number of Gmail requests in flight.
+    The limit is halved when Gmail throttles a request and raised by one after
+    as many successes in a row as the limit, so it settles just below the quota.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(maximum, 1)
+        self.minimum = min(minimum, self.maximum)
+        self.limit = self.maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot and for any pause to end.
+        """
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, throttled):
+        """
+        Adjust the limit after a request succeeded or was throttled.
+        """
+        with self.condition:
+            if throttled:
+                self.throttles += 1
+                self.successes = 0
+                now = time.monotonic()
+                if now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Hold back every request for the given number of seconds.
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        return {"limit": self.limit, "throttles": self.throttles, "retries": self.retries}
+
+
+def execute(request, limiter=None, retries=RETRIES):
+    """
+    Execute a Gmail API request, retrying throttled and failed requests with
+    exponential backoff and jitter, or as long as Gmail asks with Retry-After.
+    """
+    from googleapiclient.errors import HttpError
+
+    limiter = limiter or AdaptiveLimiter(1)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = request.execute()
+        except (HttpError, ConnectionError, TimeoutError) as e:
+            limiter.release()
+            API_ERRORS.inc(1, error_status(e))
+            throttled = is_throttled(e)
+            if throttled:
+                API_THROTTLED.inc()
+                limiter.record(throttled=True)
+            if attempt >= retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt)
+            print(f"Request failed ({e}), retrying in {delay:.1f} seconds.")
+            with limiter.condition:
+                limiter.retries += 1
+            API_RETRIES.inc()
+            if throttled:
+                # The quota is shared, so every request waits
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+        else:
+            limiter.release()
+            limiter.record(throttled=False)
+            return result
+
+
+def is_throttled(error):
+    """
+    Check whether an error means Gmail wants fewer requests.
+    """
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and bool(error_reasons(error) & RATE_LIMIT_REASONS))
+
+
+def error_status(error):
+    """
+    Return the HTTP status of a failed request, or the name of the error if it had none.
+    """
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+def is_retryable(error):
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(error, HttpError):
+        return True
+    return error.resp.status in RETRY_STATUSES or is_throttled(error)
+
+
+def error_reasons(error):
+    try:
+        details = json.loads(error.content)["error"]["errors"]
+        return {detail.get("reason") for detail in details}
+    except (ValueError, KeyError, TypeError):
+        return set()
+
+
+def retry_delay(error, attempt):
+    """
+    Return how long to wait before retrying: as long as Retry-After asks,
+    or a random time up to an exponentially growing cap ("full jitter").
+    """
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def get_retry_after(error):
+    """
+    Return the seconds asked for by a Retry-After header, or None.
+    """
+    response = getattr(error, "resp", None)
+    value = response.get("retry-after") if response is not None else None
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
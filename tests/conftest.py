@@ -1,4 +1,5 @@
 import pytest
+
 from app import app
 
 
@@ -116,3 +117,43 @@ def temp_files_only_raw(temp_dirs):
     (temp_dirs["raw_email_dir"] / "email2.eml").touch()
 
     return temp_dirs
+
+
+@pytest.fixture
+def fake_mailbox(monkeypatch):
+    """
+    Point fetch_emails at an in-memory Gmail mailbox of 120 messages.
+    """
+    from fake_gmail import FakeMailbox, make_message
+
+    mailbox = FakeMailbox(
+        [(f"{number:016x}", make_message(number, attachments=number % 3)) for number in range(120)],
+        page_size=50,
+    )
+    monkeypatch.setattr("emails.get_credentials", lambda: object())
+    monkeypatch.setattr("emails.build_service", mailbox.build)
+    return mailbox
+
+
+@pytest.fixture
+def fetch_dirs(monkeypatch, temp_dirs):
+    """
+    Point the app's dir config at the temp directories.
+    """
+    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", temp_dirs["attachments_dir"])
+    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", temp_dirs["clean_email_dir"])
+    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", temp_dirs["raw_email_dir"])
+    return temp_dirs
+
+
+@pytest.fixture
+def job_redis(monkeypatch):
+    """
+    Give the app a fake redis for jobs, with no worker threads so tests run jobs themselves.
+    """
+    import fakeredis
+
+    redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(app, "redis", redis)
+    monkeypatch.setitem(app.config, "JOB_WORKERS", 0)
+    return redis
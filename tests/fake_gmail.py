@@ -0,0 +1,236 @@
+"""
+A local stand-in for the Gmail API, used to test fetch_emails without Google credentials.
+"""
+
+import base64
+import json
+import re
+from email.message import EmailMessage
+from email.parser import BytesParser
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.discovery import build
+
+
+def make_message(
+    number,
+    attachments=0,
+    to="Will Jakobson <will@jmail.com>",
+    from_="Stu Bettler <stu@bmail.com>",
+):
+    """
+    Build the raw bytes of a simple numbered test email.
+    """
+    msg = EmailMessage()
+    msg["Date"] = f"Mon, {number % 28 + 1:02d} Jan 2024 10:00:00 +0000"
+    msg["Subject"] = f"Message {number}"
+    msg["To"] = to
+    msg["From"] = from_
+    msg.set_content(f"This is message number {number}.\n")
+    for i in range(attachments):
+        msg.add_attachment(
+            f"attachment {i} of message {number}".encode(),
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"file_{number}_{i}.bin",
+        )
+    return bytes(msg)
+
+
+class FakeMailbox:
+    """
+    An in-memory mailbox that answers Gmail API requests.
+    """
+
+    def __init__(self, messages, page_size=100):
+        self.messages = dict(messages)
+        self.page_size = page_size
+        self.history_id = 1000
+        # Oldest history id Gmail still remembers, and (history id, message id) records
+        self.oldest_history_id = self.history_id
+        self.history = []
+        # Message ids whose next request inside a batch should fail
+        self.flaky_ids = set()
+        # Requests left to turn away, and the status and Retry-After to answer them with
+        self.throttled_requests = 0
+        self.throttle_status = 429
+        self.retry_after = None
+        self.requests = []
+        # Messages not listed here are alone in their thread
+        self.thread_ids = {}
+        # Gmail labels of messages, such as SPAM; searches leave out spam and trash
+        self.labels = {}
+
+    def handle(self, method, uri, body=None, headers=None):
+        """
+        Dispatch a request and return (status, headers, body).
+        """
+        parsed = urlparse(uri)
+        path = parsed.path
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        self.requests.append((method, path))
+
+        if self.throttled_requests:
+            self.throttled_requests -= 1
+            status, headers, content = self.error(
+                self.throttle_status, "Rate Limit Exceeded", reason="rateLimitExceeded"
+            )
+            if self.retry_after is not None:
+                headers["retry-after"] = str(self.retry_after)
+            return status, headers, content
+        if path.startswith("/batch"):
+            return self.batch(body, headers)
+        if path.endswith("/profile"):
+            return self.json({"emailAddress": "me@gmail.com", "historyId": str(self.history_id)})
+        if path.endswith("/history"):
+            return self.list_history(params)
+        if path.endswith("/messages"):
+            return self.list_messages(params)
+        if "/messages/" in path and params.get("format") == "metadata":
+            return self.get_metadata(path.rsplit("/", 1)[-1])
+        if "/messages/" in path:
+            return self.get_message(path.rsplit("/", 1)[-1])
+        return self.error(404, "Not Found")
+
+    def throttle(self, requests, status=429, retry_after=None):
+        """
+        Turn away the next requests, including calls inside batches, as Gmail does
+        when a quota is used up.
+        """
+        self.throttled_requests = requests
+        self.throttle_status = status
+        self.retry_after = retry_after
+
+    def add_message(self, message_id, raw):
+        """
+        Deliver a new message, which Gmail lists ahead of older ones.
+        """
+        self.messages = {message_id: raw, **self.messages}
+        self.history_id += 1
+        self.history.append((self.history_id, message_id))
+
+    def list_history(self, params):
+        start = int(params["startHistoryId"])
+        if start < self.oldest_history_id:
+            return self.error(404, "Requested entity was not found.")
+        records = [
+            {"id": str(history_id), "messagesAdded": [{"message": {"id": message_id}}]}
+            for history_id, message_id in self.history
+            if history_id > start
+        ]
+        return self.json({"history": records, "historyId": str(self.history_id)})
+
+    def list_messages(self, params):
+        # Searches for to:<address> or from:<address> match either header, which is close enough
+        addresses = re.findall(r"(?:to|from):(\S+)", params.get("q", ""))
+        message_ids = [
+            message_id
+            for message_id, raw in self.messages.items()
+            if not {"SPAM", "TRASH"} & set(self.labels.get(message_id, []))
+            and (not addresses or any(address in self.headers(raw) for address in addresses))
+        ]
+        start = int(params.get("pageToken", 0))
+        end = start + int(params.get("maxResults", self.page_size))
+        page = {
+            "messages": [
+                {"id": message_id, "threadId": self.thread_ids.get(message_id, message_id)}
+                for message_id in message_ids[start:end]
+            ]
+        }
+        if end < len(message_ids):
+            page["nextPageToken"] = str(end)
+        return self.json(page)
+
+    @staticmethod
+    def headers(raw):
+        return raw.split(b"\n\n", 1)[0].decode().lower()
+
+    def get_message(self, message_id):
+        if message_id not in self.messages:
+            return self.error(404, "Requested entity was not found.")
+        raw = base64.urlsafe_b64encode(self.messages[message_id]).decode("ASCII")
+        return self.json({"id": message_id, "raw": raw})
+
+    def get_metadata(self, message_id):
+        if message_id not in self.messages:
+            return self.error(404, "Requested entity was not found.")
+        msg = BytesParser().parsebytes(self.messages[message_id], headersonly=True)
+        return self.json(
+            {
+                "id": message_id,
+                "threadId": self.thread_ids.get(message_id, message_id),
+                "labelIds": self.labels.get(message_id, ["INBOX"]),
+                "payload": {
+                    "headers": [
+                        {"name": name, "value": value}
+                        for name, value in msg.items()
+                        if name in ("From", "To", "Cc", "Bcc")
+                    ]
+                },
+            }
+        )
+
+    def batch(self, body, headers):
+        content_type = headers["content-type"]
+        request = BytesParser().parsebytes(
+            f"content-type: {content_type}\r\n\r\n".encode() + body.encode()
+        )
+        boundary = "fake_batch_boundary"
+        parts = []
+        for part in request.get_payload():
+            request_line = part.get_payload().split("\n", 1)[0]
+            method, path, _ = request_line.split(" ", 2)
+            message_id = urlparse(path).path.rsplit("/", 1)[-1]
+            if message_id in self.flaky_ids:
+                self.flaky_ids.discard(message_id)
+                self.requests.append((method, urlparse(path).path))
+                status, _, content = self.error(500, "Backend Error")
+            else:
+                status, _, content = self.handle(method, path)
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                f"{content.decode()}\r\n"
+            )
+        parts.append(f"--{boundary}--")
+        return (
+            200,
+            {"content-type": f'multipart/mixed; boundary="{boundary}"'},
+            "".join(parts).encode(),
+        )
+
+    def json(self, data, status=200):
+        return status, {"content-type": "application/json"}, json.dumps(data).encode()
+
+    def error(self, status, message, reason=None):
+        error = {"code": status, "message": message}
+        if reason:
+            error["errors"] = [{"reason": reason, "message": message}]
+        return self.json({"error": error}, status)
+
+    def http(self):
+        return FakeHttp(self)
+
+    def build(self, *args, **kwargs):
+        """
+        Stand-in for googleapiclient.discovery.build that talks to this mailbox.
+        """
+        return build("gmail", "v1", http=self.http(), static_discovery=True)
+
+
+class FakeHttp:
+    """
+    An httplib2.Http replacement that sends requests to a FakeMailbox.
+    """
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        status, response_headers, content = self.mailbox.handle(
+            method, uri, body, headers
+        )
+        return httplib2.Response({"status": status, **response_headers}), content
@@ -0,0 +1,73 @@
+import hashlib
+import os
+
+import pytest
+from blobs import (
+    blob_path,
+    count_blobs,
+    link_message_blobs,
+    load_message_blobs,
+    safe_filename,
+    store_blob,
+)
+from emails import clean_email
+from fake_gmail import make_message
+
+from app import app
+
+
+def test_store_blob_dedups(tmp_path):
+    data = b"the same pdf, forwarded again"
+
+    first = store_blob(tmp_path, data)
+    second = store_blob(tmp_path, data)
+    digest = hashlib.sha256(data).hexdigest()
+
+    assert first == (digest, True)
+    assert second == (digest, False)
+    assert blob_path(tmp_path, digest) == os.path.join(
+        tmp_path, "blobs", digest[:2], digest[2:4], digest
+    )
+    assert open(blob_path(tmp_path, digest), "rb").read() == data
+    assert count_blobs(tmp_path) == 1
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "symlink"])
+def test_link_message_blobs(tmp_path, mode):
+    first, _ = store_blob(tmp_path, b"first")
+    second, _ = store_blob(tmp_path, b"second")
+
+    links = link_message_blobs(
+        tmp_path, "abc", [("image001.png", first), ("image001.png", second)], mode
+    )
+
+    assert [os.path.basename(link) for link in links] == ["image001.png", "image001 (2).png"]
+    assert [open(link, "rb").read() for link in links] == [b"first", b"second"]
+
+
+def test_safe_filename():
+    assert safe_filename("../../etc/passwd") == "passwd"
+    assert safe_filename("C:\\Users\\report.pdf") == "report.pdf"
+    assert safe_filename("..") == "attachment"
+
+
+def test_clean_email_blob_store(monkeypatch, temp_dirs):
+    attachments_dir = temp_dirs["attachments_dir"]
+    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
+    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", temp_dirs["clean_email_dir"])
+    monkeypatch.setattr("emails.ATTACHMENT_STORE", "blobs")
+    monkeypatch.setattr("emails.ATTACHMENT_LINKS", "hardlink")
+    raw_email = make_message(7, attachments=2)
+
+    # The same message saved twice, as when it is forwarded with its attachments
+    assert clean_email(raw_email, app.dir_config, "first") == 2
+    assert clean_email(raw_email, app.dir_config, "second") == 2
+
+    assert count_blobs(attachments_dir) == 2
+    assert load_message_blobs(attachments_dir, "first") == load_message_blobs(
+        attachments_dir, "second"
+    )
+    assert sorted(os.listdir(attachments_dir / "second")) == ["file_7_0.bin", "file_7_1.bin"]
+    assert (attachments_dir / "second" / "file_7_0.bin").read_bytes() == (
+        b"attachment 0 of message 7"
+    )
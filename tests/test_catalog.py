@@ -0,0 +1,188 @@
+import os
+
+from blobs import save_message_blobs
+from catalog import Catalog, get_catalog
+from emails import fetch_emails
+
+from app import app
+
+
+def add_messages(catalog):
+    catalog.add(
+        [
+            {
+                "message_id": f"{number:04d}",
+                "correspondent": "stu@bmail.com" if number % 2 else "biff@email.com",
+                "date": f"{2022 + number % 3}-01-{number % 28 + 1:02d}",
+                "sender": "Stu Bettler <stu@bmail.com>",
+                "recipient": "Will Jakobson <will@jmail.com>",
+                "subject": f"Message {number}",
+                "size": number * 10,
+                "attachments": [f"file_{number}.pdf"] if number % 5 == 0 else [],
+            }
+            for number in range(30)
+        ]
+    )
+
+
+def test_catalog_browse(tmp_path):
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    add_messages(catalog)
+
+    result = catalog.browse(per_page=10, sort="size", order="asc")
+
+    assert result["total"] == 30
+    assert result["pages"] == 3
+    assert [message["size"] for message in result["messages"]] == list(range(0, 100, 10))
+    assert result["messages"][0]["attachments"] == ["file_0.pdf"]
+    assert result["messages"][0]["from"] == "Stu Bettler <stu@bmail.com>"
+
+    last_page = catalog.browse(page=3, per_page=10, sort="size", order="asc")
+    assert [message["size"] for message in last_page["messages"]] == list(range(200, 300, 10))
+
+
+def test_catalog_filters(tmp_path):
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    add_messages(catalog)
+
+    result = catalog.browse(
+        correspondent="Stu@bmail.com", date_from="2023-01-01", date_to="2023-12-31"
+    )
+
+    # Odd numbers n with n % 3 == 1: 1, 7, 13, 19, 25
+    assert result["total"] == 5
+    assert {message["date"][:4] for message in result["messages"]} == {"2023"}
+
+
+def test_catalog_update_keeps_fields(tmp_path):
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    add_messages(catalog)
+
+    catalog.add([{"message_id": "0003", "subject": "Recleaned", "attachments": []}])
+    message = [m for m in catalog.browse(per_page=200)["messages"] if m["message_id"] == "0003"][0]
+
+    assert message["subject"] == "Recleaned"
+    assert message["correspondent"] == "stu@bmail.com"
+    assert message["size"] == 30
+
+
+def test_catalog_blobs(tmp_path):
+    # Blobs stored before the catalog kept track of them are read from the maps once
+    save_message_blobs(tmp_path, "old", [("a.pdf", "aaaa"), ("b.pdf", "bbbb")])
+    catalog = Catalog(tmp_path / "catalog.sqlite3", tmp_path)
+
+    catalog.add([{"message_id": "new", "attachments": ["b.pdf"], "blobs": ["bbbb"]}])
+    assert catalog.unused_blobs({"aaaa", "bbbb", "cccc"}) == {"cccc"}
+
+    catalog.delete(["old"])
+    assert catalog.unused_blobs({"aaaa", "bbbb"}) == {"aaaa"}
+    # Cleaning a message again replaces the blobs it uses
+    catalog.add([{"message_id": "new", "attachments": [], "blobs": []}])
+    assert catalog.unused_blobs({"bbbb"}) == {"bbbb"}
+
+
+def test_fetch_emails_fills_catalog(fake_mailbox, fetch_dirs):
+    fake_mailbox.thread_ids = {message_id: "thread" for message_id in fake_mailbox.messages}
+
+    fetch_emails("Stu@bmail.com", app.dir_config)
+    result = get_catalog(app.dir_config).browse(correspondent="stu@bmail.com", per_page=200)
+    message = result["messages"][0]
+
+    assert result["total"] == 120
+    assert message["thread_id"] == "thread"
+    assert message["size"] == len(fake_mailbox.messages[message["message_id"]])
+    assert os.path.exists(message["raw_file"])
+    assert os.path.exists(message["clean_file"])
+
+
+def test_messages_route(test_client, fetch_dirs):
+    add_messages(get_catalog(app.dir_config))
+
+    response = test_client.get("/messages?per_page=5&page=2&sort=subject&order=asc")
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert data["total"] == 30
+    assert [message["subject"] for message in data["messages"]] == [
+        "Message 13",
+        "Message 14",
+        "Message 15",
+        "Message 16",
+        "Message 17",
+    ]
+    assert test_client.get("/messages?sort=bogus").status_code == 400
+
+
+def test_catalog_search(tmp_path):
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    catalog.add(
+        [
+            {
+                "message_id": "poem",
+                "correspondent": "stu@bmail.com",
+                "sender": "Stu Bettler <stu@bmail.com>",
+                "subject": "Revisions",
+                "attachments": [],
+                "body": "Here is the latest draft of the poem about the pumping station.",
+            },
+            {
+                "message_id": "barn",
+                "correspondent": "stu@bmail.com",
+                "sender": "Stu Bettler <stu@bmail.com>",
+                "subject": "The poem",
+                "attachments": [],
+                "body": "The barn one is better.",
+            },
+        ]
+    )
+
+    result = catalog.search("poem")
+
+    assert result["total"] == 2
+    # A match in the subject ranks above one in the body
+    assert [message["message_id"] for message in result["messages"]] == ["barn", "poem"]
+    assert "[poem]" in result["messages"][1]["snippet"]
+    assert catalog.search("pump*")["total"] == 1
+    assert catalog.search("bettler barn")["total"] == 1
+    assert catalog.search('"unbalanced (quote')["total"] == 0
+
+    # Cleaning a message again replaces what was indexed for it
+    catalog.add([{"message_id": "barn", "attachments": [], "body": "Nothing to see."}])
+    assert catalog.search("barn")["total"] == 0
+    assert catalog.search("see")["messages"][0]["subject"] == "The poem"
+
+
+def test_catalog_search_ranks_newest_matches(tmp_path, monkeypatch):
+    monkeypatch.setattr("catalog.MAX_RANKED", 5)
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    catalog.add(
+        [
+            {"message_id": f"m{number}", "attachments": [], "body": f"report {number}"}
+            for number in range(12)
+        ]
+    )
+
+    first = catalog.search("report", per_page=2)
+    last = catalog.search("report", page=3, per_page=2)
+
+    assert (first["total"], first["ranked"], first["pages"]) == (12, 5, 3)
+    assert len(last["messages"]) == 1
+    found = {
+        message["message_id"]
+        for page in (1, 2, 3)
+        for message in catalog.search("report", page=page, per_page=2)["messages"]
+    }
+    assert found == {"m7", "m8", "m9", "m10", "m11"}
+
+
+def test_search_route(fake_mailbox, fetch_dirs, test_client):
+    fetch_emails("stu@bmail.com", app.dir_config)
+
+    response = test_client.get("/search?q=number 42&per_page=5")
+    data = response.get_json()
+
+    assert response.status_code == 200
+    assert data["total"] == 1
+    assert data["messages"][0]["subject"] == "Message 42"
+    assert "[42]" in data["messages"][0]["snippet"]
+    assert test_client.get("/search?q=").get_json()["total"] == 0
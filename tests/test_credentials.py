@@ -1,2 +1,103 @@
-def test_get_credentials():
-    pass
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import auth
+import fakeredis
+import pytest
+from google.oauth2.credentials import Credentials
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@pytest.fixture
+def token_file(tmp_path, monkeypatch):
+    """
+    A token file for credentials that expire in a minute, with a counted fake refresh.
+    """
+    token = tmp_path / "token.json"
+    creds = Credentials(
+        "old-token",
+        refresh_token="refresh",
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id="id",
+        client_secret="secret",
+        expiry=utcnow() + timedelta(minutes=1),
+    )
+    token.write_text(creds.to_json())
+    monkeypatch.setattr(auth, "TOKEN", str(token))
+    monkeypatch.setattr(auth, "SCOPES", None)
+    monkeypatch.setattr(auth, "_shared_redis", None)
+    auth.clear_cached_credentials()
+
+    refreshes = []
+
+    def refresh(self, request):
+        # Slow enough for other threads to pile up behind the lock
+        time.sleep(0.05)
+        refreshes.append(self)
+        self.token = f"new-token-{len(refreshes)}"
+        self.expiry = utcnow() + timedelta(hours=1)
+
+    monkeypatch.setattr(Credentials, "refresh", refresh)
+    yield token, refreshes
+    auth.clear_cached_credentials()
+
+
+def test_get_credentials(token_file):
+    token, refreshes = token_file
+
+    creds = auth.get_credentials()
+
+    # The token was still valid, but close enough to expiry to refresh early
+    assert creds.token == "new-token-1"
+    assert len(refreshes) == 1
+    assert json.loads(token.read_text())["token"] == "new-token-1"
+    assert not token.with_name("token.json.tmp").exists()
+
+
+def test_get_credentials_cached(token_file):
+    token, refreshes = token_file
+
+    first = auth.get_credentials()
+    token.unlink()
+    second = auth.get_credentials()
+
+    assert second is first
+    assert len(refreshes) == 1
+
+
+def test_get_credentials_refreshes_once(token_file):
+    _, refreshes = token_file
+    results = []
+
+    threads = [
+        threading.Thread(target=lambda: results.append(auth.get_credentials()))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(refreshes) == 1
+    assert {creds.token for creds in results} == {"new-token-1"}
+
+
+def test_get_credentials_shared(token_file, monkeypatch):
+    token, refreshes = token_file
+    redis = fakeredis.FakeRedis()
+    auth.share_credentials(redis)
+
+    auth.get_credentials()
+    # Another process starts with an empty cache and no token file of its own
+    auth.clear_cached_credentials()
+    token.unlink()
+    creds = auth.get_credentials()
+
+    assert creds.token == "new-token-1"
+    assert len(refreshes) == 1
+    assert json.loads(redis.get(auth.SHARED_TOKEN_KEY))["token"] == "new-token-1"
@@ -1,13 +1,28 @@
 import os
+from urllib.parse import parse_qs, urlparse
+
+from blobs import (
+    blob_path,
+    count_blobs,
+    link_message_blobs,
+    load_message_blobs,
+    map_path,
+    store_blob,
+)
+from catalog import get_catalog
+from deletion import delete_messages
+from emails import MANIFEST_SUFFIX, fetch_emails, load_manifest
+from fake_gmail import make_message
+from jobs import get_job, run_next_job
+from rawstore import get_packed_store
 
 from app import app
 
 
-def test_delete_files_empty_dirs(test_client, monkeypatch, temp_dirs):
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", temp_dirs["attachments_dir"])
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", temp_dirs["clean_email_dir"])
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", temp_dirs["raw_email_dir"])
-
+def delete_all(test_client, job_redis):
+    """
+    Delete every file through the route, run the job it starts and return the job.
+    """
     response = test_client.post("/delete/")
 
     assert response.status_code == 302
@@ -15,185 +30,232 @@ def test_delete_files_empty_dirs(test_client, monkeypatch, temp_dirs):
         messages = [
             message[1] for message in session["_flashes"] if message[0] == "message"
         ]
-        assert "No attachments found." in messages
-        assert "No cleaned emails found." in messages
-        assert "No raw emails found." in messages
+        assert "Started deleting every saved file." in messages
+    job_id = parse_qs(urlparse(response.location).query)["job"][0]
+    run_next_job(job_redis, app.dir_config)
+    job = get_job(job_redis, job_id)
+    assert job["status"] == "done"
+    return job
 
 
-def test_delete_files_all_dirs(test_client, monkeypatch, temp_files_all):
-    temp_files = temp_files_all
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+def test_delete_files_empty_dirs(test_client, job_redis, fetch_dirs, capsys):
+    job = delete_all(test_client, job_redis)
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
+    output = capsys.readouterr().out
+    assert "No attachments found." in output
+    assert "No cleaned emails found." in output
+    assert "No raw emails found." in output
+    assert job["deleted_messages"] == job["deleted_attachments"] == 0
 
-    response = test_client.post("/delete/")
 
-    assert response.status_code == 302
+def test_delete_files_all_dirs(test_client, job_redis, fetch_dirs, temp_files_all):
+    job = delete_all(test_client, job_redis)
 
-    assert not os.listdir(attachments_dir)
-    assert not os.listdir(clean_email_dir)
-    assert not os.listdir(raw_email_dir)
-
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "Deleted 2 emails and 2 attachments." in messages
+    assert not os.listdir(fetch_dirs["attachments_dir"])
+    assert not os.listdir(fetch_dirs["clean_email_dir"])
+    assert not os.listdir(fetch_dirs["raw_email_dir"])
+    assert job["deleted_messages"] == job["deleted_attachments"] == 2
+    assert job["messages_deleted"] == job["messages_selected"] == 2
 
 
 def test_delete_files_no_attachments(
-    test_client, monkeypatch, temp_files_no_attachments
+    test_client, job_redis, fetch_dirs, temp_files_no_attachments, capsys
 ):
-    temp_files = temp_files_no_attachments
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+    job = delete_all(test_client, job_redis)
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
+    assert not os.listdir(fetch_dirs["clean_email_dir"])
+    assert not os.listdir(fetch_dirs["raw_email_dir"])
+    assert "No attachments found." in capsys.readouterr().out
+    assert (job["deleted_messages"], job["deleted_attachments"]) == (2, 0)
 
-    response = test_client.post("/delete/")
 
-    assert response.status_code == 302
+def test_delete_files_no_clean(
+    test_client, job_redis, fetch_dirs, temp_files_no_clean, capsys
+):
+    job = delete_all(test_client, job_redis)
 
-    assert not os.listdir(clean_email_dir)
-    assert not os.listdir(raw_email_dir)
+    assert not os.listdir(fetch_dirs["attachments_dir"])
+    assert not os.listdir(fetch_dirs["raw_email_dir"])
+    assert "No cleaned emails found." in capsys.readouterr().out
+    assert job["deleted_messages"] == job["deleted_attachments"] == 2
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No attachments found." in messages
-        assert "Deleted 2 emails." in messages
 
+def test_delete_files_no_raw(test_client, job_redis, fetch_dirs, temp_files_no_raw, capsys):
+    job = delete_all(test_client, job_redis)
 
-def test_delete_files_no_clean(test_client, monkeypatch, temp_files_no_clean):
-    temp_files = temp_files_no_clean
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+    assert not os.listdir(fetch_dirs["attachments_dir"])
+    assert not os.listdir(fetch_dirs["clean_email_dir"])
+    assert "No raw emails found." in capsys.readouterr().out
+    assert job["deleted_messages"] == job["deleted_attachments"] == 2
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
 
-    response = test_client.post("/delete/")
+def test_delete_files_only_attachments(
+    test_client, job_redis, fetch_dirs, temp_files_only_attachments, capsys
+):
+    job = delete_all(test_client, job_redis)
 
-    assert response.status_code == 302
+    assert not os.listdir(fetch_dirs["attachments_dir"])
+    output = capsys.readouterr().out
+    assert "No raw emails found." in output
+    assert "No cleaned emails found." in output
+    assert (job["deleted_messages"], job["deleted_attachments"]) == (0, 2)
 
-    assert not os.listdir(attachments_dir)
-    assert not os.listdir(raw_email_dir)
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No cleaned emails found." in messages
-        assert "Deleted 2 emails and 2 attachments." in messages
+def test_delete_files_only_clean(
+    test_client, job_redis, fetch_dirs, temp_files_only_clean, capsys
+):
+    job = delete_all(test_client, job_redis)
 
+    assert not os.listdir(fetch_dirs["clean_email_dir"])
+    output = capsys.readouterr().out
+    assert "No raw emails found." in output
+    assert "No attachments found." in output
+    assert (job["deleted_messages"], job["deleted_attachments"]) == (2, 0)
 
-def test_delete_files_no_raw(test_client, monkeypatch, temp_files_no_raw):
-    temp_files = temp_files_no_raw
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
+def test_delete_files_only_raw(
+    test_client, job_redis, fetch_dirs, temp_files_only_raw, capsys
+):
+    job = delete_all(test_client, job_redis)
 
-    response = test_client.post("/delete/")
+    assert not os.listdir(fetch_dirs["raw_email_dir"])
+    output = capsys.readouterr().out
+    assert "No cleaned emails found." in output
+    assert "No attachments found." in output
+    assert (job["deleted_messages"], job["deleted_attachments"]) == (2, 0)
 
-    assert response.status_code == 302
+
+def test_delete_files_removes_manifests(test_client, job_redis, fetch_dirs, temp_files_all):
+    raw_email_dir = fetch_dirs["raw_email_dir"]
+    (raw_email_dir / "biff@email.com.manifest.json").write_text("{}")
+
+    delete_all(test_client, job_redis)
+
+    assert not os.listdir(raw_email_dir)
+
+
+def test_delete_files_blob_store(test_client, job_redis, fetch_dirs):
+    attachments_dir = fetch_dirs["attachments_dir"]
+    digest, _ = store_blob(attachments_dir, b"attachment")
+    link_message_blobs(attachments_dir, "abc", [("file.pdf", digest)], "symlink")
+
+    job = delete_all(test_client, job_redis)
 
     assert not os.listdir(attachments_dir)
-    assert not os.listdir(clean_email_dir)
+    assert job["deleted_attachments"] == 1
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No raw emails found." in messages
-        assert "Deleted 2 emails and 2 attachments." in messages
 
+def test_delete_files_packed_raw_emails(test_client, job_redis, fetch_dirs):
+    raw_dir = fetch_dirs["raw_email_dir"]
+    get_packed_store(raw_dir).put("abc", b"raw email")
 
-def test_delete_files_only_attachments(
-    test_client, monkeypatch, temp_files_only_attachments
-):
-    temp_files = temp_files_only_attachments
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+    job = delete_all(test_client, job_redis)
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
+    assert not os.listdir(raw_dir)
+    assert job["deleted_messages"] == job["messages_deleted"] == 1
 
-    response = test_client.post("/delete/")
 
-    assert response.status_code == 302
+def saved_files(directory, suffix):
+    return [name for name in os.listdir(directory) if name.endswith(suffix)]
 
-    assert not os.listdir(attachments_dir)
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No raw emails found." in messages
-        assert "No cleaned emails found." in messages
-        assert "Deleted 2 attachments." in messages
+def test_delete_messages_by_date(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
 
+    result = delete_messages(app.dir_config, date_from="2024-01-01", date_to="2024-01-07")
 
-def test_delete_files_only_clean(test_client, monkeypatch, temp_files_only_clean):
-    temp_files = temp_files_only_clean
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+    # Messages n with n % 28 < 7 are dated January 1st to 7th
+    assert result["deleted_messages"] == 35
+    assert get_catalog(app.dir_config).browse()["total"] == 85
+    assert len(saved_files(fetch_dirs["raw_email_dir"], ".eml")) == 85
+    assert len(saved_files(fetch_dirs["clean_email_dir"], ".txt")) == 85
+    assert len(load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")["message_ids"]) == 85
+    assert not os.path.exists(fetch_dirs["attachments_dir"] / "file_1_0.bin")
+    assert os.path.exists(fetch_dirs["attachments_dir"] / "file_7_0.bin")
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
 
-    response = test_client.post("/delete/")
+def test_delete_messages_from_stores(fake_mailbox, fetch_dirs, monkeypatch):
+    monkeypatch.setattr("emails.ATTACHMENT_STORE", "blobs")
+    fetch_emails("stu@bmail.com", app.dir_config, raw_store="packed")
+    attachments_dir = fetch_dirs["attachments_dir"]
+    message_ids = [f"{number:016x}" for number in range(1, 4)]
 
-    assert response.status_code == 302
+    result = delete_messages(app.dir_config, message_ids=message_ids)
 
-    assert not os.listdir(clean_email_dir)
+    assert result == {"deleted_messages": 3, "deleted_attachments": 3}
+    assert len(get_packed_store(fetch_dirs["raw_email_dir"])) == 117
+    assert count_blobs(attachments_dir) == 117
+    assert not load_message_blobs(attachments_dir, message_ids[0])
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No raw emails found." in messages
-        assert "No attachments found." in messages
-        assert "Deleted 2 emails." in messages
 
+def test_delete_route_starts_job(test_client, job_redis, fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
 
-def test_delete_files_only_raw(test_client, monkeypatch, temp_files_only_raw):
-    temp_files = temp_files_only_raw
-    attachments_dir = temp_files["attachments_dir"]
-    clean_email_dir = temp_files["clean_email_dir"]
-    raw_email_dir = temp_files["raw_email_dir"]
+    response = test_client.post(
+        "/delete/",
+        data={"correspondent": "Stu@bmail.com"},
+        headers={"Accept": "application/json"},
+    )
 
-    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
-    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_email_dir)
-    monkeypatch.setattr(app.dir_config, "RAW_EMAIL_DIR", raw_email_dir)
+    assert response.status_code == 202
+    run_next_job(job_redis, app.dir_config)
+    job = get_job(job_redis, response.json["job_id"])
+    assert job["status"] == "done"
+    assert job["messages_deleted"] == job["deleted_messages"] == 120
+    assert not saved_files(fetch_dirs["raw_email_dir"], ".eml")
+    assert not saved_files(fetch_dirs["raw_email_dir"], MANIFEST_SUFFIX)
+    assert not os.listdir(fetch_dirs["clean_email_dir"])
+    assert not os.listdir(fetch_dirs["attachments_dir"])
 
-    response = test_client.post("/delete/")
 
-    assert response.status_code == 302
+def test_delete_messages_keeps_shared(fake_mailbox, fetch_dirs):
+    fake_mailbox.messages = {
+        f"{number:016x}": make_message(
+            number, to="Biff <biff@email.com>" if number < 5 else "Will <will@jmail.com>"
+        )
+        for number in range(10)
+    }
+    fetch_emails(["stu@bmail.com", "biff@email.com"], app.dir_config)
 
-    assert not os.listdir(raw_email_dir)
+    result = delete_messages(app.dir_config, correspondent="biff@email.com")
 
-    with test_client.session_transaction() as session:
-        messages = [
-            message[1] for message in session["_flashes"] if message[0] == "message"
-        ]
-        assert "No cleaned emails found." in messages
-        assert "No attachments found." in messages
-        assert "Deleted 2 emails." in messages
+    assert result["deleted_messages"] == 0
+    assert len(saved_files(fetch_dirs["raw_email_dir"], ".eml")) == 10
+    assert not get_catalog(app.dir_config).browse(correspondent="biff@email.com")["total"]
+    assert get_catalog(app.dir_config).browse(correspondent="stu@bmail.com")["total"] == 10
+    assert not load_manifest(fetch_dirs["raw_email_dir"], "biff@email.com")["message_ids"]
+
+
+def test_delete_messages_keeps_shared_blobs(fake_mailbox, fetch_dirs, monkeypatch):
+    monkeypatch.setattr("emails.ATTACHMENT_STORE", "blobs")
+    # The first two messages have the same attachment
+    fake_mailbox.messages = {
+        f"{index:016x}": make_message(number, attachments=1)
+        for index, number in enumerate((1, 1, 2))
+    }
+    fetch_emails("stu@bmail.com", app.dir_config)
+    attachments_dir = fetch_dirs["attachments_dir"]
+    kept_id = f"{1:016x}"
+    [(_, shared)] = load_message_blobs(attachments_dir, kept_id)
+    # Which blobs are still used is looked up in the catalog, not in the maps
+    os.remove(map_path(attachments_dir, kept_id))
+
+    result = delete_messages(app.dir_config, message_ids=[f"{0:016x}", f"{2:016x}"])
+
+    assert result == {"deleted_messages": 2, "deleted_attachments": 1}
+    assert count_blobs(attachments_dir) == 1
+    assert os.path.exists(blob_path(attachments_dir, shared))
+
+
+def test_incremental_fetch_after_delete(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    message_ids = [f"{number:016x}" for number in range(3)]
+    delete_messages(app.dir_config, message_ids=message_ids)
+    manifest = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")
+    assert manifest["history_id"] is None
+
+    # History only has messages added since, so the message ids are compared instead
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+
+    assert result["total_messages"] == 3
+    assert len(saved_files(fetch_dirs["raw_email_dir"], ".eml")) == 120
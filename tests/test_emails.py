@@ -1,21 +1,25 @@
 import os
-import pytest
-
 from email import policy
-from email.parser import BytesParser
+from email.message import EmailMessage
+from email.parser import BytesParser, Parser
+from types import SimpleNamespace
 
-from app import app
+import pytest
 from emails import (
     build_email_content,
     # clean_body,
     clean_email,
+    clean_emails,
     format_subject,
     get_attachments,
     get_body,
+    iter_payload,
+    parse_email,
     set_date,
 )
+from lazyparse import parse_lazily
 
-import ipdb
+from app import app
 
 
 @pytest.fixture()
@@ -61,6 +65,25 @@ def many_attachments():
         yield message, filename, raw_email_path, message_id
 
 
+@pytest.fixture()
+def crlf_email(tmp_path):
+    """
+    Write and yield the path of an email with CRLF line breaks, as Gmail sends them.
+    """
+    msg = EmailMessage()
+    msg["Date"] = "Tue, 12 Mar 2024 09:30:00 +0000"
+    msg["Subject"] = "minutes from tuesday"
+    msg["To"] = "stu bettler <stu@bmail.com>"
+    msg["From"] = "Will Jakobson <will@jmail.com>"
+    msg.set_content(
+        "Here are the minutes.\n\nNobody objected to the new schedule,\nso it starts next week.\n"
+    )
+    msg.add_attachment("1. Schedule\n2. Budget\n", filename="minutes.txt")
+    raw_email_path = tmp_path / "crlf_line_breaks.eml"
+    raw_email_path.write_bytes(msg.as_bytes(policy=policy.default.clone(linesep="\r\n")))
+    yield raw_email_path
+
+
 def test_set_date_no_attachments(no_attachments):
     message = no_attachments[0]
     raw_date = message["Date"]
@@ -149,6 +172,14 @@ def test_get_body_nested(many_attachments):
     assert result == expected
 
 
+def test_get_body_html_only_with_attachment():
+    message = EmailMessage()
+    message.set_content("<p>Just some drafts.</p>", subtype="html")
+    message.add_attachment(b"draft", maintype="application", subtype="pdf", filename="draft.pdf")
+
+    assert get_body(message) == "This email has no text in the body."
+
+
 # def test_clean_body(no_attachments):
 #     message = no_attachments[0]
 #     body = get_body(message)
@@ -267,4 +298,221 @@ def test_clean_email_many_attachments(monkeypatch, many_attachments, temp_dirs):
     assert len(os.listdir(attachments_dir)) == 6
     assert expected_email_filename in os.listdir(clean_dir)
     for filename in expected_attachment_filenames:
-        assert filename in os.listdir(attachments_dir)
\ No newline at end of file
+        assert filename in os.listdir(attachments_dir)
+
+def test_clean_email_from_memory(monkeypatch, many_attachments, temp_dirs, tmp_path):
+    attachments_dir = temp_dirs["attachments_dir"]
+    clean_dir = temp_dirs["clean_email_dir"]
+
+    monkeypatch.setattr(app.dir_config, "ATTACHMENTS_DIR", attachments_dir)
+    monkeypatch.setattr(app.dir_config, "CLEAN_EMAIL_DIR", clean_dir)
+    filepath = many_attachments[2]
+    message_id = many_attachments[3]
+    expected_email_filename = '2015-06-19__revisions__test_id_11.txt'
+
+    clean_email(filepath, app.dir_config, message_id)
+    from_disk = (clean_dir / expected_email_filename).read_text(encoding="utf-8")
+
+    with open(filepath, "rb") as f:
+        raw_email = f.read()
+
+    for source in (raw_email, memoryview(raw_email)):
+        os.remove(clean_dir / expected_email_filename)
+        result = clean_email(source, app.dir_config, message_id)
+        from_memory = (clean_dir / expected_email_filename).read_text(encoding="utf-8")
+
+        assert result == 6
+        assert from_memory.startswith(f"***email_{message_id}.eml***\n")
+        assert from_memory.split("\n", 1)[1] == from_disk.split("\n", 1)[1]
+        assert len(os.listdir(attachments_dir)) == 6
+
+
+def test_clean_email_crlf_from_memory_matches_path(crlf_email, tmp_path):
+    raw_email = crlf_email.read_bytes()
+    assert b"\r\n" in raw_email
+    results = {}
+
+    for name, source in (("path", str(crlf_email)), ("memory", raw_email)):
+        config = SimpleNamespace(
+            CLEAN_EMAIL_DIR=tmp_path / f"clean_{name}",
+            ATTACHMENTS_DIR=tmp_path / f"attachments_{name}",
+        )
+        os.makedirs(config.CLEAN_EMAIL_DIR)
+        os.makedirs(config.ATTACHMENTS_DIR)
+        clean_email(source, config, "test_id_crlf")
+        (clean_file,) = config.CLEAN_EMAIL_DIR.iterdir()
+        results[name] = (
+            clean_file.name,
+            # The first line names the raw file, which differs
+            clean_file.read_bytes().split(b"\n", 1)[1],
+            {path.name: path.read_bytes() for path in config.ATTACHMENTS_DIR.iterdir()},
+        )
+
+    assert results["memory"] == results["path"]
+    assert b"\r" not in results["memory"][1]
+    assert b"schedule,\nso it starts" in results["memory"][1]
+
+
+def test_clean_emails_process_pool(no_attachments, one_attachment, many_attachments, tmp_path):
+    fixtures = (no_attachments, one_attachment, many_attachments)
+    raw_emails = [(fixture[3], fixture[2]) for fixture in fixtures]
+    results = {}
+
+    for processes in (1, 2):
+        config = SimpleNamespace(
+            CLEAN_EMAIL_DIR=tmp_path / f"clean_{processes}",
+            ATTACHMENTS_DIR=tmp_path / f"attachments_{processes}",
+        )
+        os.makedirs(config.CLEAN_EMAIL_DIR)
+        os.makedirs(config.ATTACHMENTS_DIR)
+
+        metadata = clean_emails(raw_emails, config, processes=processes)
+        clean_files = {
+            name: (config.CLEAN_EMAIL_DIR / name).read_bytes()
+            for name in os.listdir(config.CLEAN_EMAIL_DIR)
+        }
+        attachments = {
+            name: (config.ATTACHMENTS_DIR / name).read_bytes()
+            for name in os.listdir(config.ATTACHMENTS_DIR)
+        }
+        for item in metadata:
+            item["clean_file"] = os.path.basename(item["clean_file"])
+        results[processes] = (metadata, clean_files, attachments)
+
+    assert results[1] == results[2]
+    assert [item["message_id"] for item in results[2][0]] == ["test_id_01", "test_id_10", "test_id_11"]
+    assert [len(item["attachments"]) for item in results[2][0]] == [0, 1, 6]
+    assert results[2][0][1]["subject"] == "beautiful and stunning"
+
+
+@pytest.mark.parametrize("chunk_size", [5, 77, 1024 * 1024])
+def test_iter_payload_matches_get_payload(many_attachments, chunk_size):
+    message = many_attachments[0]
+
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        decoded = b"".join(iter_payload(part, chunk_size))
+        assert decoded == part.get_payload(decode=True)
+
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable"])
+def test_iter_payload_encodings(cte):
+    msg = EmailMessage()
+    msg.set_content(("Lines of text = and more, ünïcode too. " * 40 + "\n") * 30, cte=cte)
+    if cte == "base64":
+        # Leave off the padding, which the email package tolerates
+        msg.set_payload(msg.get_payload().rstrip().rstrip("="))
+
+    for chunk_size in (3, 64, 100000):
+        assert b"".join(iter_payload(msg, chunk_size)) == msg.get_payload(decode=True)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        "QQ==QUJD",  # padding in the middle, where the email package stops
+        "QUJDR",  # a length no padding can complete, left undecoded
+        "QUJD\nRUZH\n",
+        "QUJD RUZH",  # spaces, which the email package skips only after a failed try
+        "QUJDRQ",  # missing padding
+        "QUJDRQ=",
+        "QUJD==",
+        "QUJD\u00e9RUZH",
+        "",
+    ],
+)
+def test_iter_payload_base64_like_email_package(payload):
+    msg = EmailMessage()
+    msg["Content-Transfer-Encoding"] = "base64"
+    msg.set_payload(payload)
+
+    for chunk_size in (1, 2, 3, 4, 100):
+        assert b"".join(iter_payload(msg, chunk_size)) == msg.get_payload(decode=True)
+
+
+def message_tree(msg):
+    """
+    Return what cleaning can see of a parsed message: headers, types and payloads.
+    """
+    if msg.is_multipart():
+        payload = [message_tree(part) for part in msg.get_payload()]
+    else:
+        payload = msg.get_payload()
+    return msg.items(), msg.get_content_type(), payload
+
+
+@pytest.mark.parametrize(
+    "filename", ["no_attachments.eml", "one_attachment.eml", "many_attachments.eml"]
+)
+@pytest.mark.parametrize("line_break", [b"\n", b"\r\n"])
+def test_parse_lazily_matches_email_package(filename, line_break):
+    with open(os.path.join(os.path.dirname(__file__), "raw_emails", filename), "rb") as f:
+        raw_email = f.read().replace(b"\r\n", b"\n").replace(b"\n", line_break)
+    text = raw_email.decode("ASCII", "surrogateescape")
+
+    msg = parse_lazily(text)
+    assert msg is not None
+    assert message_tree(msg) == message_tree(Parser(policy=policy.default).parsestr(text))
+    assert message_tree(parse_email(raw_email, "lazy")) == message_tree(
+        parse_email(raw_email, "full")
+    )
+
+
+MULTIPART = (
+    "From: a@b.com\nContent-Type: multipart/mixed; boundary=xx\n\n"
+    "preamble\n--xx\nContent-Type: text/plain\n\nhello\n{rest}"
+)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        MULTIPART.format(
+            rest="--xx\nContent-Type: message/rfc822\n\nSubject: hi\n\nyo\n--xx--\n"
+        ),
+        MULTIPART.format(rest="--xx\n--xx\nContent-Type: text/plain\n\nagain\n--xx--\n"),
+        MULTIPART.format(rest="no closing boundary\n"),
+        MULTIPART.format(rest="--xx--\n").replace("hello\n", "hello\r"),
+        MULTIPART.format(rest="--xx--\n").replace("boundary=xx", ""),
+        "From: a@b.com\nnot a header\n\nbody\n",
+    ],
+)
+def test_parse_lazily_leaves_unusual_messages(text):
+    assert parse_lazily(text) is None
+    raw_email = text.encode()
+    assert message_tree(parse_email(raw_email, "lazy")) == message_tree(
+        parse_email(raw_email, "full")
+    )
+
+
+def test_clean_email_lazy_matches_full(
+    no_attachments, one_attachment, many_attachments, tmp_path, monkeypatch
+):
+    fixtures = (no_attachments, one_attachment, many_attachments)
+    results = {}
+
+    for parser in ("full", "lazy"):
+        monkeypatch.setattr("emails.PARSER", parser)
+        config = SimpleNamespace(
+            CLEAN_EMAIL_DIR=tmp_path / f"clean_{parser}",
+            ATTACHMENTS_DIR=tmp_path / f"attachments_{parser}",
+        )
+        os.makedirs(config.CLEAN_EMAIL_DIR)
+        os.makedirs(config.ATTACHMENTS_DIR)
+        sources = []
+        for fixture in fixtures:
+            with open(fixture[2], "rb") as f:
+                sources += [(fixture[3], fixture[2]), (f"{fixture[3]}_memory", f.read())]
+
+        metadata = clean_emails(sources, config)
+        for item in metadata:
+            item["clean_file"] = os.path.basename(item["clean_file"])
+        results[parser] = (
+            metadata,
+            {path.name: path.read_bytes() for path in config.CLEAN_EMAIL_DIR.iterdir()},
+            {path.name: path.read_bytes() for path in config.ATTACHMENTS_DIR.iterdir()},
+        )
+
+    assert results["lazy"] == results["full"]
+    assert len(results["lazy"][2]) == 7
@@ -0,0 +1,351 @@
+import os
+import threading
+
+import pytest
+from catalog import get_catalog
+from checkpoints import load_checkpoint
+from emails import (
+    build_queries,
+    checkout_service,
+    fetch_emails,
+    get_messages_batch,
+    load_manifest,
+    parse_addresses,
+    return_service,
+    save_manifest,
+)
+from fake_gmail import make_message
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.errors import HttpError
+
+from app import app
+
+
+def raw_emails(dirs):
+    return [name for name in os.listdir(dirs["raw_email_dir"]) if name.endswith(".eml")]
+
+
+def test_fetch_emails_serial(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config)
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(raw_emails(fetch_dirs)) == 120
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120
+    assert len(os.listdir(fetch_dirs["attachments_dir"])) == 120
+
+
+def test_fetch_emails_batched(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config, batch_size=50)
+    batches = [request for request in fake_mailbox.requests if request[1].startswith("/batch")]
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(batches) == 3  # pages of 50, 50 and 20
+    assert len(raw_emails(fetch_dirs)) == 120
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120
+
+
+def test_get_messages_batch_retries_failed_items(fake_mailbox):
+    service = fake_mailbox.build()
+    message_ids = list(fake_mailbox.messages)[:10]
+    fake_mailbox.flaky_ids = {message_ids[2], message_ids[7]}
+
+    result = get_messages_batch(service, message_ids)
+    single_gets = [
+        request for request in fake_mailbox.requests if request[1].endswith(message_ids[2])
+    ]
+
+    assert result == [fake_mailbox.messages[message_id] for message_id in message_ids]
+    assert len(single_gets) == 2  # once inside the batch, once on its own
+
+
+def test_get_messages_batch_caps_batch_size(fake_mailbox):
+    service = fake_mailbox.build()
+    message_ids = list(fake_mailbox.messages)
+
+    result = get_messages_batch(service, message_ids, batch_size=500)
+    batches = [request for request in fake_mailbox.requests if request[1].startswith("/batch")]
+
+    assert len(result) == 120
+    assert len(batches) == 2
+
+
+def test_fetch_emails_workers(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config, workers=4)
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(raw_emails(fetch_dirs)) == 120
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120
+    assert len(os.listdir(fetch_dirs["attachments_dir"])) == 120
+
+
+def test_fetch_emails_workers_batched(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config, batch_size=20, workers=3)
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120
+
+
+def test_fetch_emails_workers_own_service(fake_mailbox, fetch_dirs, monkeypatch):
+    services = []
+
+    def build_service(*args, **kwargs):
+        service = fake_mailbox.build()
+        services.append((threading.get_ident(), service))
+        return service
+
+    monkeypatch.setattr("emails.build_service", build_service)
+    fetch_emails("stu@bmail.com", app.dir_config, workers=4)
+    thread_ids = [thread_id for thread_id, _ in services]
+
+    # One service for listing plus at most one per worker thread
+    assert 2 <= len(services) <= 5
+    assert len(set(thread_ids)) > 1
+
+
+def test_checkout_service():
+    creds = AnonymousCredentials()
+    service = checkout_service(creds)
+    other = checkout_service(creds)
+
+    # A service in use is never handed out again until it is returned
+    assert other is not service
+    return_service(creds, service)
+    assert checkout_service(creds) is service
+    # New credentials get a new service
+    assert checkout_service(AnonymousCredentials()) not in (service, other)
+
+
+def test_fetch_emails_reuses_services(fake_mailbox, fetch_dirs, monkeypatch):
+    creds = object()
+    builds = []
+
+    def build_service(*args, **kwargs):
+        builds.append(threading.get_ident())
+        return fake_mailbox.build()
+
+    monkeypatch.setattr("emails.get_credentials", lambda: creds)
+    monkeypatch.setattr("emails.build_service", build_service)
+    fetch_emails("stu@bmail.com", app.dir_config, workers=3)
+    first_fetch = len(builds)
+    fetch_emails("stu@bmail.com", app.dir_config, workers=3)
+
+    # One service for listing and at most one per download worker, all built by the first fetch
+    assert 2 <= first_fetch <= 3 + 1
+    assert len(builds) == first_fetch
+
+
+def test_fetch_emails_writes_manifest(fake_mailbox, fetch_dirs):
+    fetch_emails("Stu@bmail.com", app.dir_config)
+    manifest = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")
+
+    assert manifest["message_ids"] == set(fake_mailbox.messages)
+    assert manifest["history_id"] == "1000"
+
+
+def test_build_queries():
+    addresses = parse_addresses("Stu@bmail.com, biff@email.com;\nwill@jmail.com stu@bmail.com")
+    queries = build_queries(addresses, max_length=90)
+
+    assert addresses == ["stu@bmail.com", "biff@email.com", "will@jmail.com"]
+    assert queries == [
+        (
+            "to:stu@bmail.com OR from:stu@bmail.com OR to:biff@email.com OR from:biff@email.com",
+            ["stu@bmail.com", "biff@email.com"],
+        ),
+        ("to:will@jmail.com OR from:will@jmail.com", ["will@jmail.com"]),
+    ]
+
+
+def test_fetch_emails_several_correspondents(fake_mailbox, fetch_dirs, monkeypatch):
+    # Stu writes to Will, Stu writes to Biff, and Biff writes to Will
+    fake_mailbox.messages = {
+        f"{number:016x}": make_message(
+            number,
+            to="Biff <biff@email.com>" if 10 <= number < 20 else "Will <will@jmail.com>",
+            from_="Biff <biff@email.com>" if number >= 20 else "Stu <stu@bmail.com>",
+        )
+        for number in range(30)
+    }
+    # One search per correspondent, so messages between them are listed twice
+    monkeypatch.setattr("emails.MAX_QUERY_LENGTH", 50)
+
+    result = fetch_emails(["stu@bmail.com", "biff@email.com"], app.dir_config)
+    gets = [request for request in fake_mailbox.requests if "/messages/" in request[1]]
+    catalog = get_catalog(app.dir_config)
+    raw_dir = fetch_dirs["raw_email_dir"]
+
+    assert result == {"total_messages": 30, "total_attachments": 0}
+    assert len(gets) == 30
+    assert catalog.browse(correspondent="stu@bmail.com")["total"] == 20
+    assert catalog.browse(correspondent="biff@email.com")["total"] == 20
+    shared = catalog.browse(correspondent="biff@email.com", sort="subject", order="asc")
+    assert shared["messages"][0]["correspondents"] == ["biff@email.com", "stu@bmail.com"]
+    assert len(load_manifest(raw_dir, "stu@bmail.com")["message_ids"]) == 20
+    assert len(load_manifest(raw_dir, "biff@email.com")["message_ids"]) == 20
+
+
+def test_fetch_emails_incremental_nothing_new(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    fake_mailbox.requests.clear()
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+    listed = [request for request in fake_mailbox.requests if request[1].endswith("/messages")]
+
+    assert result == {"total_messages": 0, "total_attachments": 0}
+    assert not listed
+
+
+def test_fetch_emails_incremental_history(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    fake_mailbox.add_message("new_message_1", make_message(500, attachments=1))
+    fake_mailbox.add_message("new_message_2", make_message(501))
+    fake_mailbox.requests.clear()
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+    gets = [request for request in fake_mailbox.requests if "/messages/" in request[1]]
+    batches = [request for request in fake_mailbox.requests if request[1].startswith("/batch")]
+    listed = [request for request in fake_mailbox.requests if request[1].endswith("/messages")]
+    manifest = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")
+
+    assert result == {"total_messages": 2, "total_attachments": 1}
+    # The new messages' headers in one batch, then each message
+    assert len(gets) == 4
+    assert len(batches) == 1
+    assert not listed
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 122
+    assert manifest["history_id"] == "1002"
+    assert {"new_message_1", "new_message_2"} <= manifest["message_ids"]
+
+
+def test_fetch_emails_incremental_history_unrelated_mail(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    other = "Biff Wellington <biff@email.com>"
+    fake_mailbox.add_message("unrelated", make_message(500, to=other, from_=other))
+    fake_mailbox.add_message("spam", make_message(501))
+    fake_mailbox.labels["spam"] = ["SPAM"]
+    fake_mailbox.add_message("new_message", make_message(502))
+    fake_mailbox.requests.clear()
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+    listed = [request for request in fake_mailbox.requests if request[1].endswith("/messages")]
+    manifest = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")
+
+    assert result == {"total_messages": 1, "total_attachments": 0}
+    assert len(listed) == 0
+    assert "new_message" in manifest["message_ids"]
+    assert not {"unrelated", "spam"} & manifest["message_ids"]
+
+
+def test_fetch_emails_incremental_history_batches(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    for number in range(5):
+        fake_mailbox.add_message(f"new_message_{number}", make_message(500 + number))
+    fake_mailbox.add_message("deleted", make_message(505))
+    del fake_mailbox.messages["deleted"]
+    fake_mailbox.flaky_ids.add("new_message_3")
+    fake_mailbox.requests.clear()
+
+    result = fetch_emails(
+        "stu@bmail.com", app.dir_config, incremental=True, batch_size=2, workers=2
+    )
+    batches = [request for request in fake_mailbox.requests if request[1].startswith("/batch")]
+    manifest = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")
+
+    assert result == {"total_messages": 5, "total_attachments": 0}
+    # Headers of six messages, then five downloads, two at a time
+    assert len(batches) == 3 + 3
+    assert {f"new_message_{number}" for number in range(5)} <= manifest["message_ids"]
+    assert "deleted" not in manifest["message_ids"]
+
+
+def test_fetch_emails_incremental_expired_history(fake_mailbox, fetch_dirs):
+    fetch_emails("stu@bmail.com", app.dir_config)
+    fake_mailbox.add_message("new_message_1", make_message(500))
+    fake_mailbox.oldest_history_id = 1001
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+
+    assert result == {"total_messages": 1, "total_attachments": 0}
+
+
+def test_fetch_emails_incremental_without_history(fake_mailbox, fetch_dirs):
+    message_ids = list(fake_mailbox.messages)
+    save_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com", message_ids[:100], None)
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, incremental=True)
+
+    assert result == {"total_messages": 20, "total_attachments": 21}
+    assert load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")["message_ids"] == set(
+        message_ids
+    )
+
+
+def test_fetch_emails_resume(fake_mailbox, fetch_dirs, monkeypatch):
+    monkeypatch.setattr("emails.MANIFEST_INTERVAL", 10)
+    get_message = fake_mailbox.get_message
+
+    def fail_after_75(message_id):
+        if len(fake_mailbox.requests) > 75:
+            return fake_mailbox.error(400, "Bad Request")
+        return get_message(message_id)
+
+    monkeypatch.setattr(fake_mailbox, "get_message", fail_after_75)
+    with pytest.raises(HttpError):
+        fetch_emails("stu@bmail.com", app.dir_config)
+    checkpoint = load_checkpoint(fetch_dirs["raw_email_dir"], ["stu@bmail.com"])
+    saved = load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")["message_ids"]
+
+    # The second page of 50 was being fetched
+    assert checkpoint["page_token"] == "50"
+    assert checkpoint["completed_ids"] <= saved
+
+    monkeypatch.setattr(fake_mailbox, "get_message", get_message)
+    fake_mailbox.requests.clear()
+    result = fetch_emails("stu@bmail.com", app.dir_config, resume=True)
+    gets = [request for request in fake_mailbox.requests if "/messages/" in request[1]]
+    lists = [request for request in fake_mailbox.requests if request[1].endswith("/messages")]
+
+    assert result["total_messages"] == len(gets) == 120 - len(saved)
+    assert len(lists) == 2
+    assert len(raw_emails(fetch_dirs)) == 120
+    assert load_manifest(fetch_dirs["raw_email_dir"], "stu@bmail.com")["message_ids"] == set(
+        fake_mailbox.messages
+    )
+    assert load_checkpoint(fetch_dirs["raw_email_dir"], ["stu@bmail.com"]) is None
+
+
+def test_fetch_emails_pipeline_stages(fake_mailbox, fetch_dirs):
+    events = []
+
+    def progress(event, **data):
+        events.append((event, data))
+
+    result = fetch_emails(
+        "stu@bmail.com",
+        app.dir_config,
+        workers=3,
+        cleaners=2,
+        writers=2,
+        queue_size=1,
+        progress=progress,
+    )
+    stages = [data["stages"] for event, data in events if event == "stages"][-1]
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert list(stages) == ["list", "download", "clean", "write"]
+    assert stages["list"]["processed"] == 120
+    assert stages["download"]["processed"] == 120
+    assert stages["write"]["processed"] == 120
+    assert stages["clean"]["workers"] == 2
+    assert stages["clean"]["queue_size"] == 1
+    for message_id, raw in fake_mailbox.messages.items():
+        assert (fetch_dirs["raw_email_dir"] / f"email_{message_id}.eml").read_bytes() == raw
+
+
+def test_fetch_emails_clean_processes(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config, workers=2, clean_processes=2)
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(raw_emails(fetch_dirs)) == 120
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120
+    assert len(os.listdir(fetch_dirs["attachments_dir"])) == 120
@@ -1,8 +1,10 @@
-import pytest
+from unittest.mock import Mock, create_autospec, patch
 
-from app import app, DirConfig
-from unittest.mock import Mock, patch, create_autospec
+import pytest
 from google.auth.credentials import Credentials
+from jobs import get_job, run_next_job
+
+from app import DirConfig, app
 
 
 @pytest.fixture()
@@ -16,6 +18,8 @@ def test_get(test_client):
     response = test_client.get("/")
 
     assert response.status_code == 200
+    # A plain fetch is a full one; incremental and resuming are opted into
+    assert b"checked" not in response.data
 
 
 def test_post_empty_request(test_client):
@@ -24,9 +28,10 @@ def test_post_empty_request(test_client):
     assert response.status_code == 400
 
 
-def test_post_no_creds(test_client, monkeypatch, mock_token):
+def test_post_no_creds(test_client, monkeypatch, mock_token, job_redis):
     mock_creds = None
     monkeypatch.setattr("auth.get_credentials", lambda: mock_creds)
+    monkeypatch.setattr("emails.get_credentials", lambda: mock_creds)
     monkeypatch.setattr("auth.TOKEN", mock_token)
 
     response = test_client.post("/", data={"email_address": "biff@email.com"})
@@ -37,7 +42,14 @@ def test_post_no_creds(test_client, monkeypatch, mock_token):
         messages = [
             message[1] for message in session["_flashes"] if message[0] == "message"
         ]
-        assert "Failed to obtain credentials." in messages
+        assert "Started fetching emails for biff@email.com." in messages
+
+    job_id = run_next_job(job_redis, app.dir_config)
+    job = get_job(job_redis, job_id)
+
+    assert response.location.endswith(f"/?job={job_id}")
+    assert job["status"] == "failed"
+    assert job["errors"] == ["Failed to obtain credentials."]
 
 
 @pytest.mark.skip(reason="Haven't gotten this working yet")
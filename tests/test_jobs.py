@@ -0,0 +1,240 @@
+import json
+import os
+import pstats
+
+import pytest
+from blobs import count_blobs
+from jobs import (
+    JobCancelled,
+    JobProgress,
+    cancel_job,
+    enqueue_fetch,
+    events_channel,
+    get_job,
+    run_job,
+    run_next_job,
+    stream_job_events,
+)
+from rawstore import get_packed_store
+
+from app import app
+
+
+def test_enqueue_fetch(job_redis):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com", incremental=True)
+    job = get_job(job_redis, job_id)
+
+    assert job["status"] == "queued"
+    assert job["email_address"] == "stu@bmail.com"
+    assert job["incremental"] is True
+    assert job["messages_fetched"] == 0
+    assert job["errors"] == []
+
+
+def test_get_job_missing(job_redis):
+    assert get_job(job_redis, "nope") is None
+
+
+def test_run_next_job_empty_queue(job_redis):
+    assert run_next_job(job_redis, app.dir_config, timeout=0.1) is None
+
+
+def test_run_job(job_redis, fake_mailbox, fetch_dirs):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+
+    assert run_next_job(job_redis, app.dir_config) == job_id
+
+    job = get_job(job_redis, job_id)
+    assert job["status"] == "done"
+    assert job["pages_listed"] == 3
+    assert job["messages_fetched"] == 120
+    assert job["attachments_saved"] == 120
+    assert job["total_messages"] == 120
+    assert job["total_attachments"] == 120
+    assert job["stages"]["write"]["processed"] == 120
+    assert job_redis.ttl(f"gfetch:job:{job_id}") > 0
+
+
+def test_run_job_with_config_settings(job_redis, fake_mailbox, fetch_dirs, monkeypatch):
+    monkeypatch.setattr(app.dir_config, "RAW_STORE", "packed")
+    monkeypatch.setattr(app.dir_config, "ATTACHMENT_STORE", "blobs")
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+
+    run_next_job(job_redis, app.dir_config)
+
+    assert get_job(job_redis, job_id)["status"] == "done"
+    assert len(get_packed_store(fetch_dirs["raw_email_dir"])) == 120
+    assert not [name for name in os.listdir(fetch_dirs["raw_email_dir"]) if name.endswith(".eml")]
+    assert count_blobs(fetch_dirs["attachments_dir"]) == 120
+
+
+def test_cancel_queued_job(job_redis, fake_mailbox, fetch_dirs):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+
+    assert cancel_job(job_redis, job_id)
+    run_next_job(job_redis, app.dir_config)
+
+    assert get_job(job_redis, job_id)["status"] == "cancelled"
+    assert not fake_mailbox.requests
+
+
+def test_cancel_running_job(job_redis, fake_mailbox, fetch_dirs, monkeypatch):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    get_message = fake_mailbox.get_message
+
+    def cancel_after_ten(message_id):
+        if len(fake_mailbox.requests) == 10:
+            cancel_job(job_redis, job_id)
+        return get_message(message_id)
+
+    monkeypatch.setattr(fake_mailbox, "get_message", cancel_after_ten)
+    run_job(job_redis, job_id, app.dir_config)
+    job = get_job(job_redis, job_id)
+
+    assert job["status"] == "cancelled"
+    assert job["messages_fetched"] < 120
+
+
+def test_cancel_missing_job(job_redis):
+    assert not cancel_job(job_redis, "nope")
+
+
+def test_job_status_route(test_client, job_redis):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+
+    response = test_client.get(f"/jobs/{job_id}")
+
+    assert response.status_code == 200
+    assert response.json["status"] == "queued"
+    assert test_client.get("/jobs/nope").status_code == 404
+
+
+def test_cancel_route(test_client, job_redis):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+
+    response = test_client.post(f"/jobs/{job_id}/cancel")
+
+    assert response.status_code == 200
+    assert response.json["status"] == "cancelled"
+    assert test_client.post("/jobs/nope/cancel").status_code == 404
+
+
+def test_post_json_returns_job_id(test_client, job_redis):
+    response = test_client.post(
+        "/",
+        data={"email_address": "stu@bmail.com"},
+        headers={"Accept": "application/json"},
+    )
+
+    assert response.status_code == 202
+    assert get_job(job_redis, response.json["job_id"])["status"] == "queued"
+    assert job_redis.lindex("gfetch:jobs:queue", 0).decode() == response.json["job_id"]
+
+
+def test_job_progress_only_publishes_to_listeners(job_redis, monkeypatch):
+    monkeypatch.setattr("jobs.LISTENER_CHECK_INTERVAL", 0)
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    progress = JobProgress(job_redis, job_id)
+
+    progress("page", messages=50)
+    assert not progress.listening
+
+    pubsub = job_redis.pubsub()
+    pubsub.subscribe(events_channel(job_id))
+    assert pubsub.get_message(timeout=1)["type"] == "subscribe"
+    progress("cleaned", message_id="abc", attachments=2)
+    event = json.loads(pubsub.get_message(timeout=1)["data"])
+
+    assert progress.listening
+    assert event["event"] == "cleaned"
+    assert event["message_id"] == "abc"
+    assert event["messages_listed"] == 50
+    assert event["attachments_saved"] == 2
+    assert event["rate"] > 0
+    assert event["eta"] is not None
+    # Per-message counts are saved on the next event that isn't per message
+    assert get_job(job_redis, job_id)["messages_cleaned"] == 0
+    progress("stages", stages={})
+    assert get_job(job_redis, job_id)["messages_cleaned"] == 1
+
+
+def test_job_progress_per_message_events_skip_redis(job_redis, monkeypatch):
+    monkeypatch.setattr("jobs.LISTENER_CHECK_INTERVAL", float("inf"))
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    progress = JobProgress(job_redis, job_id)
+    progress("page", messages=50)
+
+    # With no one listening, per-message events don't touch redis at all
+    progress.redis = None
+    for number in range(50):
+        progress("fetched", message_id=str(number), size=100)
+        progress("cleaned", message_id=str(number), attachments=1)
+    progress.redis = job_redis
+    cancel_job(job_redis, job_id)
+
+    with pytest.raises(JobCancelled):
+        progress("stages", stages={})
+    job = get_job(job_redis, job_id)
+    assert job["messages_fetched"] == job["messages_cleaned"] == 50
+    assert job["attachments_saved"] == 50
+
+
+def test_stream_job_events(job_redis, fake_mailbox, fetch_dirs, monkeypatch):
+    monkeypatch.setattr("jobs.LISTENER_CHECK_INTERVAL", 0)
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    stream = stream_job_events(job_redis, job_id)
+
+    first = next(stream)
+    run_job(job_redis, job_id, app.dir_config)
+    events = [json.loads(chunk.removeprefix("data: ")) for chunk in stream]
+
+    assert first.startswith("event: status\n")
+    assert json.loads(first.split("data: ", 1)[1])["status"] == "queued"
+    assert [event["event"] for event in events].count("cleaned") == 120
+    assert events[-1]["event"] == "finished"
+    assert events[-1]["status"] == "done"
+    assert events[-1]["messages_cleaned"] == 120
+
+
+def test_job_events_route_finished_job(test_client, job_redis):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    cancel_job(job_redis, job_id)
+
+    response = test_client.get(f"/jobs/{job_id}/events")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert '"status": "cancelled"' in response.get_data(as_text=True)
+    assert test_client.get("/jobs/nope/events").status_code == 404
+
+
+def test_profiled_job(test_client, job_redis, fake_mailbox, fetch_dirs):
+    response = test_client.post(
+        "/",
+        data={"email_address": "stu@bmail.com"},
+        headers={"Accept": "application/json", "X-Gfetch-Profile": "1"},
+    )
+    job_id = response.json["job_id"]
+    assert get_job(job_redis, job_id)["profile"] is True
+    assert test_client.get(f"/jobs/{job_id}/profile").status_code == 404
+
+    run_next_job(job_redis, app.dir_config)
+
+    profile = test_client.get(f"/jobs/{job_id}/profile")
+    assert profile.status_code == 200
+    path = fetch_dirs["raw_email_dir"] / "downloaded.prof"
+    path.write_bytes(profile.data)
+    assert pstats.Stats(str(path)).total_calls
+    summary = test_client.get(f"/jobs/{job_id}/profile?format=text").get_data(as_text=True)
+    assert "fetch_emails" in summary
+    # Work done by the pipeline's threads is in the profile too
+    assert "clean_email_with_metadata" in summary
+
+
+def test_unprofiled_job_has_no_profile(test_client, job_redis, fake_mailbox, fetch_dirs):
+    job_id = enqueue_fetch(job_redis, "stu@bmail.com")
+    run_next_job(job_redis, app.dir_config)
+
+    assert get_job(job_redis, job_id)["profile"] is False
+    assert test_client.get(f"/jobs/{job_id}/profile").status_code == 404
+    assert not (fetch_dirs["raw_email_dir"] / "profiles").exists()
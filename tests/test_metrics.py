@@ -0,0 +1,84 @@
+import re
+
+import pytest
+from emails import get_message
+from jobs import enqueue_fetch, run_next_job
+from metrics import Counter, Histogram, _metrics, render_metrics, reset_metrics
+from throttling import AdaptiveLimiter
+
+from app import app
+
+
+@pytest.fixture
+def metrics():
+    reset_metrics()
+    yield
+    reset_metrics()
+
+
+def sample(text, name, **labels):
+    """
+    Return the value of a sample in the exposition text, or None.
+    """
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    if label_text:
+        name = f"{name}{{{label_text}}}"
+    match = re.search(rf"^{re.escape(name)} (\S+)$", text, re.MULTILINE)
+    return None if match is None else float(match.group(1))
+
+
+def test_render_counter_and_histogram():
+    counter = Counter("test_things_total", "Things.", ("kind",))
+    histogram = Histogram("test_seconds", "Time.", ("step",), buckets=(0.1, 1))
+    try:
+        counter.inc(2, 'a "b"')
+        counter.inc(1, 'a "b"')
+        histogram.observe(0.05, "x")
+        histogram.observe(0.5, "x")
+        histogram.observe(5, "x")
+        text = render_metrics()
+    finally:
+        _metrics.remove(counter)
+        _metrics.remove(histogram)
+
+    assert "# TYPE test_things_total counter" in text
+    assert 'test_things_total{kind="a \\"b\\""} 3' in text
+    assert "# TYPE test_seconds histogram" in text
+    assert sample(text, "test_seconds_bucket", step="x", le="0.1") == 1
+    assert sample(text, "test_seconds_bucket", step="x", le="1") == 2
+    assert sample(text, "test_seconds_bucket", step="x", le="+Inf") == 3
+    assert sample(text, "test_seconds_sum", step="x") == 5.55
+    assert sample(text, "test_seconds_count", step="x") == 3
+
+
+def test_metrics_route_after_fetch(test_client, job_redis, fake_mailbox, fetch_dirs, metrics):
+    enqueue_fetch(job_redis, "stu@bmail.com")
+    run_next_job(job_redis, app.dir_config)
+
+    response = test_client.get("/metrics")
+    text = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    assert sample(text, "gfetch_stage_seconds_count", stage="list") == 3
+    for stage in ("get", "decode", "parse", "get_attachments", "write_raw", "write_clean"):
+        assert sample(text, "gfetch_stage_seconds_count", stage=stage) == 120
+    assert sample(text, "gfetch_stage_bytes_total", stage="write_raw") == sum(
+        len(raw_email) for raw_email in fake_mailbox.messages.values()
+    )
+    assert sample(text, "gfetch_stage_bytes_total", stage="get_attachments") > 0
+    assert sample(text, "gfetch_jobs_in_flight", kind="fetch") == 0
+    assert sample(text, "gfetch_jobs_finished_total", kind="fetch", status="done") == 1
+
+
+def test_api_errors_and_retries_counted(fake_mailbox, metrics):
+    message_id = next(iter(fake_mailbox.messages))
+    fake_mailbox.throttle(2, retry_after=0)
+
+    get_message(fake_mailbox.build(), message_id, AdaptiveLimiter(4))
+
+    text = render_metrics()
+    assert sample(text, "gfetch_api_errors_total", status="429") == 2
+    assert sample(text, "gfetch_api_throttled_total") == 2
+    assert sample(text, "gfetch_api_retries_total") == 2
+    assert sample(text, "gfetch_stage_seconds_count", stage="get") == 1
@@ -1,4 +1,12 @@
-from app import app, create_dirs
+import os
+import subprocess
+import sys
+
+from emails import fetch_options
+
+from app import DirConfig, app, create_app, create_dirs
+
+APP_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app")
 
 
 def test_create_dirs_already_exist(monkeypatch, temp_dirs):
@@ -31,3 +39,60 @@ def test_create_dirs_not_exist(monkeypatch, tmp_path):
     assert attachments_dir.exists()
     assert clean_email_dir.exists()
     assert raw_email_dir.exists()
+
+
+def test_create_app_with_config(tmp_path):
+    config = {
+        "RAW_EMAIL_DIR": str(tmp_path / "raw"),
+        "CLEAN_EMAIL_DIR": str(tmp_path / "clean"),
+        "ATTACHMENTS_DIR": str(tmp_path / "clean" / "attachments"),
+        "JOB_WORKERS": 0,
+    }
+
+    other_app = create_app(config)
+
+    assert other_app is not app
+    assert isinstance(other_app.dir_config, DirConfig)
+    assert other_app.dir_config.RAW_EMAIL_DIR == config["RAW_EMAIL_DIR"]
+    assert app.dir_config.RAW_EMAIL_DIR != config["RAW_EMAIL_DIR"]
+    assert other_app.config["JOB_WORKERS"] == 0
+    assert (tmp_path / "clean" / "attachments").is_dir()
+    assert other_app.test_client().get("/").status_code == 200
+
+
+def test_create_app_job_settings(tmp_path, monkeypatch):
+    # Read when the app is created, long after the modules using them were imported
+    monkeypatch.setenv("GFETCH_WORKERS", "3")
+    monkeypatch.setenv("GFETCH_PROFILES_DIR", "")
+    monkeypatch.setenv("GFETCH_METRICS_PORT", "9100")
+    config = {
+        "RAW_EMAIL_DIR": str(tmp_path / "raw"),
+        "CLEAN_EMAIL_DIR": str(tmp_path / "clean"),
+        "ATTACHMENTS_DIR": str(tmp_path / "attachments"),
+        "RAW_STORE": "packed",
+        "DELETE_BATCH_SIZE": 10,
+    }
+
+    other_app = create_app(config)
+    dir_config = other_app.dir_config
+    options = fetch_options(dir_config)
+
+    assert (options["workers"], options["raw_store"]) == (3, "packed")
+    assert dir_config.DELETE_BATCH_SIZE == 10
+    assert dir_config.PROFILES_DIR is None
+    assert other_app.config["METRICS_PORT"] == 9100
+
+
+def test_import_leaves_gmail_client():
+    """
+    Importing the app, without creating it, shouldn't import the Gmail client or OAuth libraries.
+    """
+    code = (
+        "import sys, app, jobs; "
+        "print(' '.join(name for name in sys.modules if name.startswith(('google', 'httplib2'))))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=APP_DIR, capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.split() == []
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+from pipeline import Pipeline, Stage
+
+
+def test_pipeline_runs_all_stages():
+    results = []
+
+    pipeline = Pipeline(
+        "numbers",
+        range(100),
+        [
+            Stage("double", lambda n: [n * 2], workers=4),
+            Stage("split", lambda n: [n, n + 1], workers=2),
+            Stage("collect", lambda n: results.append(n) or (), workers=1),
+        ],
+    )
+    pipeline.run()
+    stats = pipeline.stats()
+
+    assert sorted(results) == sorted([n * 2 for n in range(100)] + [n * 2 + 1 for n in range(100)])
+    assert stats["numbers"]["processed"] == 100
+    assert stats["double"]["processed"] == 100
+    assert stats["collect"]["processed"] == 200
+
+
+def test_pipeline_ordered_stage_keeps_input_order():
+    results = []
+
+    def slow_for_even(n):
+        if n % 2 == 0:
+            time.sleep(0.002)
+        yield n
+
+    pipeline = Pipeline(
+        "numbers",
+        range(50),
+        [
+            Stage("slow", slow_for_even, workers=4, ordered=True),
+            Stage("collect", lambda n: results.append(n) or ()),
+        ],
+    )
+    pipeline.run()
+
+    assert results == list(range(50))
+
+
+def test_pipeline_bounded_queues():
+    in_flight = []
+    lock = threading.Lock()
+    produced = 0
+
+    def source():
+        nonlocal produced
+        for n in range(200):
+            with lock:
+                produced += 1
+                in_flight.append(produced - consumed)
+            yield n
+
+    consumed = 0
+
+    def slow_consumer(n):
+        nonlocal consumed
+        time.sleep(0.0005)
+        with lock:
+            consumed += 1
+        return ()
+
+    pipeline = Pipeline("numbers", source(), [Stage("slow", slow_consumer, queue_size=5)])
+    pipeline.run()
+
+    # The queue plus the item being worked on, plus the one waiting to be put
+    assert max(in_flight) <= 7
+
+
+def test_pipeline_reraises_stage_errors():
+    def fail_on_ten(n):
+        if n == 10:
+            raise ValueError("ten")
+        yield n
+
+    pipeline = Pipeline(
+        "numbers",
+        range(1000),
+        [Stage("fail", fail_on_ten, workers=2), Stage("sink", lambda n: ())],
+    )
+
+    with pytest.raises(ValueError, match="ten"):
+        pipeline.run()
+    assert pipeline.stats()["numbers"]["processed"] < 1000
+
+
+def test_pipeline_reports_stats():
+    reports = []
+
+    def slow(n):
+        time.sleep(0.01)
+        return ()
+
+    pipeline = Pipeline("numbers", range(20), [Stage("slow", slow)])
+    pipeline.run(on_stats=reports.append, stats_interval=0.05)
+
+    assert len(reports) >= 2
+    assert reports[-1]["slow"]["processed"] == 20
+    assert 0 < reports[-1]["slow"]["utilization"] <= 1
@@ -0,0 +1,86 @@
+import os
+from types import SimpleNamespace
+
+from emails import fetch_emails, read_raw_email, reclean_emails, write_raw_email
+from fake_gmail import make_message
+from rawstore import PACKS_DIR, get_packed_store
+
+from app import app
+
+
+def test_packed_store_round_trip(tmp_path):
+    store = get_packed_store(tmp_path)
+    messages = {f"{number:016x}": make_message(number, attachments=1) for number in range(20)}
+
+    for message_id, raw in messages.items():
+        store.put(message_id, raw)
+
+    assert len(store) == 20
+    assert store.message_ids() == list(messages)
+    assert all(store.get(message_id) == raw for message_id, raw in messages.items())
+    assert store.get("missing") is None
+    # One segment holds every message, compressed
+    segments = [name for name in os.listdir(tmp_path / PACKS_DIR) if name.endswith(".pack")]
+    assert len(segments) == 1
+    assert os.path.getsize(tmp_path / PACKS_DIR / segments[0]) < sum(map(len, messages.values()))
+
+
+def test_packed_store_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr("rawstore.SEGMENT_SIZE", 1000)
+    store = get_packed_store(tmp_path)
+
+    paths = [store.put(str(number), make_message(number) * 3) for number in range(15)]
+    packs = tmp_path / PACKS_DIR
+    sizes = {name: os.path.getsize(packs / name) for name in os.listdir(packs)}
+    # Fetching a message again leaves the stored copy and the segments as they were
+    assert store.put("3", make_message(3) * 3) == paths[3]
+    assert {name: os.path.getsize(packs / name) for name in os.listdir(packs)} == sizes
+
+    assert len([name for name in os.listdir(packs) if name.endswith(".pack")]) > 2
+    assert store.get("3") == make_message(3) * 3
+    assert store.get("4") == make_message(4) * 3
+
+    assert store.delete([str(number) for number in range(15)] + ["missing"]) == 15
+    # Only the segment still being written to is kept
+    assert len([name for name in os.listdir(packs) if name.endswith(".pack")]) == 1
+    assert len(store) == 0
+
+
+def test_fetch_emails_packed(fake_mailbox, fetch_dirs):
+    result = fetch_emails("stu@bmail.com", app.dir_config, raw_store="packed")
+    raw_dir = fetch_dirs["raw_email_dir"]
+    message_id = next(iter(fake_mailbox.messages))
+
+    assert result["total_messages"] == 120
+    assert not [name for name in os.listdir(raw_dir) if name.endswith(".eml")]
+    assert len(get_packed_store(raw_dir)) == 120
+    assert read_raw_email(message_id, app.dir_config) == fake_mailbox.messages[message_id]
+
+
+def test_write_raw_email_names_its_file(tmp_path, capsys):
+    config = SimpleNamespace(RAW_EMAIL_DIR=tmp_path)
+
+    loose = write_raw_email("loose", make_message(1), config, store="files")
+    packed = write_raw_email("packed", make_message(2), config, store="packed")
+    output = capsys.readouterr().out
+
+    assert f"message loose into {os.path.basename(loose)}." in output
+    assert f"message packed into {os.path.basename(packed)}." in output
+    assert os.path.basename(packed).endswith(".pack")
+    assert not os.path.exists(tmp_path / "email_packed.eml")
+
+
+def test_reclean_emails(tmp_path):
+    config = SimpleNamespace(
+        RAW_EMAIL_DIR=tmp_path / "raw",
+        CLEAN_EMAIL_DIR=tmp_path / "clean",
+        ATTACHMENTS_DIR=tmp_path / "attachments",
+    )
+    for directory in (config.RAW_EMAIL_DIR, config.CLEAN_EMAIL_DIR, config.ATTACHMENTS_DIR):
+        os.makedirs(directory)
+    write_raw_email("loose", make_message(1), config, store="files")
+    write_raw_email("packed", make_message(2, attachments=1), config, store="packed")
+
+    assert reclean_emails(config, processes=0) == 2
+    assert len(os.listdir(config.CLEAN_EMAIL_DIR)) == 2
+    assert os.listdir(config.ATTACHMENTS_DIR) == ["file_2_0.bin"]
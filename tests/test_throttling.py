@@ -0,0 +1,117 @@
+import os
+
+import httplib2
+import pytest
+from emails import fetch_emails, get_message
+from googleapiclient.errors import HttpError
+from throttling import AdaptiveLimiter, execute, get_retry_after, is_throttled
+
+from app import app
+
+
+def http_error(status, headers=None, content=b"{}"):
+    return HttpError(httplib2.Response({"status": status, **(headers or {})}), content)
+
+
+def message_requests(mailbox, message_id):
+    return [request for request in mailbox.requests if request[1].endswith(message_id)]
+
+
+def test_execute_retries_throttled_request(fake_mailbox):
+    message_id = next(iter(fake_mailbox.messages))
+    fake_mailbox.throttle(3, retry_after=0)
+    limiter = AdaptiveLimiter(4)
+
+    raw = get_message(fake_mailbox.build(), message_id, limiter)
+
+    assert raw == fake_mailbox.messages[message_id]
+    assert len(message_requests(fake_mailbox, message_id)) == 4
+    assert limiter.stats()["throttles"] == 3
+    assert limiter.stats()["retries"] == 3
+
+
+def test_execute_gives_up(fake_mailbox):
+    message_id = next(iter(fake_mailbox.messages))
+    fake_mailbox.throttle(10, retry_after=0)
+
+    with pytest.raises(HttpError) as excinfo:
+        get_message(fake_mailbox.build(), message_id, retries=2)
+
+    assert excinfo.value.resp.status == 429
+    assert len(message_requests(fake_mailbox, message_id)) == 3
+
+
+def test_execute_does_not_retry_missing_message(fake_mailbox):
+    with pytest.raises(HttpError):
+        get_message(fake_mailbox.build(), "missing")
+
+    assert len(message_requests(fake_mailbox, "missing")) == 1
+
+
+def test_execute_backs_off_exponentially(fake_mailbox, monkeypatch):
+    delays = []
+    monkeypatch.setattr("throttling.random.uniform", lambda low, high: high)
+    monkeypatch.setattr("throttling.time.sleep", delays.append)
+    message_id = next(iter(fake_mailbox.messages))
+    fake_mailbox.throttle(4, status=503)
+
+    get_message(fake_mailbox.build(), message_id)
+
+    assert delays == [1.0, 2.0, 4.0, 8.0]
+
+
+def test_execute_retries_connection_errors():
+    class FlakyRequest:
+        calls = 0
+
+        def execute(self):
+            self.calls += 1
+            if self.calls == 1:
+                raise ConnectionError("reset")
+            return "ok"
+
+    request = FlakyRequest()
+
+    assert execute(request) == "ok"
+    assert request.calls == 2
+
+
+def test_get_retry_after():
+    assert get_retry_after(http_error(429, {"retry-after": "7"})) == 7.0
+    assert get_retry_after(http_error(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert get_retry_after(http_error(429)) is None
+
+
+def test_is_throttled():
+    rate_limited = b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+
+    assert is_throttled(http_error(429))
+    assert is_throttled(http_error(403, content=rate_limited))
+    assert not is_throttled(http_error(403))
+    assert not is_throttled(http_error(503))
+
+
+def test_adaptive_limiter(monkeypatch):
+    monkeypatch.setattr("throttling.DECREASE_INTERVAL", 0)
+    limiter = AdaptiveLimiter(8)
+
+    limiter.record(throttled=True)
+    limiter.record(throttled=True)
+    assert limiter.limit == 2
+
+    for _ in range(2 + 3):
+        limiter.record(throttled=False)
+    assert limiter.limit == 4
+
+    for _ in range(100):
+        limiter.record(throttled=False)
+    assert limiter.limit == 8
+
+
+def test_fetch_emails_survives_throttling(fake_mailbox, fetch_dirs):
+    fake_mailbox.throttle(5, retry_after=0)
+
+    result = fetch_emails("stu@bmail.com", app.dir_config, batch_size=20, workers=3)
+
+    assert result == {"total_messages": 120, "total_attachments": 120}
+    assert len(os.listdir(fetch_dirs["clean_email_dir"])) == 120